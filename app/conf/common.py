@@ -15,6 +15,40 @@ MAX_ESI_RETRIES = 3
 # how long to cache the results of all ESI requests
 ESI_CACHE_DURATION_SECONDS = 60 * 10
 
+# max number of ESI requests the async transport keeps in flight at once, and how long each one may take
+ESI_MAX_CONCURRENT_REQUESTS = 128
+ESI_REQUEST_TIMEOUT_SECONDS = 30
+
+# request rate shared by every process talking to ESI, see eve_api/esi_governor.py
+ESI_REQUESTS_PER_SECOND = 100
+ESI_REQUEST_BURST = 200
+
+# errors we allow ourselves per minute across every process, well under CCP's limit of 100. once it's used up, or ESI's
+# own error allowance drops under ESI_ERROR_LIMIT_THRESHOLD, nothing is sent until the window resets.
+ESI_ERROR_BUDGET_PER_MINUTE = 60
+ESI_ERROR_LIMIT_THRESHOLD = 20
+
+# longest a task will sleep waiting on the rate limiter. anything longer puts the task back on the queue.
+ESI_THROTTLE_MAX_SLEEP_SECONDS = 2
+
+# access tokens of characters with a scan due within this many seconds are refreshed ahead of the scan
+ESI_TOKEN_PREWARM_SECONDS = 60 * 5
+
+# how long to remember the ETag of an ESI page for conditional requests
+ESI_ETAG_DURATION_SECONDS = 60 * 60 * 24 * 2
+
+# how long static universe objects (types, structures, systems...) may live in each process' local cache
+LOCAL_CACHE_TTL_SECONDS = 60 * 5
+
+# scans are scheduled for when their ESI data expires, plus up to this many seconds so they don't all land at once
+ESI_SCAN_JITTER_SECONDS = 15
+
+# the scan scheduler won't let more than this many tasks pile up on each queue
+ESI_SCAN_QUEUE_CAPS = {
+    "general_queue": 50,
+    "player_queue": 100,
+}
+
 AUTHENTICATION_BACKENDS = [
     # Uncomment following if you want to access the admin
     'django.contrib.auth.backends.ModelBackend'
@@ -9,21 +9,19 @@ import enum
 import hashlib
 import waffle
 
-# we really really dont want to import this sanely or else monkey patch will trigger twice
-from manage import grequests
-
 from django.conf import settings
 from django.core.cache import cache
-from django.apps import apps
 
 from oauthlib.common import urldecode
 from oauthlib.oauth2.rfc6749.errors import *
-from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 from simplejson import JSONDecodeError
-from urllib3.util.retry import Retry
 from raven import breadcrumbs
 
+from eve_api import esi_governor, esi_tokens
+from eve_api.esi_exceptions import EsiCacheSwitchover
+from eve_api.esi_transport import EsiRequest, get_transport
+
 logger=logging.getLogger(__name__)
 
 
@@ -35,6 +33,15 @@ class EsiError(enum.Enum):
     EsiApplicationError = 5
 
 
+class EsiNotModified():
+    """
+    Yielded in place of a page when ESI answers a conditional request with 304 Not Modified. Carries the summary that
+    was stored alongside the page's ETag the last time the page was downloaded.
+    """
+    def __init__(self, summary):
+        self.summary = summary
+
+
 class EsiClient():
     def __init__(self,
                  authenticating_character=None,
@@ -44,7 +51,8 @@ class EsiClient():
                  raise_other_errors=True,
                  error_throttle_threshold=20,
                  bypass_cache=False,
-                 retry_interval_seconds=settings.ESI_RETRY_TIME_INTERVAL_SECONDS
+                 retry_interval_seconds=settings.ESI_RETRY_TIME_INTERVAL_SECONDS,
+                 use_etags=False
                  ):
         self._max_retries = max_retries
         self._log_application_errors = log_application_errors
@@ -54,6 +62,10 @@ class EsiClient():
         self._error_throttle_threshold = error_throttle_threshold
         self._bypass_cache = bypass_cache
         self._retry_interval_seconds = retry_interval_seconds
+        self._use_etags = use_etags
+
+        # etags of pages downloaded by this client that haven't been committed yet. see commit_etags
+        self._pending_etags = {}
 
         # contains x-headers of most recent esi request made with this client
         self._x_headers = {}
@@ -102,49 +114,12 @@ class EsiClient():
         :return: access token, err
         """
         try:
-            EsiKey_lazy = apps.get_model(app_label='eve_api', model_name='EsiKey')
-            key_exists = EsiKey_lazy.objects.filter(
-                character = self._authenticating_character,
-                use_key = True
-            ).exists()
-            if not key_exists:
-                raise Exception("We dont have an ESI key for this character")
-
-
-            key = EsiKey_lazy.objects.filter(character=self._authenticating_character, use_key=True).first()
-            refresh_token = key.refresh_token
-
-            # Check cache
-            cache_key = hashlib.sha224(refresh_token.encode('utf-8')).hexdigest()
-            access_token = cache.get(cache_key)
-            if access_token is not None:
-                logger.info("Access token request hit cache")
-                return access_token, None
-            logger.info("Access token request MISS cache")
-
-            # Get access token from EVE SSO
-            client_id = settings.EVEOAUTH['CONSUMER_KEY']
-            client_secret = settings.EVEOAUTH['CONSUMER_SECRET']
-            base_url = settings.EVEOAUTH['BASE_URL']
-            token_url = base_url + settings.EVEOAUTH['TOKEN_URL']
-
-            esi_sso = OAuth2Session(client_id, token={'refresh_token': refresh_token})
-            extra = {'client_id': client_id, 'client_secret': client_secret}
-            logger.debug("Querying EVE SSO for an access token")
-            access_token = esi_sso.refresh_token(token_url, **extra)
-            logger.debug("Access token acquired")
-
-            # Add access token to cache
-            # Expire the token 30 seconds early so there's no weird race conditions.
-            expires_in = int(access_token["expires_in"]) - 30
-            cache_key = hashlib.sha224(refresh_token.encode('utf-8')).hexdigest()
-            cache.set(cache_key, access_token, timeout=expires_in)
-            logger.debug("Access token added to redis")
-            return access_token, None
+            return esi_tokens.get_access_token(self._authenticating_character.pk), None
         except OAuth2Error as e:
             # CCP is giving us oauth errors. We need to verify if the user's token is rejected. We do that using a urllib
             # post because we don't trust the error codes being returned by our oauth2 lib
-            if not EsiClient.is_refresh_token_valid(refresh_token):
+            refresh_token = esi_tokens.get_refresh_token(self._authenticating_character.pk)
+            if refresh_token is not None and not EsiClient.is_refresh_token_valid(refresh_token):
                 logger.warning("ESI Refresh Token was rejected. User probably deleted TEST Auth app. exception: InvalidTokenError charid %s charname %s" % (
                     self._authenticating_character.pk, self._authenticating_character.name))
                 if waffle.switch_is_active("delete_keys_when_revoked"):
@@ -158,32 +133,19 @@ class EsiClient():
         # allow all other exceptions to propagate up stack to trigger retry logic
 
     def _update_error_throttle_counter(self, response, endpoint):
-        logger = logging.getLogger(__name__)
+        # the governor does the actual throttling, every response has already been reported to it
         if response is None:
             return
         self._x_headers = response.headers
         if "X-Esi-Error-Limit-Remain" in response.headers:
             error_allowance_remaining = int(response.headers["X-Esi-Error-Limit-Remain"])
             if error_allowance_remaining < self._error_throttle_threshold:
-                wait_time = int(response.headers["X-Esi-Error-Limit-Reset"])
-                logger.warning(
-                    "ESI error allowance down to %s after executing %s. Blocking ESI Request for %s seconds." % (
-                    error_allowance_remaining, endpoint, wait_time))
-                cache.set("BLOCK_ESI_REQUESTS", wait_time, timeout=wait_time + 1)
-            else:
-                if error_allowance_remaining != 100:
-                    logger.info("Esi error allowance is %s" % error_allowance_remaining)
-
-    def _block_if_throttle_active(self):
-        block_time = cache.get("BLOCK_ESI_REQUESTS")
-        if block_time is not None:
-            logger = logging.getLogger(__name__)
-            logger.warning("blocking ESI call for %s seconds" % block_time)
-            time.sleep(block_time)
-        return
+                logger.warning("ESI error allowance down to %s after executing %s." % (error_allowance_remaining, endpoint))
+            elif error_allowance_remaining != 100:
+                logger.info("Esi error allowance is %s" % error_allowance_remaining)
 
     def _prepare_request(self, endpoint_url):
-        self._block_if_throttle_active()
+        esi_governor.wait_for_capacity()
         esi_url = settings.EVE_ESI_URL
         full_url = esi_url + endpoint_url
 
@@ -212,6 +174,8 @@ class EsiClient():
             json_data = json.dumps(post_body)
             headers = {"Content-Type":"application/json"}
             response = session.post(url, data=json_data, headers=headers)
+        esi_governor.record_response(url, response.status_code, response.elapsed.total_seconds(), response.headers,
+                                     self._error_throttle_threshold)
 
         # update the x-error-limit, no matter what happened with this specific request
         self._update_error_throttle_counter(response, url)
@@ -310,9 +274,81 @@ class EsiClient():
 
         cache_key = self._get_cache_key(endpoint_url, post_body)
 
-        cache.set(cache_key, content, timeout=settings.ESI_CACHE_DURATION_SECONDS)
+        # cache for exactly as long as ccp does, if they told us
+        timeout = settings.ESI_CACHE_DURATION_SECONDS
+        if expires_at is not None:
+            timeout = int((expires_at - datetime.datetime.now(pytz.utc)).total_seconds())
+            if timeout <= 0:
+                return
+
+        cache.set(cache_key, content, timeout=timeout)
         return
 
+    def _get_etag_key(self, url, etag_scope=None):
+        # etags are stored per full url (so per page) and authenticating character. callers that post-process pages
+        # before summarizing them can pass a scope so differently processed summaries never get mixed up.
+        algo = hashlib.new('SHA256')
+        authchar = self._authenticating_character.pk if self._authenticating_character is not None else None
+        a_char = authchar if authchar else ""
+        scope = etag_scope if etag_scope else ""
+        algo.update((str(url) + str(a_char) + str(scope)).encode('utf-8'))
+        return "esi_etag_%s" % algo.hexdigest()
+
+    def _load_etags(self, urls, etag_scope=None):
+        """
+        :return: (dict of url -> etag cache key, dict of etag cache key -> stored (etag, summary))
+        """
+        if not self._use_etags:
+            return {}, {}
+        keys = {u: self._get_etag_key(u, etag_scope) for u in urls}
+        return keys, cache.get_many(list(keys.values()))
+
+    def _get_transport_headers(self):
+        # the transport paces every request itself, this is where a throttled task gets put back on the queue
+        esi_governor.wait_for_capacity()
+        if self._authenticating_character is None:
+            return {}
+        access_token, err = self._get_access_token_from_refresh()
+        if err is not None:
+            raise Exception("Esi client could not get an access token for character {} err {}".format(
+                self._authenticating_character.pk, err))
+        return {"Authorization": "Bearer {}".format(access_token["access_token"])}
+
+    def _build_requests(self, endpoint_url, params, etag_scope=None):
+        """
+        :return: (list of EsiRequest tagged with (param, etag cache key), dict of etag cache key -> stored (etag, summary))
+        """
+        url = settings.EVE_ESI_URL + endpoint_url
+        headers = self._get_transport_headers()
+        etag_keys, stored_etags = self._load_etags([url.format(p) for p in params], etag_scope)
+
+        requests = []
+        for p in params:
+            etag_key = etag_keys.get(url.format(p))
+            request_headers = dict(headers)
+            if etag_key in stored_etags:
+                request_headers["If-None-Match"] = stored_etags[etag_key][0]
+            requests.append(EsiRequest(url.format(p), request_headers, tag=(p, etag_key)))
+        return requests, stored_etags
+
+    def _record_etag(self, response, summary):
+        _, etag_key = response.request.tag
+        etag = response.headers.get("etag")
+        if etag_key is not None and etag is not None:
+            self._pending_etags[etag_key] = (etag, summary)
+
+    def commit_etags(self):
+        """
+        Persists the ETags of every page downloaded since the last commit. Call this only once the downloaded data has
+        been fully processed, so a page can never be reported unchanged before its contents made it into the db.
+        """
+        if self._pending_etags:
+            cache.set_many(self._pending_etags, timeout=settings.ESI_ETAG_DURATION_SECONDS)
+        self._pending_etags = {}
+
+    def discard_etags(self):
+        self._pending_etags = {}
+
     def post(self, endpoint_url, post_body):
         if not self._bypass_cache and not settings.GLOBALLY_DISABLE_ESI_CACHE:
             data = self._try_read_from_cache(endpoint_url, post_body)
@@ -361,6 +397,17 @@ class EsiClient():
             logger.warning("Connection error when querying ESI")
             return None, EsiError.ConnectionError
 
+    def get_last_expiry(self):
+        """
+        Returns the expiry of the most recent ESI response this client received as a UTC datetime, or None.
+        """
+        expires = self._x_headers.get("expires") if self._x_headers else None
+        if expires is None:
+            return None
+        expires = eut.parsedate(expires)
+        tz = pytz.timezone('UTC')
+        return datetime.datetime(*expires[:6]).replace(tzinfo=tz)
+
     def get_page_count(self, endpoint_url):
         cache_setting = self._bypass_cache
         self._bypass_cache = True
@@ -372,141 +419,142 @@ class EsiClient():
             pages = self._x_headers.get("x-pages")
         return int(pages) if pages is not None else None
 
-    def _chunks(self, l, n):
-        """Yield successive n-sized chunks from l."""
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-
     def get_multiple(self, endpoint_url, params):
-        # no error handling as of right now, mayyyy want to change that
-        url, err, session = self._prepare_request(endpoint_url)
-
-        retry = Retry(
-            total=3,
-            read=3,
-            connect=3,
-            backoff_factor=0.3,
-            status_forcelist=(500, 502, 504),
-        )
-
-        # mount a custom ssl adapter that will have a large enough connection pool
-        max_pool_size = 128
-        pool_size = min(max_pool_size, len(params))
-        logger.info("building http adapter with pool size {}".format(pool_size))
-        session.mount('https://',
-                      HTTPAdapter(
-                          pool_connections = pool_size,
-                          pool_maxsize= pool_size,
-                          max_retries=retry
-                      )
-                    )
-        logger.info("adapter mounted")
-
-        requests = [(grequests.get(url.format(p), session=session),p) for p in params]
-
-        results = {}
-
-        for chunk in self._chunks(requests, max_pool_size):
-            logger.debug("mapping chunk")
-            request_urls = [r for r,_ in chunk]
-            request_params = [p for _,p in chunk]
-
-            responses = grequests.map(request_urls)
-            responses_with_params = zip(request_params, responses)
-            logger.debug("map completed")
-
-            for param,response in responses_with_params:
-                # update the x-error-limit, no matter what happened with this specific request
-                # self._update_error_throttle_counter(response, url)
-
-                # no error handling until we can figure out implications
-                try:
-                    data = response.json()
-                except JSONDecodeError as e:
-                    logger.error(str(e) + " " + str(response.content))
-                    raise e
-                if type(data) is dict:
-                    if "error" in data:
-                        if self._raise_application_errors:
-                            raise Exception("bad result from esi: {} with param {} on url {}".format(data, param, endpoint_url))
-                self._depreciation_check(response, endpoint_url)
-
-                results[param] = data
-
-        return results
-
-    def get_multiple_paginated(self, endpoint_url):
-        page_count = self.get_page_count(endpoint_url)
-        #page_count = 0 if page_count is None else page_count
-        expires = self._x_headers.get("expires")
+        """
+        Requests endpoint_url once per param.
+        :return: dict of param -> response data. if this client uses etags, params whose response hasn't changed since
+        the last committed download are left out.
+        """
+        return dict(self.iter_multiple(endpoint_url, params))
 
-        params = [i+1 for i in range(page_count)]
+    def iter_multiple(self, endpoint_url, params):
+        """
+        Streaming version of get_multiple. Yields (param, response data) as each request completes.
+        """
+        requests, _ = self._build_requests(endpoint_url, params)
 
-        results = self.get_multiple_flat(endpoint_url + "?page={}", params, expiry=expires, return_if_cache_inconsistent=True)
-        if results is None:
-            # cache failure, we need to restart
-            return self.get_multiple_paginated(endpoint_url)
-        else:
-            return results
+        for response in get_transport().iter_requests(requests):
+            param, _ = response.request.tag
+            if response.error is not None:
+                raise Exception("request for param {} on url {} failed: {}".format(param, endpoint_url, response.error))
 
-    def get_multiple_flat(self, endpoint_url, params, expiry=None, return_if_cache_inconsistent=False):
-        # no error handling as of right now, mayyyy want to change that
-        url, err, session = self._prepare_request(endpoint_url)
-
-        retry = Retry(
-            total=3,
-            read=3,
-            connect=3,
-            backoff_factor=0.3,
-            status_forcelist=(500, 502, 504),
-        )
-
-        # mount a custom ssl adapter that will have a large enough connection pool
-        max_pool_size = 128
-        pool_size = min(max_pool_size, len(params))
-        logger.info("building http adapter with pool size {}".format(pool_size))
-        session.mount('https://',
-                      HTTPAdapter(
-                          pool_connections = pool_size,
-                          pool_maxsize= pool_size,
-                          max_retries=retry
-                      )
-                    )
-        logger.info("adapter mounted")
-
-        requests = [(grequests.get(url.format(p), session=session),p) for p in params]
-
-        results = []
-
-        c_id = 0
-        for chunk in self._chunks(requests, max_pool_size):
-            logger.info("mapping chunk")
-            request_urls = [r for r,_ in chunk]
-
-            responses = grequests.map(request_urls)
-            logger.info("map completed")
-            r_id = 0
-            for response in responses:
-                if expiry is None:
-                    expiry = response.headers["expires"]
-                else:
-                    if expiry != response.headers["expires"]:
-                        # a cache switchover happened somewhere in here. WE NEED TO REDO EVERYTHING.
-                        logger.warning("Cache switchover while querying {}. Restarting query.".format(endpoint_url))
-                        if return_if_cache_inconsistent:
-                            return None
-                        else:
-                            return self.get_multiple_flat(endpoint_url, params)
+            # update the x-error-limit, no matter what happened with this specific request
+            self._update_error_throttle_counter(response, endpoint_url)
+
+            if response.status_code == 304:
+                # unchanged. keep the etag alive for another round
+                self._record_etag(response, None)
+                continue
 
+            try:
                 data = response.json()
+            except JSONDecodeError as e:
+                logger.error(str(e) + " " + str(response.content))
+                raise e
+            if type(data) is dict and "error" in data:
+                if self._raise_application_errors:
+                    raise Exception("bad result from esi: {} with param {} on url {}".format(data, param, endpoint_url))
+            else:
+                # never remember etags of errors
+                self._record_etag(response, None)
+            self._depreciation_check(response, endpoint_url)
+
+            yield param, data
+
+    def iter_multiple_paginated(self, endpoint_url, stages=None, summarize=None, etag_scope=None):
+        """
+        Streaming version of get_multiple_paginated. Yields each page as soon as it's downloaded, after running it
+        through every callable in stages (page -> page). Pages are yielded in the order they complete, not page order.
+        Raises EsiCacheSwitchover if ESI's cache rolls over mid query, in which case every page already yielded is from
+        the old cache and the caller should start over.
+
+        If this client uses etags, pages that haven't changed since the last committed download are yielded as
+        EsiNotModified. summarize (staged page -> anything) is stored alongside each page's etag so callers can still
+        tell what was on an unchanged page. Pass an etag_scope if the stages or summary depend on anything but the url.
+        """
+        page_count = self.get_page_count(endpoint_url)
+        expires = self._x_headers.get("expires")
 
-                r_id += 1
-                results.extend(data)
-            c_id += 1
-            # run a single depreciation check
-            if responses:
-                self._depreciation_check(responses[0], endpoint_url)
+        params = [i+1 for i in range(page_count)]
+        return self.iter_multiple_flat(endpoint_url + "?page={}", params, expiry=expires, stages=stages,
+                                       summarize=summarize, etag_scope=etag_scope)
 
-        return results
+    def iter_multiple_flat(self, endpoint_url, params, expiry=None, stages=None, summarize=None, etag_scope=None):
+        """
+        Yields the (staged) result of every request as it completes. See iter_multiple_paginated.
+        """
+        requests, stored_etags = self._build_requests(endpoint_url, params, etag_scope)
 
+        failures = []
+        depreciation_checked = False
+        responses = get_transport().iter_requests(requests)
+        try:
+            for response in responses:
+                if response.error is not None:
+                    failures.append((response.url, response.error))
+                    continue
 
+                self._update_error_throttle_counter(response, endpoint_url)
+                if expiry is None:
+                    expiry = response.headers["expires"]
+                elif expiry != response.headers["expires"]:
+                    # a cache switchover happened somewhere in here. WE NEED TO REDO EVERYTHING.
+                    logger.warning("Cache switchover while querying {}.".format(endpoint_url))
+                    raise EsiCacheSwitchover()
+
+                if response.status_code == 304:
+                    _, etag_key = response.request.tag
+                    stored = stored_etags[etag_key]
+                    self._pending_etags[etag_key] = stored
+                    yield EsiNotModified(stored[1])
+                    continue
+
+                # run a single depreciation check
+                if not depreciation_checked:
+                    self._depreciation_check(response, endpoint_url)
+                    depreciation_checked = True
+
+                page = response.json()
+                for stage in stages or []:
+                    page = stage(page)
+                self._record_etag(response, summarize(page) if summarize else None)
+                yield page
+        finally:
+            # stop anything still in flight if we bailed out early
+            responses.close()
+
+        if failures:
+            raise Exception("{} requests failed when querying {}. first failure: {} {}".format(
+                len(failures), endpoint_url, failures[0][0], failures[0][1]))
+
+    def get_multiple_paginated(self, endpoint_url, stages=None):
+        """
+        Downloads every page of endpoint_url and returns the concatenated results. If stages are provided each page is
+        run through them as it arrives, so only the staged output is ever held in memory.
+        If this client uses etags, unchanged pages are left out of the results.
+        """
+        while True:
+            try:
+                results = []
+                for page in self.iter_multiple_paginated(endpoint_url, stages=stages):
+                    if not isinstance(page, EsiNotModified):
+                        results.extend(page)
+                return results
+            except EsiCacheSwitchover:
+                # cache failure, we need to restart
+                logger.warning("Restarting paginated query {}".format(endpoint_url))
+                self.discard_etags()
+
+    def get_multiple_flat(self, endpoint_url, params, expiry=None, return_if_cache_inconsistent=False, stages=None):
+        try:
+            results = []
+            for page in self.iter_multiple_flat(endpoint_url, params, expiry=expiry, stages=stages):
+                if not isinstance(page, EsiNotModified):
+                    results.extend(page)
+            return results
+        except EsiCacheSwitchover:
+            self.discard_etags()
+            if return_if_cache_inconsistent:
+                return None
+            else:
+                return self.get_multiple_flat(endpoint_url, params, stages=stages)
@@ -31,4 +31,21 @@ class EsiDuplicateXMLCharacterExists(Exception):
         Exception.__init__(self,*args,**kwargs)
 
     def __str__(self):
-        return "User tried to add an ESI character that the XML api believes belongs to another auth account"
\ No newline at end of file
+        return "User tried to add an ESI character that the XML api believes belongs to another auth account"
+
+class EsiThrottled(Exception):
+    """Raised when the ESI governor wants a task to back off for longer than it's worth sleeping."""
+    def __init__(self, delay, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+        self.delay = delay
+
+    def __str__(self):
+        return "ESI requests are throttled for another {:.1f} seconds".format(self.delay)
+
+class EsiCacheSwitchover(Exception):
+    """Raised when ESI's cache rolls over in the middle of a multi-page query."""
+    def __init__(self,*args,**kwargs):
+        Exception.__init__(self,*args,**kwargs)
+
+    def __str__(self):
+        return "ESI cache switched over mid query"
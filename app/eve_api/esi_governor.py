@@ -0,0 +1,226 @@
+import functools
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from eve_api.esi_exceptions import EsiThrottled
+
+logger=logging.getLogger(__name__)
+
+# Rate limiting shared by every process that talks to ESI (huey workers and the web process alike). all state lives in
+# redis:
+#   - a token bucket caps the global request rate
+#   - ESI errors are counted per minute against our own budget, and ESI's error allowance header is watched. when
+#     either runs low nothing is sent until the error window resets.
+#   - request counts, errors and latency are recorded per endpoint, per hour
+
+ENDPOINT_STATS_TIMEOUT = 2 * 86400
+
+# KEYS: bucket, blocked until. ARGV: now, rate, burst, tokens wanted
+# returns the seconds to wait before trying again, 0 if the tokens were taken
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local blocked_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local wanted = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= wanted then
+    tokens = tokens - wanted
+else
+    wait = (wanted - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+# KEYS: blocked until. ARGV: until, seconds from now. only ever pushes the block further out
+_BLOCK_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+_scripts = {}
+_local = threading.local()
+
+
+def _get_script(source):
+    if source not in _scripts:
+        _scripts[source] = get_redis_connection("default").register_script(source)
+    return _scripts[source]
+
+
+# every key is used on the raw redis connection, so they go through make_key for the cache's key prefix
+
+def _bucket_key():
+    return cache.make_key("esi_rate_limiter_bucket")
+
+
+def _blocked_until_key():
+    return cache.make_key("esi_requests_blocked_until")
+
+
+def _error_budget_key(window):
+    return cache.make_key("esi_error_budget_{}".format(window))
+
+
+def _endpoint_stats_key(hour):
+    return cache.make_key("esi_endpoint_stats_{}".format(hour))
+
+
+def get_endpoint_name(url):
+    # ids in the path (characters, regions, structures) would give every target its own endpoint
+    path = url.split("?", 1)[0]
+    if path.startswith(settings.EVE_ESI_URL):
+        path = path[len(settings.EVE_ESI_URL):]
+    return re.sub(r"/\d+", "/{}", path)
+
+
+def acquire(tokens=1):
+    """
+    Takes tokens off the shared bucket.
+    :return: seconds to wait before trying again, 0 if the request can go out now
+    """
+    try:
+        wait = _get_script(_ACQUIRE_SCRIPT)(
+            keys=[_bucket_key(), _blocked_until_key()],
+            args=[time.time(), settings.ESI_REQUESTS_PER_SECOND, settings.ESI_REQUEST_BURST, tokens]
+        )
+        return float(wait)
+    except Exception as e:
+        # a redis hiccup shouldn't stop ESI traffic, ESI's own error limit still applies
+        logger.error("ESI rate limiter unavailable, letting request through: {}".format(e))
+        return 0
+
+
+def block_requests(seconds, reason):
+    """
+    Holds every ESI request in every process for the next seconds.
+    """
+    until = time.time() + seconds
+    try:
+        extended = _get_script(_BLOCK_SCRIPT)(keys=[_blocked_until_key()], args=[until, max(int(seconds) + 1, 1)])
+    except Exception as e:
+        logger.error("failed to block ESI requests for {} seconds: {}".format(seconds, e))
+        return
+    if extended:
+        logger.warning("Blocking all ESI requests for {} seconds: {}".format(int(seconds), reason))
+
+
+def record_response(url, status_code, elapsed_seconds, headers, error_limit_threshold=None):
+    """
+    Call for every response we get from ESI, retries included.
+    :param status_code: None if the request never got a response
+    """
+    if error_limit_threshold is None:
+        error_limit_threshold = settings.ESI_ERROR_LIMIT_THRESHOLD
+    now = time.time()
+    window = int(now // 60)
+    endpoint = get_endpoint_name(url)
+    # ESI counts every 4xx/5xx against the error limit, connection failures never reach it
+    counts_against_budget = status_code is not None and status_code >= 400
+
+    try:
+        pipe = get_redis_connection("default").pipeline()
+        stats_key = _endpoint_stats_key(int(now // 3600))
+        pipe.hincrby(stats_key, "{}:requests".format(endpoint), 1)
+        pipe.hincrbyfloat(stats_key, "{}:seconds".format(endpoint), elapsed_seconds or 0)
+        if status_code is None or counts_against_budget:
+            pipe.hincrby(stats_key, "{}:errors".format(endpoint), 1)
+        pipe.expire(stats_key, ENDPOINT_STATS_TIMEOUT)
+        if counts_against_budget:
+            pipe.incr(_error_budget_key(window))
+            pipe.expire(_error_budget_key(window), 120)
+        results = pipe.execute()
+    except Exception as e:
+        logger.error("failed to record ESI response for {}: {}".format(endpoint, e))
+        return
+
+    if counts_against_budget and results[-2] >= settings.ESI_ERROR_BUDGET_PER_MINUTE:
+        block_requests((window + 1) * 60 - now, "{} errors this minute, last from {} ({})".format(
+            results[-2], endpoint, status_code))
+
+    remain = headers.get("X-Esi-Error-Limit-Remain") if headers is not None else None
+    if remain is not None and int(remain) < error_limit_threshold:
+        reset = int(headers.get("X-Esi-Error-Limit-Reset", 60))
+        block_requests(reset, "ESI error allowance down to {} after {}".format(remain, endpoint))
+
+
+def get_endpoint_stats(hours=1):
+    """
+    :return: dict of endpoint -> {"requests", "errors", "average_seconds"} over the last hours
+    """
+    conn = get_redis_connection("default")
+    current_hour = int(time.time() // 3600)
+    totals = {}
+    for hour in range(current_hour - hours + 1, current_hour + 1):
+        for field, value in conn.hgetall(_endpoint_stats_key(hour)).items():
+            endpoint, stat = field.decode("utf-8").rsplit(":", 1)
+            endpoint_totals = totals.setdefault(endpoint, {"requests": 0, "errors": 0, "seconds": 0.0})
+            endpoint_totals[stat] += float(value) if stat == "seconds" else int(value)
+
+    for endpoint_totals in totals.values():
+        seconds = endpoint_totals.pop("seconds")
+        endpoint_totals["average_seconds"] = seconds / endpoint_totals["requests"] if endpoint_totals["requests"] else None
+    return totals
+
+
+def is_deferring():
+    return getattr(_local, "deferring", False)
+
+
+def wait_for_capacity():
+    """
+    Blocks until the governor lets a request out. Inside an esi_task, a wait longer than
+    ESI_THROTTLE_MAX_SLEEP_SECONDS raises EsiThrottled instead, so the task can go back on the queue.
+    """
+    while True:
+        wait = acquire()
+        if wait <= 0:
+            return
+        if is_deferring() and wait > settings.ESI_THROTTLE_MAX_SLEEP_SECONDS:
+            raise EsiThrottled(wait)
+        time.sleep(min(wait, settings.ESI_THROTTLE_MAX_SLEEP_SECONDS) if is_deferring() else wait)
+
+
+def esi_task(queue, **task_kwargs):
+    """
+    Use in place of queue.task() on tasks that talk to ESI. When ESI requests are throttled for a while, the task is
+    scheduled to run again once the wait is over instead of keeping a worker asleep.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            # tasks called directly from other tasks leave the caller's setting alone
+            was_deferring = is_deferring()
+            _local.deferring = True
+            try:
+                return fn(*args, **kwargs)
+            except EsiThrottled as e:
+                logger.info("{} deferred for {:.1f} seconds, ESI requests are throttled".format(fn.__name__, e.delay))
+                task.schedule(args=args, kwargs=kwargs, delay=e.delay)
+            finally:
+                _local.deferring = was_deferring
+
+        task = queue.task(**task_kwargs)(inner)
+        return task
+    return decorator
@@ -0,0 +1,111 @@
+import logging
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from requests_oauthlib import OAuth2Session
+
+logger=logging.getLogger(__name__)
+
+# access tokens are thrown away this long before CCP expires them, so no request goes out with a token about to die
+ACCESS_TOKEN_EARLY_EXPIRY_SECONDS = 30
+TOKEN_REFRESH_LOCK_SECONDS = 30
+# how long a caller waits on another caller's refresh of the same character before refreshing itself
+TOKEN_REFRESH_WAIT_SECONDS = 10
+
+
+def _access_token_key(character_id):
+    return "esi_access_token_{}".format(character_id)
+
+
+def _refresh_lock_key(character_id):
+    return "esi_access_token_refreshing_{}".format(character_id)
+
+
+def get_refresh_token(character_id):
+    """
+    :return: refresh token of the character's active ESI key, or None
+    """
+    EsiKey_lazy = apps.get_model(app_label='eve_api', model_name='EsiKey')
+    return EsiKey_lazy.objects.filter(
+        character_id=character_id,
+        use_key=True
+    ).values_list('refresh_token', flat=True).first()
+
+
+def _refresh_access_token(character_id):
+    refresh_token = get_refresh_token(character_id)
+    if refresh_token is None:
+        raise Exception("We dont have an ESI key for this character")
+
+    client_id = settings.EVEOAUTH['CONSUMER_KEY']
+    client_secret = settings.EVEOAUTH['CONSUMER_SECRET']
+    token_url = settings.EVEOAUTH['BASE_URL'] + settings.EVEOAUTH['TOKEN_URL']
+
+    esi_sso = OAuth2Session(client_id, token={'refresh_token': refresh_token})
+    logger.debug("Querying EVE SSO for an access token for character {}".format(character_id))
+    access_token = esi_sso.refresh_token(token_url, client_id=client_id, client_secret=client_secret)
+
+    expires_in = int(access_token["expires_in"]) - ACCESS_TOKEN_EARLY_EXPIRY_SECONDS
+    access_token["expires_at"] = time.time() + expires_in
+    cache.set(_access_token_key(character_id), access_token, timeout=expires_in)
+    return access_token
+
+
+def get_access_token(character_id):
+    """
+    Returns a live access token for the character. Only one caller refreshes a character's token at a time, everyone
+    else waits for its result.
+    Raises OAuth2Error if SSO rejects the refresh.
+    """
+    key = _access_token_key(character_id)
+    access_token = cache.get(key)
+    if access_token is not None:
+        return access_token
+    logger.info("Access token request MISS cache for character {}".format(character_id))
+
+    lock_key = _refresh_lock_key(character_id)
+    deadline = time.monotonic() + TOKEN_REFRESH_WAIT_SECONDS
+    while True:
+        if cache.add(lock_key, True, timeout=TOKEN_REFRESH_LOCK_SECONDS):
+            try:
+                # the refresh we were waiting on may have landed between our get and add
+                access_token = cache.get(key)
+                if access_token is None:
+                    access_token = _refresh_access_token(character_id)
+                return access_token
+            finally:
+                cache.delete(lock_key)
+
+        time.sleep(0.1)
+        access_token = cache.get(key)
+        if access_token is not None:
+            return access_token
+        if time.monotonic() > deadline:
+            logger.warning("gave up waiting on the access token refresh for character {}".format(character_id))
+            return _refresh_access_token(character_id)
+
+
+def prewarm_access_token(character_id, within_seconds):
+    """
+    Refreshes the character's token ahead of time if it's missing or expires in the next within_seconds. Never waits,
+    if someone else is already refreshing it there's nothing to do.
+    :return: True if the token was refreshed
+    """
+    access_token = cache.get(_access_token_key(character_id))
+    if access_token is not None and access_token.get("expires_at", 0) > time.time() + within_seconds:
+        return False
+
+    lock_key = _refresh_lock_key(character_id)
+    if not cache.add(lock_key, True, timeout=TOKEN_REFRESH_LOCK_SECONDS):
+        return False
+    try:
+        _refresh_access_token(character_id)
+        return True
+    finally:
+        cache.delete(lock_key)
+
+
+def invalidate_access_token(character_id):
+    cache.delete(_access_token_key(character_id))
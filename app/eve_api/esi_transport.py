@@ -0,0 +1,187 @@
+import asyncio
+import atexit
+import functools
+import logging
+import os
+import threading
+
+import aiohttp
+import simplejson
+
+from django.conf import settings
+
+from eve_api import esi_governor
+from eve_api.esi_exceptions import EsiThrottled
+
+logger=logging.getLogger(__name__)
+
+# statuses worth retrying. everything else is handed back to the caller as is
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class EsiRequest():
+    def __init__(self, url, headers=None, tag=None):
+        self.url = url
+        self.headers = headers or {}
+        # anything the caller wants handed back alongside the response
+        self.tag = tag
+
+
+class EsiResponse():
+    """
+    Fully read response, shaped like the bits of requests.Response the esi client uses.
+    If every attempt failed to connect, error is set and status_code is None.
+    """
+    def __init__(self, request, status_code=None, headers=None, content=b"", error=None, elapsed=None):
+        self.request = request
+        self.url = request.url
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {}
+        self.content = content
+        self.error = error
+        # seconds the request took
+        self.elapsed = elapsed
+
+    def json(self):
+        return simplejson.loads(self.content)
+
+
+class EsiTransport():
+    """
+    Asyncio fan-out for ESI requests behind a synchronous interface. Every transport owns one event loop and one
+    long-lived pooled session, so keep-alive connections are reused across calls.
+
+    - at most max_concurrency requests are in flight at once
+    - every request waits for the shared ESI governor (global rate limit and error budget) before going out, and
+      every response, retries included, is reported back to it. the governor's redis calls run in the loop's executor
+      so they don't hold up the requests already in flight
+    - inside an esi_task, a governor wait longer than ESI_THROTTLE_MAX_SLEEP_SECONDS cancels the whole fan-out and
+      raises EsiThrottled, same as a single request would
+    - each request is retried on its own, with exponential backoff, on connection errors and 5xx responses
+
+    Not thread safe, use get_transport() to get the current thread's transport.
+    """
+
+    def __init__(self,
+                 max_concurrency=settings.ESI_MAX_CONCURRENT_REQUESTS,
+                 max_retries=settings.MAX_ESI_RETRIES,
+                 error_limit_threshold=settings.ESI_ERROR_LIMIT_THRESHOLD,
+                 timeout_seconds=settings.ESI_REQUEST_TIMEOUT_SECONDS,
+                 backoff_seconds=0.3):
+        self._max_concurrency = max_concurrency
+        self._max_retries = max_retries
+        self._error_limit_threshold = error_limit_threshold
+        self._timeout_seconds = timeout_seconds
+        self._backoff_seconds = backoff_seconds
+
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._session = None
+
+    async def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self._max_concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self._timeout_seconds)
+        )
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = self._loop.run_until_complete(self._create_session())
+        return self._session
+
+    def close(self):
+        if self._session is not None and not self._session.closed:
+            self._loop.run_until_complete(self._session.close())
+        self._loop.close()
+
+    async def _wait_for_capacity(self, deferring):
+        # same rules as esi_governor.wait_for_capacity. is_deferring() is per thread, so the caller's setting is passed
+        # in rather than read from an executor thread.
+        while True:
+            wait = await self._loop.run_in_executor(None, esi_governor.acquire)
+            if wait <= 0:
+                return
+            if deferring and wait > settings.ESI_THROTTLE_MAX_SLEEP_SECONDS:
+                raise EsiThrottled(wait)
+            await asyncio.sleep(min(wait, settings.ESI_THROTTLE_MAX_SLEEP_SECONDS) if deferring else wait)
+
+    async def _fetch(self, session, semaphore, request, deferring):
+        attempt = 0
+        while True:
+            result = None
+            async with semaphore:
+                await self._wait_for_capacity(deferring)
+                started = self._loop.time()
+                try:
+                    async with session.get(request.url, headers=request.headers) as response:
+                        content = await response.read()
+                        result = EsiResponse(request, response.status, response.headers, content,
+                                             elapsed=self._loop.time() - started)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    result = EsiResponse(request, error=e, elapsed=self._loop.time() - started)
+
+            # outside the semaphore, the next request can go out while this one is recorded
+            await self._loop.run_in_executor(None, functools.partial(
+                esi_governor.record_response,
+                request.url, result.status_code, result.elapsed, result.headers, self._error_limit_threshold
+            ))
+
+            if result.error is None and result.status_code not in RETRY_STATUSES:
+                return result
+
+            attempt += 1
+            if attempt > self._max_retries:
+                return result
+            logger.info("Retrying {} after {}. Attempt {}".format(request.url, result.error or result.status_code, attempt))
+            # back off outside the semaphore, so the other requests keep going
+            await asyncio.sleep(self._backoff_seconds * (2 ** (attempt - 1)))
+
+    async def _start(self, session, requests, deferring):
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        return [asyncio.ensure_future(self._fetch(session, semaphore, r, deferring)) for r in requests]
+
+    def iter_requests(self, requests):
+        """
+        Performs every request, yielding each EsiResponse as soon as it completes. Responses are yielded in the order
+        they complete. Anything still in flight is cancelled if the caller stops iterating early, or if ESI requests are
+        throttled for too long and EsiThrottled is raised.
+        """
+        if not requests:
+            return
+        session = self._get_session()
+        tasks = self._loop.run_until_complete(self._start(session, requests, esi_governor.is_deferring()))
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield self._loop.run_until_complete(next_done)
+        finally:
+            pending = [t for t in tasks if not t.done()]
+            for t in pending:
+                t.cancel()
+            if pending:
+                self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    def request_all(self, requests):
+        """
+        :return: list of EsiResponse, in the same order as requests
+        """
+        responses = {}
+        for response in self.iter_requests(requests):
+            responses[id(response.request)] = response
+        return [responses[id(r)] for r in requests]
+
+
+_local = threading.local()
+
+
+def get_transport():
+    """
+    Returns this thread's transport. A fresh one is built after a fork, event loops and sockets don't survive one.
+    """
+    transport = getattr(_local, "transport", None)
+    if transport is None or getattr(_local, "pid", None) != os.getpid():
+        transport = EsiTransport()
+        _local.transport = transport
+        _local.pid = os.getpid()
+        atexit.register(transport.close)
+    return transport
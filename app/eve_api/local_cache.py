@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger=logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "local_cache_invalidate"
+
+# every LocalCache in this process, by name
+_caches = {}
+_listener_lock = threading.Lock()
+_listener_pid = None
+
+
+class LocalCache():
+    """
+    Bounded, process-local LRU cache with a per-entry TTL. Sits in front of redis for objects that practically never
+    change, so hot loops don't pay a round trip and an unpickle per lookup.
+
+    Entries are dropped everywhere through redis pub/sub when invalidate() is called (from post_save receivers), the
+    TTL only bounds how stale an entry can get if an invalidation is missed.
+
+    get() hands out the stored object itself, shared by every thread in the process. Never modify it, load a fresh
+    row from the db to change and save.
+    """
+
+    def __init__(self, name, max_size, ttl_seconds=settings.LOCAL_CACHE_TTL_SECONDS):
+        self.name = name
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def get(self, key):
+        _ensure_listener()
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if value is None:
+            return
+        key = str(key)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(str(key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate(self, key):
+        """
+        Drops key from this cache in every process.
+        """
+        self.delete(key)
+        try:
+            get_redis_connection("default").publish(_get_channel(), "{}:{}".format(self.name, key))
+        except Exception as e:
+            logger.error("failed to publish local cache invalidation for {} {}: {}".format(self.name, key, e))
+
+
+def _get_channel():
+    # pub/sub channels share redis with every other deployment using it, prefix ours like the cache's keys
+    return cache.make_key(INVALIDATION_CHANNEL)
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_redis_connection("default").pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(_get_channel())
+            for message in pubsub.listen():
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode("utf-8")
+                name, key = data.split(":", 1)
+                if name in _caches:
+                    _caches[name].delete(key)
+        except Exception as e:
+            logger.warning("local cache invalidation listener lost its connection: {}".format(e))
+
+        # we may have missed invalidations while we weren't listening
+        for c in _caches.values():
+            c.clear()
+        time.sleep(5)
+
+
+def _ensure_listener():
+    # started lazily, and once per process. threads don't survive a fork.
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        listener = threading.Thread(target=_listen, name="local-cache-invalidation", daemon=True)
+        listener.start()
+        _listener_pid = os.getpid()
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2019-02-04 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eve_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eveplayercharacter',
+            name='transactions_cursor',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.2 on 2019-02-07 19:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eve_api', '0002_eveplayercharacter_transactions_cursor'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='esikey',
+            index_together={('character', 'use_key')},
+        ),
+    ]
@@ -45,6 +45,11 @@ class CcpIdTypeResolver(models.Model):
             return "alliance"
         return None
 
+    @staticmethod
+    def is_legacy_id(ccp_id):
+        # pre-2011 ids share one range, their type can only be found by asking ESI
+        return 100000000 <= ccp_id <= 2147483647
+
     @staticmethod
     def get_id_type(ccp_id):
         if ccp_id == 2:
@@ -69,7 +74,7 @@ class CcpIdTypeResolver(models.Model):
         if 31000001 <= ccp_id <= 32000000:
             return "system"
 
-        if 100000000 <= ccp_id <=  2147483647:
+        if CcpIdTypeResolver.is_legacy_id(ccp_id):
             # legacy organization (pre-2011)
 
             # check cache
@@ -32,6 +32,9 @@ class EVEPlayerCharacter(models.Model):
     transactions_last_updated = models.DateTimeField(default=None, null=True)
     journal_last_updated = models.DateTimeField(default=None, null=True)
 
+    # newest wallet transaction id we've ingested for this character
+    transactions_cursor = models.BigIntegerField(default=None, null=True)
+
     def delete_revoked_esi_key(self):
         keys = self.key.filter(use_key=True)
         logger.info("Deleting {} revoked keys for {}".format(len(keys), self.name))
@@ -11,6 +11,9 @@ from eve_api.app_defines import *
 from eve_api.esi_client import EsiClient
 from eve_api.app_defines import ESI_KEY_DELETED_BY_EVEOAUTH, ESI_KEY_REPLACED_BY_OWNER
 from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from eve_api.esi_tokens import invalidate_access_token
 from .esi_models import CharacterESIRoles
 import waffle
 import logging
@@ -110,6 +113,10 @@ class EsiKey(models.Model):
 
     use_key = models.BooleanField(default=True)
 
+    class Meta:
+        index_together = [
+            ["character", "use_key"],
+        ]
 
     @staticmethod
     def add_esi_key(char, refresh_token, user_adding_key, current_owner_hash, scopes):
@@ -161,4 +168,11 @@ class EsiKey(models.Model):
 
     @staticmethod
     def does_character_have_key(character_id):
-        return EsiKey.objects.filter(character__id=character_id, use_key=True).exists()
\ No newline at end of file
+        return EsiKey.objects.filter(character__id=character_id, use_key=True).exists()
+
+
+@receiver(post_save, sender=EsiKey)
+def esi_key_token_invalidator(sender, instance, **kwargs):
+    # a replaced or revoked key's access token must not outlive it
+    if instance.character_id is not None:
+        invalidate_access_token(instance.character_id)
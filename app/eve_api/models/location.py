@@ -1,11 +1,16 @@
 from django.db import models
 import logging
 from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 
 from eve_api.esi_client import EsiClient
+from eve_api.local_cache import LocalCache
 
 logger = logging.getLogger(__name__)
 
+local_locations = LocalCache("location", max_size=50000)
+
 
 class Location(models.Model):
     ccp_id = models.BigIntegerField(primary_key=True)
@@ -30,8 +35,8 @@ class Location(models.Model):
             # static universe objects are int32, dont hit the names endpoint if it's bigger
             if ccp_id <= 2147483647:
                 client = EsiClient(log_application_errors=False, raise_application_errors=False)
-                object_type, _ = client.post("/v2/universe/names/", post_body="[%s]" % ccp_id)
-                if object_type.get("error") == "Ensure all IDs are valid before resolving.":
+                object_type, _ = client.post("/v3/universe/names/", post_body=[ccp_id])
+                if type(object_type) is dict and object_type.get("error") == "Ensure all IDs are valid before resolving.":
                     # no problemo, the id must map to a structure.
                     pass
                 elif "error" not in object_type:
@@ -39,7 +44,7 @@ class Location(models.Model):
                         System.import_object(ccp_id=ccp_id)
                     return
                 else:
-                    raise Exception("Unhandlable application error from /v2/universe/names/: %s ccp_id: %s" % (object_type, ccp_id))
+                    raise Exception("Unhandlable application error from /v3/universe/names/: %s ccp_id: %s" % (object_type, ccp_id))
             Structure.import_object(ccp_id=ccp_id, origin_character_id=origin_character_id)
 
     @staticmethod
@@ -61,8 +66,13 @@ class Location(models.Model):
 
     @staticmethod
     def get_object(ccp_id, origin_character_id):
+        local_obj = local_locations.get(ccp_id)
+        if local_obj is not None:
+            return local_obj
+
         cached_obj = cache.get("cache_eve_location:%s" % ccp_id)
         if cached_obj is not None:
+            local_locations.set(ccp_id, cached_obj)
             return cached_obj
         else:
 
@@ -74,7 +84,14 @@ class Location(models.Model):
                 Location.verify_object_exists(ccp_id, origin_character_id)
                 item = Location.objects.get(ccp_id=ccp_id)
             cache.set("cache_eve_location:%s" % ccp_id, item, timeout=86400)
+            local_locations.set(ccp_id, item)
             return item
 
     class Meta:
-        select_on_save = True
\ No newline at end of file
+        select_on_save = True
+
+
+@receiver(post_save, sender=Location)
+def location_cache_invalidator(sender, instance, **kwargs):
+    cache.delete("cache_eve_location:{}".format(instance.pk))
+    local_locations.invalidate(instance.pk)
@@ -6,9 +6,13 @@ from django.core.cache import cache
 from django.db.models.signals import post_save
 import time, logging
 from conf.huey_queues import general_queue
+from eve_api.local_cache import LocalCache
 
 logger=logging.getLogger(__name__)
 
+local_object_types = LocalCache("object_type", max_size=50000)
+local_object_type_names = LocalCache("object_type_name", max_size=50000)
+
 
 class ObjectType(models.Model):
     ccp_id = models.BigIntegerField(primary_key=True)
@@ -50,8 +54,13 @@ class ObjectType(models.Model):
 
     @staticmethod
     def get_object(ccp_id):
+        local_obj = local_object_types.get(ccp_id)
+        if local_obj is not None:
+            return local_obj
+
         cached_obj = cache.get("cache_object_type:%s" % ccp_id)
         if cached_obj is not None:
+            local_object_types.set(ccp_id, cached_obj)
             return cached_obj
         else:
             try:
@@ -60,24 +69,31 @@ class ObjectType(models.Model):
                 ObjectType.verify_object_exists(ccp_id)
                 item = ObjectType.objects.get(ccp_id=ccp_id)
             cache.set("cache_object_type:%s" % ccp_id, item, timeout=None)
+            local_object_types.set(ccp_id, item)
         return item
 
     @staticmethod
     def get_cached_item_names_multi(ccp_ids):
         key = "cache_object_type_name_{}"
-        keys = [key.format(i) for i in ccp_ids]
+        local_names = [local_object_type_names.get(i) for i in ccp_ids]
+        keys = [key.format(i) for i, name in zip(ccp_ids, local_names) if name is None]
 
-        res = cache.get_many(keys)
+        res = cache.get_many(keys) if keys else {}
 
         ret = []
         keys_to_set = {}
-        for obj_id, obj_key in zip(ccp_ids, keys):
+        for obj_id, name in zip(ccp_ids, local_names):
+            if name is not None:
+                ret.append(name)
+                continue
+            obj_key = key.format(obj_id)
             if obj_key in res:
-                ret.append(res[obj_key])
+                name = res[obj_key]
             else:
-                o = ObjectType.get_object(obj_id)
-                ret.append(o.name)
-                keys_to_set[obj_key] = o.name
+                name = ObjectType.get_object(obj_id).name
+                keys_to_set[obj_key] = name
+            local_object_type_names.set(obj_id, name)
+            ret.append(name)
 
         if keys_to_set:
             cache.set_many(keys_to_set, timeout=None)
@@ -190,3 +206,5 @@ def objecttype_cache_invalidator(sender, instance, **kwargs):
     ccp_id = instance.pk
     keys = [x.format(ccp_id) for x in ['cache_object_volume_{}', 'cache_object_type_name_{}', 'cache_object_type:{}']]
     cache.delete_many(keys)
+    local_object_types.invalidate(ccp_id)
+    local_object_type_names.invalidate(ccp_id)
@@ -7,9 +7,12 @@ from django.core.cache import cache
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.db import transaction
+from eve_api.local_cache import LocalCache
 
 logger = logging.getLogger(__name__)
 
+local_structures = LocalCache("structure", max_size=20000)
+
 
 class Structure(models.Model):
     ccp_id = models.BigIntegerField(primary_key=True)
@@ -93,8 +96,13 @@ class Structure(models.Model):
 
     @staticmethod
     def get_object(ccp_id, origin_character_id):
+        local_obj = local_structures.get(ccp_id)
+        if local_obj is not None:
+            return local_obj
+
         cached_obj = cache.get("cached_eve_structure:%s" % ccp_id)
         if cached_obj is not None:
+            local_structures.set(ccp_id, cached_obj)
             return cached_obj
         else:
             try:
@@ -122,6 +130,7 @@ class Structure(models.Model):
                 # we only cache structures that are not blank
                 if not item.is_blank:
                     cache.set("cached_eve_structure:%s" % ccp_id, item, timeout=None)
+                    local_structures.set(ccp_id, item)
                 return item
 
             except Exception as e:
@@ -178,6 +187,7 @@ def structure_name_invalidator(sender, instance, **kwargs):
 
     cache.set('structure_name_{}', instance.name, timeout=None)
     cache.set("cached_eve_structure:{}".format(instance.pk), instance, timeout=None)
+    local_structures.invalidate(structure_id)
 
 
 from eve_api.models import EVEPlayerCharacter
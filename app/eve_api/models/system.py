@@ -3,10 +3,15 @@ import logging, requests
 from eve_api.esi_client import EsiClient
 from django.db.utils import InternalError, IntegrityError
 from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from conf.huey_queues import general_queue
+from eve_api.local_cache import LocalCache
 
 logger = logging.getLogger(__name__)
 
+local_systems = LocalCache("system", max_size=10000)
+
 
 # if anyone ever changes this to SolarSystem i'll fucking kill them
 class System(models.Model):
@@ -46,8 +51,13 @@ class System(models.Model):
 
     @staticmethod
     def get_object(ccp_id):
+        local_obj = local_systems.get(ccp_id)
+        if local_obj is not None:
+            return local_obj
+
         cached_obj = cache.get("cache_eve_system:%s" % ccp_id)
         if cached_obj is not None:
+            local_systems.set(ccp_id, cached_obj)
             return cached_obj
         else:
             try:
@@ -56,6 +66,7 @@ class System(models.Model):
                 import_universe_system(system_id=ccp_id)
                 item = System.objects.get(ccp_id=ccp_id)
             cache.set("cache_eve_system:%s" % ccp_id, item, timeout=None)
+            local_systems.set(ccp_id, item)
             return item
 
     def region(self):
@@ -137,4 +148,10 @@ def import_universe_system(system_id):
         location.save()
         from eve_api.models import CcpIdTypeResolver
         CcpIdTypeResolver.add_type(system_id, "system")
-    return
\ No newline at end of file
+    return
+
+
+@receiver(post_save, sender=System)
+def system_cache_invalidator(sender, instance, **kwargs):
+    cache.delete("cache_eve_system:{}".format(instance.pk))
+    local_systems.invalidate(instance.pk)
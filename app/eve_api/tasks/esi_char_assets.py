@@ -4,6 +4,7 @@ from django.db.models import Q
 
 from eve_api.esi_client import EsiClient, EsiError
 from eve_api.models import EVEPlayerCharacter, Structure, Location, System, ObjectType, EsiKey
+from market.utils import bulk_insert_ignore, chunks
 logger = logging.getLogger(__name__)
 
 
@@ -68,129 +69,146 @@ def update_asset_names(character, assets, container_names_only = True):
     return assets
 
 
-def resolve_location_tree(
-        root_location_id,
-        root_location,
-        base_asset,
-        asset_list,
-        location_id_hashtable,
-        parent_container=None
-    ):
-    if not Location.exists(base_asset["item_id"]):
-        location, _ = Location.objects.get_or_create(
-            ccp_id=base_asset["item_id"],
-            defaults={
-                "parent_container": parent_container,
-                "system": root_location.system,
-                "constellation": root_location.constellation,
-                "region": root_location.region,
-                "root_location_id": root_location_id
-            }
-        )
-        location.save()
-
-    # we need to check if any children of the base_asset are containers themselves.
-    for asset in asset_list:
-        # is asset a direct child of base_asset?
-        if asset["location_id"] == base_asset["item_id"]:
-            # does asset have children?
-            if asset["item_id"] in location_id_hashtable:
-                resolve_location_tree(
-                    root_location_id,
-                    root_location,
-                    asset,
-                    asset_list,
-                    location_id_hashtable,
-                    base_asset["item_id"])
-
-
-
-def sort_assets_into_structures(assets, item_id_hashtable, container_candidate_hashtable, character):
+class AssetGraph:
     """
-    Returns a list of assets that sitting DIRECTLY inside a structure. Items in containers or ships are excluded.
-    Returns an updated container_candidate_hashtable & item_id hashtable & assets list that excludes pocos,
-    which tend to cause a shit ton of problems else where.
-    :param assets:
-    :param item_id_hashtable:
-    :param container_candidate_hashtable:
-    :param character:
-    :return:
+    Index over a character's asset list. Children are indexed by location_id once, so every lookup the asset
+    resolution needs is a dict hit instead of a scan over the whole list.
     """
-    items_in_structures = []
 
-    for asset in assets:
-        if asset["location_id"] not in item_id_hashtable:
-            items_in_structures.append(asset)
-            # Handle side case when the "structure" an asset is inside is actually the character's pod
-            if asset["location_id"] == character.pk:
-                continue
-            else:
-                if asset["location_id"] > 60000000 and asset["location_id"] < 64000000:
-                    # station
-                    Structure.verify_object_exists(asset["location_id"], character.pk)
-                elif asset["location_id"] > 30000000 and asset["location_id"] <= 32000000:
-                    # it's a system id
-                    Location.verify_object_exists(asset["location_id"], character.pk)
-                else:
-                    # it's either a structure or a poco
-                    try:
-                        Structure.verify_object_exists(asset["location_id"], character.pk)
-                    except Exception as e:
-                        # it's a poco and there's nothing we can do about it
-                        del item_id_hashtable[asset["item_id"]]
-                        try:
-                            del container_candidate_hashtable[asset["location_id"]]
-                        except KeyError:
-                            pass
-                        items_in_structures.remove(asset)
-                        assets.remove(asset)
-                        continue
-
-    return items_in_structures, container_candidate_hashtable, item_id_hashtable, assets
-
-
-def resolve_container_locations(assets, item_id_hashtable, items_in_structures, container_candidate_hashtable, character):
+    def __init__(self, assets):
+        self.assets = assets
+        self.by_item_id = {}
+        self.children = {}
+        for asset in assets:
+            self.by_item_id[asset["item_id"]] = asset
+            self.children.setdefault(asset["location_id"], []).append(asset)
+
+    def is_in_container(self, asset):
+        return asset["location_id"] in self.by_item_id
+
+    def is_container(self, asset):
+        return asset["item_id"] in self.children
+
+    def get_root_location_ids(self):
+        """
+        :return: every location id that isn't an item in the asset list (structures, stations, systems, the pod)
+        """
+        return [location_id for location_id in self.children if location_id not in self.by_item_id]
+
+    def get_root_assets(self, root_location_id):
+        return self.children.get(root_location_id, [])
+
+    def iter_containers(self, root_asset):
+        """
+        Yields (container, parent container item_id) for root_asset and every container beneath it.
+        Iterative, so deep nesting can't blow the stack.
+        """
+        stack = [(root_asset, None)]
+        while stack:
+            asset, parent_container = stack.pop()
+            yield asset, parent_container
+            for child in self.children.get(asset["item_id"], []):
+                if self.is_container(child):
+                    stack.append((child, asset["item_id"]))
+
+    def iter_subtree(self, root_asset):
+        stack = [root_asset]
+        while stack:
+            asset = stack.pop()
+            yield asset
+            stack.extend(self.children.get(asset["item_id"], []))
+
+    def drop_root_location(self, root_location_id):
+        """
+        Removes everything at root_location_id, including the contents of any containers there.
+        """
+        dropped = set()
+        for root_asset in self.children.pop(root_location_id, []):
+            for asset in self.iter_subtree(root_asset):
+                dropped.add(asset["item_id"])
+        for item_id in dropped:
+            del self.by_item_id[item_id]
+            self.children.pop(item_id, None)
+        self.assets = [a for a in self.assets if a["item_id"] not in dropped]
+
+
+def verify_root_locations(graph, character):
     """
-    Resolves the Location of any containers in the assets
-    :param assets:
-    :param item_id_hashtable:
-    :param items_in_structures:
-    :param container_candidate_hashtable:
-    :return:
+    Makes sure every location assets sit directly inside exists, once per location.
+    Assets in player owned customs offices can't be resolved and are dropped from the graph.
+    """
+    for location_id in graph.get_root_location_ids():
+        # Handle side case when the "structure" an asset is inside is actually the character's pod
+        if location_id == character.pk:
+            continue
+        if location_id > 60000000 and location_id < 64000000:
+            # station
+            Structure.verify_object_exists(location_id, character.pk)
+        elif location_id > 30000000 and location_id <= 32000000:
+            # it's a system id
+            Location.verify_object_exists(location_id, character.pk)
+        else:
+            # it's either a structure or a poco
+            try:
+                Structure.verify_object_exists(location_id, character.pk)
+            except Exception as e:
+                # it's a poco and there's nothing we can do about it
+                graph.drop_root_location(location_id)
+
+
+def get_root_location(location_id, character):
+    """
+    :return: (root_location_id, root Location) for containers sitting directly inside location_id
     """
-    for asset in items_in_structures:
-        if asset["item_id"] in container_candidate_hashtable:
-            # This asset has children. It needs a Location created for it.
+    if location_id > 30000000 and location_id <= 32000000:
+        base_system = System.get_object(ccp_id=location_id)
+        return base_system.ccp_id, Location.get_object(base_system.ccp_id, character.pk)
 
-            # we've got three possibilities at this point:
-            # 1. The object is sitting inside a structure, and its root location is the structure
-            # 2. The object is sitting inside another container, and its root location is that container
-            # 3. The object is sitting in space, and its root location is that star system.
+    if Structure.exists(ccp_id=location_id):
+        base_structure = Structure.get_object(location_id, character.pk)
+        return base_structure.ccp_id, base_structure.location
 
-            # If the object is inside another container, then we still don't know if the whole shebang is in space,
-            # inside a structure, or what. We only want to call resolve_location_tree for a single "tree" of containers,
-            # so if this container isn't at the top of the stack, we skip it.
+    msg = "The asset is located in an unknown entity type, unable to resolve root location. Asset Location ID: %s Character Trigger: %s" % (location_id, character.pk)
+    logger.critical(msg)
+    raise Exception(msg)
 
-            if asset["location_id"] in item_id_hashtable:
-                continue
 
-            # need to figure out if root location is a Structure or a System
-            if asset["location_id"] > 30000000 and asset["location_id"] <= 32000000:
-                base_system = System.get_object(ccp_id=asset["location_id"])
-                root_location_id = base_system.ccp_id
-                root_location = Location.get_object(root_location_id, character.pk)
-            else:
-                if Structure.exists(ccp_id=asset["location_id"]):
-                    base_structure = Structure.get_object(asset["location_id"], character.pk)
-                    root_location_id = base_structure.ccp_id
-                    root_location = base_structure.location
+def resolve_container_locations(graph, character):
+    """
+    Creates a Location for every container in the assets. Every tree of containers is walked once from its top, so
+    each container knows its parent and the root location (structure or star system) the whole tree sits in.
+    Existing Locations are left as they are.
+    """
+    locations = []
+    for location_id in graph.get_root_location_ids():
+        root_containers = [a for a in graph.get_root_assets(location_id) if graph.is_container(a)]
+        if not root_containers:
+            continue
 
-                else:
-                    msg = "The asset is located in an unknown entity type, unable to resolve root location. Asset Location ID: %s Asset Item ID: %s, Character Trigger: %s" % (asset["location_id"], asset["item_id"], character.pk)
-                    logger.critical(msg)
-                    raise Exception(msg)
+        root_location_id, root_location = get_root_location(location_id, character)
+        for root_container in root_containers:
+            for container, parent_container in graph.iter_containers(root_container):
+                locations.append(Location(
+                    ccp_id=container["item_id"],
+                    parent_container=parent_container,
+                    system=root_location.system,
+                    constellation=root_location.constellation,
+                    region=root_location.region,
+                    root_location_id=root_location_id
+                ))
 
-            resolve_location_tree(root_location_id, root_location, asset, assets, container_candidate_hashtable)
+    created = bulk_insert_ignore(Location, locations)
+    logger.info("Created %s of %s container locations for character %s" % (created, len(locations), character.pk))
+
+
+def load_locations(location_ids):
+    """
+    :return: dict of ccp_id -> Location for the given ids that exist
+    """
+    ret = {}
+    for batch in chunks(list(location_ids), 1000):
+        ret.update(Location.objects.in_bulk(batch))
+    return ret
 
 
 def extract_assets(character, assets):
@@ -198,47 +216,21 @@ def extract_assets(character, assets):
     location, _ = Location.objects.get_or_create(ccp_id=character.pk, defaults={"root_location_id": character.pk})
     location.save()
 
-    # remove assets with an item_id over 9000000000000000000. they are bugged items. -ccp cockroach
-    for item in assets:
-        if item["item_id"] > 9000000000000000000:
-            assets.remove(item)
-
-    # create new assets
     # first we need to figure out what items are in containers, and which items are in structures
+    graph = AssetGraph(assets)
+    verify_root_locations(graph, character)
+    resolve_container_locations(graph, character)
 
-    # hash table of all item_ids in the asset list with a value of their location
-    item_id_hashtable = {}
-
-    # hash table of every location id in the asset list
-    container_candidate_hashtable = {}
-
-    for asset in assets:
-        item_id_hashtable[asset["item_id"]] = asset["location_id"]
-        container_candidate_hashtable[asset["location_id"]] = True
-
-    items_in_structures, container_candidate_hashtable, item_id_hashtable, assets = sort_assets_into_structures(
-        assets,
-        item_id_hashtable,
-        container_candidate_hashtable,
-        character
-    )
-
-    resolve_container_locations(
-        assets,
-        item_id_hashtable,
-        items_in_structures,
-        container_candidate_hashtable,
-        character
-    )
+    locations = load_locations(graph.children.keys())
 
     asset_objects = []
-    for asset in assets:
-        is_in_container = asset["location_id"] in item_id_hashtable
-        if not Location.exists(asset["location_id"]):
+    for asset in graph.assets:
+        is_in_container = graph.is_in_container(asset)
+        location = locations.get(asset["location_id"])
+        if location is None:
             # todo: if this triggers, the item is most likely trashed. either remove item from assets or flag it explicitly
             logger.warning("Asset location could not be found. char: %s asset_info: %s in_container: %s" % (character.pk, asset, is_in_container))
             continue
-        location = Location.get_object(asset["location_id"], character.pk)
 
         # resolve type
         item_type = ObjectType.get_object(asset["type_id"])
@@ -260,10 +252,11 @@ def extract_assets(character, assets):
     return update_asset_names(character, asset_objects)
 
 
-def get_character_assets(character_ccp_id):
+def get_character_assets(character_ccp_id, client=None):
     """
 
     :param character_ccp_id:
+    :param client: optional EsiClient authenticated as the character, so the caller can inspect the response headers
     :return:
     {
     location_flag : varchar
@@ -292,8 +285,15 @@ def get_character_assets(character_ccp_id):
     #if not character.has_esi_scope():
     #    return None
 
-    client = EsiClient(authenticating_character=character)
-    assets_pages = client.get_multiple_paginated("/v3/characters/{}/assets/".format(character_ccp_id))
+    # remove assets with an item_id over 9000000000000000000. they are bugged items. -ccp cockroach
+    drop_bugged_items = lambda page: [item for item in page if item["item_id"] <= 9000000000000000000]
+
+    if client is None:
+        client = EsiClient(authenticating_character=character)
+    assets_pages = client.get_multiple_paginated(
+        "/v3/characters/{}/assets/".format(character_ccp_id),
+        stages=[drop_bugged_items]
+    )
     assets = extract_assets(character, assets_pages)
     return assets
 
@@ -4,6 +4,7 @@ from django.db.utils import InternalError
 from eve_api.esi_client import EsiClient
 from eve_api.models import EVEPlayerCharacter, EVEPlayerCorporation, ObjectType, Structure, EVEPlayerAlliance, System, CcpIdTypeResolver
 from eve_api.tasks import util
+from eve_api.tasks.esi_id_resolver import resolve_ids
 
 logger=logging.getLogger(__name__)
 
@@ -37,6 +38,20 @@ def resolve_extra_info_object(character, key, value):
     return (key,value)
 
 
+def get_journal_entry_ids(entries):
+    """
+    :return: every character/corporation/alliance id the entries reference
+    """
+    ids = set()
+    for entry in entries:
+        for key in ["first_party_id", "second_party_id"]:
+            if key in entry:
+                ids.add(entry[key])
+        if entry.get("context_id_type") in ["character_id", "corporation_id", "alliance_id"]:
+            ids.add(entry["context_id"])
+    return ids
+
+
 def verify_journal_entry(entry, character):
     if "first_party_id" in entry:
         # no more first_party_type!
@@ -81,6 +96,9 @@ def get_character_journal(character_ccp_id, page = 1, page_limit=5):
 
     journal_entries, _ = client.get("/v4/characters/%s/wallet/journal/?page=%s" % (character_ccp_id,page))
 
+    # resolve the whole page's counterparties up front, verifying each entry is then just cache hits
+    resolve_ids(get_journal_entry_ids(journal_entries))
+
     formatted_entries = []
     for entry in journal_entries:
         e = verify_journal_entry(entry, character)
@@ -4,6 +4,7 @@ from django.db.utils import InternalError
 from eve_api.esi_client import EsiClient
 from eve_api.models import EVEPlayerCharacter, EVEPlayerCorporation, Structure, ObjectType, CcpIdTypeResolver
 from . import util
+from .esi_id_resolver import resolve_ids
 logger = logging.getLogger(__name__)
 
 
@@ -44,6 +45,9 @@ def get_character_transactions(character_ccp_id, oldest_entry=None, page=0):
     else:
         transaction_entries, _ = client.get("/v1/characters/%s/wallet/transactions/?from_id=%s" % (character_ccp_id,oldest_entry))
 
+    # resolve the whole page's clients up front, verifying each transaction is then just cache hits
+    resolve_ids(entry["client_id"] for entry in transaction_entries)
+
     oldest_transaction_entry = -1
     transactions = []
     for entry in transaction_entries:
@@ -0,0 +1,165 @@
+import logging
+
+from django.core.cache import cache
+
+from eve_api.esi_client import EsiClient
+from eve_api.models import EVEPlayerCharacter, EVEPlayerCorporation, EVEPlayerAlliance, CcpIdTypeResolver
+from market.utils import bulk_insert_ignore, chunks
+
+logger=logging.getLogger(__name__)
+
+# both endpoints take at most 1000 ids per request
+ESI_ID_CHUNK_SIZE = 1000
+
+# /universe/names/ categories we know the type name of. see CCP_ID_TYPE_GROUPS
+NAME_CATEGORY_TYPES = {
+    "character": "character",
+    "corporation": "corporation",
+    "alliance": "alliance",
+    "solar_system": "system",
+    "faction": "faction",
+}
+
+ENTITY_MODELS = {
+    "character": (EVEPlayerCharacter, "eveplayercharacter_exists_{}"),
+    "corporation": (EVEPlayerCorporation, "eveplayercorporation_exists_{}"),
+    "alliance": (EVEPlayerAlliance, "eveplayeralliance_exists_{}"),
+}
+
+
+def _post_in_chunks(client, endpoint_url, ids):
+    """
+    Posts ids to endpoint_url 1000 at a time. ESI fails a whole request over a single id it can't resolve, so a failed
+    chunk is split until the bad ids are on their own, and those are dropped.
+    :return: every result, concatenated
+    """
+    results = []
+    pending = list(chunks(sorted(ids), ESI_ID_CHUNK_SIZE))
+    while pending:
+        batch = pending.pop()
+        data, err = client.post(endpoint_url, post_body=batch)
+        if err is None:
+            results.extend(data)
+        elif len(batch) > 1:
+            half = len(batch) // 2
+            pending.extend([batch[:half], batch[half:]])
+        else:
+            logger.info("ESI could not resolve id {} using {}: {}".format(batch[0], endpoint_url, data))
+    return results
+
+
+def _get_names(client, ids, names):
+    """
+    Adds the /universe/names/ result of every id not already in names to it.
+    :param names: dict of ccp_id -> (category, name)
+    """
+    ids = [i for i in ids if i not in names]
+    if not ids:
+        return
+    for result in _post_in_chunks(client, "/v3/universe/names/", ids):
+        names[result["id"]] = (result["category"], result["name"])
+
+
+def _load_known_types(ccp_ids):
+    """
+    :return: dict of ccp_id -> type name of the legacy ids we've resolved before
+    """
+    cached = cache.get_many(["ccp_id_type_name_resolver_%s" % i for i in ccp_ids])
+    known = {}
+    for ccp_id in ccp_ids:
+        type_name = cached.get("ccp_id_type_name_resolver_%s" % ccp_id)
+        if type_name is not None:
+            known[ccp_id] = type_name
+
+    remaining = [i for i in ccp_ids if i not in known]
+    for batch in chunks(remaining, 10000):
+        rows = CcpIdTypeResolver.objects.filter(ccp_id__in=batch, type_name__isnull=False).values_list('ccp_id', 'type_name')
+        known.update(rows)
+    return known
+
+
+def _store_types(id_types):
+    if not id_types:
+        return
+    bulk_insert_ignore(CcpIdTypeResolver, [CcpIdTypeResolver(ccp_id=i, type_name=t) for i, t in id_types.items()])
+    cache.set_many({"ccp_id_type_name_resolver_%s" % i: t for i, t in id_types.items()}, timeout=604800)
+
+
+def _get_missing_ids(model, ccp_ids):
+    existing = set()
+    for batch in chunks(list(ccp_ids), 10000):
+        existing.update(model.objects.filter(pk__in=batch).values_list('pk', flat=True))
+    return set(ccp_ids) - existing
+
+
+def resolve_ids(ccp_ids):
+    """
+    Figures out the type of every id in an ingest batch and creates every character, corporation and alliance among
+    them we don't have yet. Characters cost a few requests to /universe/names/ and /characters/affiliation/ for the
+    whole batch instead of up to three requests per id. New corporations and alliances are provisioned one by one.
+    Anything ESI can't resolve in bulk is left to the per-id verify methods.
+    :return: dict of ccp_id -> type name (see CcpIdTypeResolver.get_id_type)
+    """
+    ccp_ids = set(int(i) for i in ccp_ids)
+    client = EsiClient(log_application_errors=False, raise_application_errors=False)
+    names = {}
+
+    # everything outside the legacy range can be typed by its id alone
+    legacy_ids = [i for i in ccp_ids if CcpIdTypeResolver.is_legacy_id(i)]
+    id_types = {i: CcpIdTypeResolver.get_id_type(i) for i in ccp_ids if not CcpIdTypeResolver.is_legacy_id(i)}
+    id_types.update(_load_known_types(legacy_ids))
+
+    _get_names(client, [i for i in legacy_ids if i not in id_types], names)
+    new_types = {}
+    for ccp_id in legacy_ids:
+        if ccp_id not in id_types and ccp_id in names and names[ccp_id][0] in NAME_CATEGORY_TYPES:
+            new_types[ccp_id] = NAME_CATEGORY_TYPES[names[ccp_id][0]]
+    _store_types(new_types)
+    id_types.update(new_types)
+
+    missing = {}
+    for type_name, (model, _) in ENTITY_MODELS.items():
+        missing[type_name] = _get_missing_ids(model, [i for i, t in id_types.items() if t == type_name])
+
+    # new characters need their corporation, and it might be new to us as well
+    affiliations = {}
+    if missing["character"]:
+        for affiliation in _post_in_chunks(client, "/v1/characters/affiliation/", missing["character"]):
+            affiliations[affiliation["character_id"]] = affiliation
+    missing["corporation"].update(_get_missing_ids(
+        EVEPlayerCorporation, set(a["corporation_id"] for a in affiliations.values()) - missing["corporation"]))
+
+    # corporations and alliances are few next to characters, and bulk endpoints only give us their names. they go
+    # through the regular provisioning so tickers, alliances and executors are filled in, and a corporation's
+    # alliance comes from the corporation itself rather than one of its characters.
+    for alliance_id in missing["alliance"]:
+        EVEPlayerAlliance.verify_object_exists(alliance_id)
+    for corp_id in missing["corporation"]:
+        EVEPlayerCorporation.verify_object_exists(corp_id)
+
+    _get_names(client, missing["character"], names)
+    characters = []
+    for char_id in missing["character"]:
+        affiliation = affiliations.get(char_id)
+        if char_id not in names or affiliation is None:
+            continue
+        characters.append(EVEPlayerCharacter(pk=char_id, name=names[char_id][1], corporation_id=affiliation["corporation_id"]))
+    bulk_insert_ignore(EVEPlayerCharacter, characters)
+
+    created = {
+        "alliance": missing["alliance"],
+        "corporation": missing["corporation"],
+        "character": set(c.pk for c in characters),
+    }
+    logger.info("resolved {} ids, created {} characters, {} corporations and {} alliances".format(
+        len(ccp_ids), len(created["character"]), len(created["corporation"]), len(created["alliance"])))
+
+    # the per-id verify methods now hit cache for everything that exists
+    exists_keys = {}
+    for type_name, (_, key_format) in ENTITY_MODELS.items():
+        type_ids = set(i for i, t in id_types.items() if t == type_name) | created[type_name]
+        for ccp_id in type_ids - (missing[type_name] - created[type_name]):
+            exists_keys[key_format.format(ccp_id)] = True
+    cache.set_many(exists_keys, timeout=86400)
+
+    return id_types
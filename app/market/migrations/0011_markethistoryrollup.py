@@ -0,0 +1,37 @@
+# Generated by Django 2.1.2 on 2019-02-04 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eve_api', '0002_eveplayercharacter_transactions_cursor'),
+        ('market', '0010_auto_20190128_1900'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketHistoryRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('as_of', models.DateField()),
+                ('volume_7', models.BigIntegerField(default=0)),
+                ('volume_14', models.BigIntegerField(default=0)),
+                ('volume_30', models.BigIntegerField(default=0)),
+                ('highest_7', models.FloatField(default=0)),
+                ('highest_14', models.FloatField(default=0)),
+                ('highest_30', models.FloatField(default=0)),
+                ('isk_volume_7', models.FloatField(default=0)),
+                ('isk_volume_14', models.FloatField(default=0)),
+                ('isk_volume_30', models.FloatField(default=0)),
+                ('object_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='eve_api.ObjectType')),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='eve_api.Region')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='markethistoryrollup',
+            unique_together={('region', 'object_type')},
+        ),
+    ]
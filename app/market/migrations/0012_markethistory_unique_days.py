@@ -0,0 +1,38 @@
+# Generated by Django 2.1.2 on 2019-02-06 21:40
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_history(apps, schema_editor):
+    MarketHistory = apps.get_model('market', 'MarketHistory')
+    duplicates = MarketHistory.objects.values('region_id', 'date', 'object_type_id').annotate(
+        keep_id=Min('id'),
+        entries=Count('id')
+    ).filter(entries__gt=1)
+
+    for d in list(duplicates):
+        MarketHistory.objects.filter(
+            region_id=d['region_id'],
+            date=d['date'],
+            object_type_id=d['object_type_id']
+        ).exclude(id=d['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0011_markethistoryrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_history, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='markethistory',
+            unique_together={('region', 'date', 'object_type')},
+        ),
+        migrations.AlterIndexTogether(
+            name='markethistory',
+            index_together=set(),
+        ),
+    ]
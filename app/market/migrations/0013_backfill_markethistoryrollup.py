@@ -0,0 +1,58 @@
+# Generated by Django 2.1.2 on 2019-02-08 10:05
+
+import datetime
+
+from django.db import migrations
+from django.db.models import F, FloatField, Max, Sum
+from django.db.models.functions import Cast
+
+WINDOWS = (7, 14, 30)
+
+
+def backfill_rollups(apps, schema_editor):
+    # same aggregates as MarketHistoryRollup.rebuild_region, which can't be called on the historical models. without
+    # them every route reads 0 velocity until its region's next history pull.
+    MarketHistory = apps.get_model('market', 'MarketHistory')
+    MarketHistoryRollup = apps.get_model('market', 'MarketHistoryRollup')
+
+    # today's history is never pulled, yesterday is the last complete day
+    as_of = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+    region_ids = MarketHistory.objects.filter(
+        date__gt=as_of - datetime.timedelta(days=max(WINDOWS)),
+        date__lte=as_of
+    ).values_list('region_id', flat=True).distinct()
+
+    for region_id in list(region_ids):
+        rollups = {}
+        for days in WINDOWS:
+            rows = MarketHistory.objects.filter(
+                region_id=region_id,
+                date__gt=as_of - datetime.timedelta(days=days),
+                date__lte=as_of
+            ).values('object_type_id').annotate(
+                volume=Sum('volume'),
+                highest=Max('highest'),
+                isk_volume=Sum(F('average') * Cast('volume', FloatField()))
+            )
+            for row in rows:
+                r = rollups.get(row['object_type_id'])
+                if r is None:
+                    r = MarketHistoryRollup(region_id=region_id, object_type_id=row['object_type_id'], as_of=as_of)
+                    rollups[row['object_type_id']] = r
+                setattr(r, "volume_{}".format(days), row['volume'] or 0)
+                setattr(r, "highest_{}".format(days), row['highest'] or 0)
+                setattr(r, "isk_volume_{}".format(days), row['isk_volume'] or 0)
+
+        MarketHistoryRollup.objects.filter(region_id=region_id).delete()
+        MarketHistoryRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0012_markethistory_unique_days'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
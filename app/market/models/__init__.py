@@ -4,7 +4,7 @@ from .trading_route import TradingRoute
 from .market_order import MarketOrder
 from .player_transaction import PlayerTransaction, TransactionLinkage
 from .item_group import ItemGroup
-from .market_history import MarketHistory
+from .market_history import MarketHistory, MarketHistoryRollup
 from .market_price_dao import MarketPriceDAO
 from .shopping_list import ShoppingListItem
 from .player_assets import AssetContainer, AssetEntry
@@ -22,10 +22,6 @@ logger=logging.getLogger(__name__)
 def heat_market_price_dao():
     MarketPriceDAO.heat_cache()
 
-@general_queue.task()
-def heat_market_orders():
-    MarketOrder.heat_cache()
-
 @general_queue.task()
 def heat_market_history():
     MarketHistory.heat_cache()
@@ -33,5 +29,4 @@ def heat_market_history():
 @general_queue.task()
 def heat_cache():
     heat_market_price_dao()
-    heat_market_orders()
     heat_market_history()
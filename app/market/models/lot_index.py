@@ -0,0 +1,67 @@
+import logging
+from bisect import bisect_left
+
+from .player_transaction import PlayerTransaction
+
+logger=logging.getLogger(__name__)
+
+
+class LotIndex:
+    """
+    A character's unallocated buy lots in one structure, per type: prices sorted ascending with cumulative quantity and
+    cost, so the cost of the cheapest N units is a single binary search.
+
+    Build one per request with load(), lots change every time transactions are linked.
+    """
+
+    def __init__(self, lots):
+        """
+        :param lots: iterable of (object_type_id, unit_price, quantity)
+        """
+        by_type = {}
+        for object_type_id, unit_price, quantity in lots:
+            by_type.setdefault(object_type_id, []).append((unit_price, quantity))
+
+        self._prices = {}
+        self._cumulative_quantity = {}
+        self._cumulative_cost = {}
+        for object_type_id, type_lots in by_type.items():
+            type_lots.sort(key=lambda l: l[0])
+            prices = []
+            cumulative_quantity = [0]
+            cumulative_cost = [0.0]
+            for unit_price, quantity in type_lots:
+                prices.append(unit_price)
+                cumulative_quantity.append(cumulative_quantity[-1] + quantity)
+                cumulative_cost.append(cumulative_cost[-1] + quantity * unit_price)
+            self._prices[object_type_id] = prices
+            self._cumulative_quantity[object_type_id] = cumulative_quantity
+            self._cumulative_cost[object_type_id] = cumulative_cost
+
+    @staticmethod
+    def load(character_id, structure_id, object_type_ids=None):
+        lots = PlayerTransaction.objects.filter(
+            character_id = character_id,
+            location_id = structure_id,
+            quantity_without_known_destination__gt=0
+        )
+        if object_type_ids is not None:
+            lots = lots.filter(object_type_id__in=object_type_ids)
+        return LotIndex(lots.values_list('object_type_id', 'unit_price', 'quantity_without_known_destination'))
+
+    def get_cheapest_cost(self, object_type_id, quantity):
+        """
+        :return: (units covered by the lots, cost of buying those units cheapest first)
+        """
+        cumulative_quantity = self._cumulative_quantity.get(object_type_id)
+        if not cumulative_quantity or quantity <= 0:
+            return 0, 0.0
+
+        cumulative_cost = self._cumulative_cost[object_type_id]
+        if quantity >= cumulative_quantity[-1]:
+            return cumulative_quantity[-1], cumulative_cost[-1]
+
+        # lots before i - 1 are used up entirely, the rest comes out of lot i - 1
+        i = bisect_left(cumulative_quantity, quantity)
+        partial = quantity - cumulative_quantity[i - 1]
+        return quantity, cumulative_cost[i - 1] + partial * self._prices[object_type_id][i - 1]
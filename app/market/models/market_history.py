@@ -2,14 +2,16 @@ import logging
 import hashlib
 from django.contrib.auth.models import User
 import asyncio
+from datetime import timedelta
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.core.cache import cache
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType, Region
-from market.utils import get_cached_column, obj_exists_cached
+from market.utils import get_cached_column, obj_exists_cached, chunks, bulk_update_fields
 from conf.huey_queues import general_queue
 
 
@@ -30,7 +32,7 @@ class MarketHistory(models.Model):
     region = models.ForeignKey(Region, on_delete=models.CASCADE)
 
     class Meta:
-        index_together = [
+        unique_together = [
             ("region", "date", "object_type"),
         ]
 
@@ -77,4 +79,233 @@ class MarketHistory(models.Model):
                 )] = True
 
         cache.set_many(keys, timeout=MarketHistory.get_market_history_cache_timeout())
-        logger.info("Market history cache hot with {} kv's".format(len(keys)))
\ No newline at end of file
+        logger.info("Market history cache hot with {} kv's".format(len(keys)))
+
+class MarketHistoryRollup(models.Model):
+    """
+    Rolling aggregates of MarketHistory per (region, type) over the 7, 14 and 30 days ending on as_of (inclusive).
+    Kept current incrementally by begin_update() on every history pull, so readers never re-aggregate history.
+    """
+    WINDOWS = (7, 14, 30)
+
+    region = models.ForeignKey(Region, on_delete=models.CASCADE)
+    object_type = models.ForeignKey(ObjectType, on_delete=models.CASCADE)
+    as_of = models.DateField()
+
+    volume_7 = models.BigIntegerField(default=0)
+    volume_14 = models.BigIntegerField(default=0)
+    volume_30 = models.BigIntegerField(default=0)
+
+    highest_7 = models.FloatField(default=0)
+    highest_14 = models.FloatField(default=0)
+    highest_30 = models.FloatField(default=0)
+
+    # sum of average * volume, so the average price can be maintained incrementally
+    isk_volume_7 = models.FloatField(default=0)
+    isk_volume_14 = models.FloatField(default=0)
+    isk_volume_30 = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = (("region", "object_type"),)
+
+    @staticmethod
+    def get_rollup_fields():
+        return [
+            "{}_{}".format(name, days)
+            for name in ("volume", "highest", "isk_volume")
+            for days in MarketHistoryRollup.WINDOWS
+        ]
+
+    def get_average(self, days):
+        volume = getattr(self, "volume_{}".format(days))
+        if not volume:
+            return None
+        return getattr(self, "isk_volume_{}".format(days)) / volume
+
+    def _in_window(self, date, days, as_of=None):
+        as_of = as_of or self.as_of
+        return as_of - timedelta(days=days) < date <= as_of
+
+    def _reset(self, as_of):
+        self.as_of = as_of
+        for f in MarketHistoryRollup.get_rollup_fields():
+            setattr(self, f, 0)
+
+    def _add(self, date, volume, highest, average):
+        for days in MarketHistoryRollup.WINDOWS:
+            if not self._in_window(date, days):
+                continue
+            setattr(self, "volume_{}".format(days), getattr(self, "volume_{}".format(days)) + volume)
+            setattr(self, "highest_{}".format(days), max(getattr(self, "highest_{}".format(days)), highest))
+            setattr(self, "isk_volume_{}".format(days), getattr(self, "isk_volume_{}".format(days)) + average * volume)
+
+    def _remove(self, date, volume, highest, average, new_as_of):
+        """
+        Takes a day that falls out of a window when it slides from as_of to new_as_of back out of that window.
+        :return: True if the day held a window's max, which then has to be recomputed from history
+        """
+        lost_max = False
+        for days in MarketHistoryRollup.WINDOWS:
+            if not self._in_window(date, days) or self._in_window(date, days, new_as_of):
+                continue
+            setattr(self, "volume_{}".format(days), getattr(self, "volume_{}".format(days)) - volume)
+            setattr(self, "isk_volume_{}".format(days), getattr(self, "isk_volume_{}".format(days)) - average * volume)
+            if highest >= getattr(self, "highest_{}".format(days)):
+                lost_max = True
+        return lost_max
+
+    @staticmethod
+    def _recompute(region_id, rollups, object_type_ids, as_of):
+        """
+        Rebuilds the given types from history, filling rollups in place.
+        :return: list of rollups that didn't exist yet
+        """
+        created = []
+        for object_type_id in object_type_ids:
+            if object_type_id in rollups:
+                rollups[object_type_id]._reset(as_of)
+            else:
+                r = MarketHistoryRollup(region_id=region_id, object_type_id=object_type_id)
+                r._reset(as_of)
+                rollups[object_type_id] = r
+                created.append(r)
+
+        oldest = as_of - timedelta(days=max(MarketHistoryRollup.WINDOWS))
+        for batch in chunks(list(object_type_ids), 1000):
+            rows = MarketHistory.objects.filter(
+                region_id=region_id,
+                object_type_id__in=batch,
+                date__gt=oldest,
+                date__lte=as_of
+            ).values_list('object_type_id', 'date', 'volume', 'highest', 'average')
+            for object_type_id, date, volume, highest, average in rows:
+                rollups[object_type_id]._add(date, volume, highest, average)
+        return created
+
+    @staticmethod
+    def rebuild_region(region_id, as_of):
+        """
+        Throws away and rebuilds every rollup in the region from history.
+        """
+        oldest = as_of - timedelta(days=max(MarketHistoryRollup.WINDOWS))
+        object_type_ids = MarketHistory.objects.filter(
+            region_id=region_id,
+            date__gt=oldest,
+            date__lte=as_of
+        ).values_list('object_type_id', flat=True).distinct()
+
+        rollups = {}
+        created = MarketHistoryRollup._recompute(region_id, rollups, set(object_type_ids), as_of)
+        with transaction.atomic():
+            MarketHistoryRollup.objects.filter(region_id=region_id).delete()
+            MarketHistoryRollup.objects.bulk_create(created, batch_size=1000)
+        logger.info("Rebuilt {} market history rollups for region {}".format(len(created), region_id))
+
+    @staticmethod
+    def begin_update(region_id, as_of):
+        """
+        Starts applying a history pull to the region's rollups. Call before the pull inserts anything, hand every
+        inserted batch to add_entries() and save() once the pull is done.
+        :param as_of: last complete day of history
+        """
+        return MarketHistoryRollupUpdate(region_id, as_of)
+
+
+class MarketHistoryRollupUpdate:
+    """
+    Slides every rollup in a region forward to as_of and folds in the history rows a pull inserts, batch by batch, so
+    the pull never has to hold on to what it inserted. Only the days leaving a window are read back from history, plus
+    the full 30 days of the few types whose max left a window or that have no rollup yet.
+    """
+
+    def __init__(self, region_id, as_of):
+        self.region_id = region_id
+        self.as_of = as_of
+        self.changed = set()
+        # types an earlier pull wrote history for but died before saving its rollups. that history is in the db now,
+        # so it would never be added, only removed once it leaves a window. those types are read back in full.
+        self.unsaved_type_ids = cache.get(self._unsaved_types_key()) or set()
+        self.to_recompute = set(self.unsaved_type_ids)
+        self.rollups = {r.object_type_id: r for r in MarketHistoryRollup.objects.filter(region_id=region_id)}
+        # without any rollups the region is rebuilt from history on save
+        if self.rollups:
+            self._slide()
+
+    def _slide(self):
+        # runs before the pull inserts anything, so every day read back here was part of the old windows.
+        # rollups are grouped by their current as_of, which is normally the same for the region
+        behind = {}
+        for r in self.rollups.values():
+            if r.as_of < self.as_of:
+                behind.setdefault(r.as_of, []).append(r)
+
+        for old_as_of, group in behind.items():
+            if self.as_of - old_as_of >= timedelta(days=max(MarketHistoryRollup.WINDOWS)):
+                self.to_recompute.update(r.object_type_id for r in group)
+                continue
+
+            # the days leaving each window
+            leaving = Q()
+            for days in MarketHistoryRollup.WINDOWS:
+                leaving |= Q(date__gt=old_as_of - timedelta(days=days), date__lte=self.as_of - timedelta(days=days))
+            rows = MarketHistory.objects.filter(leaving, region_id=self.region_id).values_list(
+                'object_type_id', 'date', 'volume', 'highest', 'average')
+
+            for object_type_id, date, volume, highest, average in rows:
+                r = self.rollups.get(object_type_id)
+                if r is None or r.as_of != old_as_of:
+                    continue
+                if r._remove(date, volume, highest, average, self.as_of):
+                    self.to_recompute.add(object_type_id)
+                self.changed.add(object_type_id)
+
+            for r in group:
+                r.as_of = self.as_of
+
+    def _unsaved_types_key(self):
+        return "market_history_rollup_unsaved_types_{}".format(self.region_id)
+
+    def expect_entries(self, object_type_ids):
+        """
+        Call before inserting history for these types. If the pull doesn't get to save(), the next update recomputes
+        them from history.
+        """
+        new_ids = set(object_type_ids) - self.unsaved_type_ids
+        if not new_ids:
+            return
+        self.unsaved_type_ids |= new_ids
+        cache.set(self._unsaved_types_key(), self.unsaved_type_ids, timeout=None)
+
+    def add_entries(self, new_entries):
+        """
+        :param new_entries: MarketHistory objects that were just inserted
+        """
+        if not self.rollups:
+            return
+        for e in new_entries:
+            r = self.rollups.get(e.object_type_id)
+            if r is None:
+                self.to_recompute.add(e.object_type_id)
+                continue
+            r._add(e.date, e.volume, e.highest, e.average)
+            self.changed.add(e.object_type_id)
+
+    def save(self):
+        if not self.rollups:
+            MarketHistoryRollup.rebuild_region(self.region_id, self.as_of)
+            cache.delete(self._unsaved_types_key())
+            return
+
+        # recomputed types are read back from history in full, whatever was added to them above is thrown away
+        created = MarketHistoryRollup._recompute(self.region_id, self.rollups, self.to_recompute, self.as_of)
+        created_ids = {r.object_type_id for r in created}
+        updated = [self.rollups[i] for i in self.changed | self.to_recompute if i not in created_ids]
+
+        with transaction.atomic():
+            # rollups that only slid forward don't need anything but their as_of written
+            MarketHistoryRollup.objects.filter(region_id=self.region_id, as_of__lt=self.as_of).update(as_of=self.as_of)
+            bulk_update_fields(MarketHistoryRollup, updated, ["as_of"] + MarketHistoryRollup.get_rollup_fields())
+            MarketHistoryRollup.objects.bulk_create(created, batch_size=1000)
+        cache.delete(self._unsaved_types_key())
+        logger.info("Market history rollups for region {}: {} updated, {} recomputed, {} created".format(
+            self.region_id, len(updated), len(self.to_recompute), len(created)))
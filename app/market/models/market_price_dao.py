@@ -1,26 +1,25 @@
 import logging
+import json
+import uuid
 from django.contrib.auth.models import User
 import asyncio
 
 from django.db import models
 from django.core.cache import cache
 from django.db.models.signals import post_save
-from django.db.models import Sum, Avg, Max
+from django.db.models import Sum, Avg, Min
 from django.dispatch import receiver
+from django_redis import get_redis_connection
 
-from eve_api.models import Structure, EVEPlayerCharacter, ObjectType, Region
-from django.utils import timezone
-from datetime import timedelta
+from eve_api.models import Structure, EVEPlayerCharacter, ObjectType
 from enum import Enum
-from market.models import MarketHistory
+from market.models import MarketHistoryRollup
 from market.models import MarketOrder
 from .shopping_list import ShoppingListItem
 
-import gevent
-from gevent.pool import Pool
-
 
 from market.models.util import get_structures_we_have_keys_for
+from market.utils import chunks
 
 logger=logging.getLogger(__name__)
 
@@ -65,41 +64,60 @@ class MarketPriceDAO:
         return 31 * 86400
 
     @staticmethod
-    def purge_structure_price_cache(structure_id, object_ids):
-        patterns = [
-            "dao_lowest_sell_price_{}_{}",
-            "dao_posted_order_volume_{}_{}",
-            "dao_lowest_sell_order_{}_{}"
-        ]
+    def get_structure_metrics():
+        """
+        :return: dict of structure metric name -> function(object_type_ids, structure) -> dict of object_type_id -> value
+        """
+        return {
+            "lowest_sell_price": MarketPriceDAO.calculate_lowest_sell_price_multi,
+            "posted_order_volume": lambda ids, structure: MarketPriceDAO.calculate_posted_volume_multi(ids, False, structure),
+            "lowest_sell_order": MarketPriceDAO.calculate_lowest_sell_order_multi,
+        }
 
-        patterns_to_delete = []
-        for i in object_ids:
-            patterns_to_delete.extend(
-                [pattern.format(structure_id, i) for pattern in patterns]
-            )
+    @staticmethod
+    def _get_structure_hash_key(metric, structure_id):
+        # one redis hash per (metric, structure). fields are type ids, values are json. the raw connection doesn't
+        # apply the cache's key prefix, make_key does.
+        return cache.make_key("dao_{}_{}".format(metric, structure_id))
 
-        cache.delete_many(patterns_to_delete)
-        logger.info("Reheating DAO Price cache for {} object_types after partial purge".format(len(object_ids)))
-        MarketPriceDAO.heat_price_cache(structure_id, object_ids)
-        logger.info("DAO Price Cache hot")
+    @staticmethod
+    def _write_hash(conn, hash_key, values):
+        for batch in chunks(list(values.items()), 1000):
+            conn.hmset(hash_key, {k: json.dumps(v) for k, v in batch})
+        conn.expire(hash_key, MarketPriceDAO.get_market_dao_cache_timeout())
 
     @staticmethod
-    def purge_region_dao_cache(region_id, object_ids):
-        # purge DAO velocity cache
-        velocity_key = "dao_velocity_" + str(region_id) + "_30_{}"
-        patterns_to_delete = [velocity_key.format(i) for i in object_ids]
-        cache.delete_many(patterns_to_delete)
-        logger.info("Reheating DAO velocity cache for {} object_types after partial purge".format(len(object_ids)))
-        MarketPriceDAO.heat_velocity_cache(region_id, object_ids)
-        logger.info("DAO velocity cache hot")
+    def _swap_in_hash(conn, hash_key, values):
+        """
+        Replaces the whole hash at once. It's built under a temporary key and renamed over the live one, so readers
+        see either the old hash or the new one, never a half written one.
+        """
+        if not values:
+            conn.delete(hash_key)
+            return
+        building_key = "{}_building_{}".format(hash_key, uuid.uuid4().hex)
+        MarketPriceDAO._write_hash(conn, building_key, values)
+        conn.rename(building_key, hash_key)
 
-        # purge max price cache
-        max_price_key = "dao_max_sell_" + str(region_id) + "_30_{}"
-        patterns_to_delete = [max_price_key.format(i) for i in object_ids]
-        cache.delete_many(patterns_to_delete)
-        logger.info("Reheating DAO max price cache for {} object_types after partial purge".format(len(object_ids)))
-        MarketPriceDAO.heat_max_price_cache(region_id, object_ids)
-        logger.info("DAO max price cache hot")
+    @staticmethod
+    def _calculate_structure_metric(metric, structure, object_type_ids):
+        # every requested type gets a value, None included, so misses aren't recomputed on every read
+        calculated = MarketPriceDAO.get_structure_metrics()[metric](object_type_ids, structure)
+        return {i: calculated.get(i) for i in object_type_ids}
+
+    @staticmethod
+    def purge_structure_price_cache(structure_id, object_ids):
+        """
+        Recomputes the given types' values for the structure in place.
+        """
+        structure = Structure.get_object(structure_id, None)
+        object_ids = list(object_ids)
+        conn = get_redis_connection("default")
+        logger.info("Refreshing DAO Price cache for {} object_types in structure {}".format(len(object_ids), structure_id))
+        for metric in MarketPriceDAO.get_structure_metrics():
+            values = MarketPriceDAO._calculate_structure_metric(metric, structure, object_ids)
+            MarketPriceDAO._write_hash(conn, MarketPriceDAO._get_structure_hash_key(metric, structure_id), values)
+        logger.info("DAO Price Cache hot")
 
     @staticmethod
     def heat_price_cache(structure_id=None, object_ids=None):
@@ -109,209 +127,135 @@ class MarketPriceDAO:
             structures = get_structures_we_have_keys_for()
             structures = [Structure.get_object(s, None) for s in structures]
 
-        if not object_ids:
-            object_ids = ObjectType.get_all_tradeable_items()
-
-        logger.info("Heating object_id lowest sell price")
-        for s in structures:
-            MarketPriceDAO.get_lowest_sell_price_multi(object_ids, s)
+        if object_ids:
+            for s in structures:
+                MarketPriceDAO.purge_structure_price_cache(s.pk, object_ids)
+            return
 
-        logger.info("Heating object_id volume posted")
-        for s in structures:
-            MarketPriceDAO.get_sell_volume_posted_multi(object_ids, s)
-
-        logger.info("Heating object_id lowest order")
-        for s in structures:
-            MarketPriceDAO.get_lowest_sell_order_multi(object_ids, s)
-
-    @staticmethod
-    def heat_velocity_cache(region_id=None, object_ids=None):
-        if region_id:
-            distinct_regions = [region_id]
-        else:
-            distinct_regions = MarketHistory.objects.all().values_list('region_id', flat=True).distinct()
-
-        for region_id in distinct_regions:
-            region = Region.get_object(region_id)
-            logger.info("Heating velocity cache for region {}".format(region.pk))
-            oldest_order = timezone.now() - timedelta(days=30)
-            if not object_ids:
-                object_ids = MarketHistory.objects.filter(region=region, date__gte=oldest_order).values_list('object_type_id', flat=True).distinct()
-            MarketPriceDAO.get_avg_velocity30_multi(object_ids, region)
-
-    @staticmethod
-    def heat_max_price_cache(region_id=None, object_ids=None):
-        if region_id:
-            distinct_regions = [region_id]
-        else:
-            distinct_regions = MarketHistory.objects.all().values_list('region_id', flat=True).distinct()
-
-        for region_id in distinct_regions:
-            region = Region.get_object(region_id)
-            logger.info("Heating max sell price 30day for region {}".format(region.pk))
-            oldest_order = timezone.now() - timedelta(days=30)
-            if not object_ids:
-                object_ids = MarketHistory.objects.filter(region=region, date__gte=oldest_order).values_list('object_type_id', flat=True).distinct()
-            MarketPriceDAO.get_max_sell30_multi(object_ids, region)
+        object_ids = list(ObjectType.get_all_tradeable_items())
+        conn = get_redis_connection("default")
+        for metric in MarketPriceDAO.get_structure_metrics():
+            logger.info("Heating {}".format(metric))
+            for s in structures:
+                values = MarketPriceDAO._calculate_structure_metric(metric, s, object_ids)
+                MarketPriceDAO._swap_in_hash(conn, MarketPriceDAO._get_structure_hash_key(metric, s.pk), values)
 
     @staticmethod
     def heat_cache():
         logger.info("Heating price cache")
         MarketPriceDAO.heat_price_cache()
         logger.info("Market price cache hot")
-        logger.info("Heating velocity cache")
-        MarketPriceDAO.heat_velocity_cache()
-        logger.info("Velocity cache hot")
-        logger.info("Heating max price cache")
-        MarketPriceDAO.heat_max_price_cache()
-        logger.info("Max price cache hot")
-
-    @staticmethod
-    def _load_cached_range(
-            object_type_ids,
-            key_gen_func,
-            calc_func,
-    ):
-        keys = [key_gen_func(i) for i in object_type_ids]
-
-        res = cache.get_many(keys)
-        ret = []
-        keys_to_set = {}
-
-        for obj_id, obj_key in zip(object_type_ids, keys):
-            if obj_key in res:
-                v = res[obj_key]
-                if v == -1:
-                    ret.append(None)
-                else:
-                    ret.append(v)
-            else:
-                v = calc_func(obj_id)
-                ret.append(v)
-                keys_to_set[obj_key] = -1 if v is None else v
-
-        if keys_to_set:
-            cache.set_many(keys_to_set, timeout=MarketPriceDAO.get_market_dao_cache_timeout())
-        return ret
 
     @staticmethod
-    def calculate_lowest_sell_price(object_type_id, structure):
-        best_order = MarketOrder.objects.filter(
+    def _load_structure_metric(object_type_ids, metric, structure):
+        """
+        Loads a column of values for the structure with a single HMGET. Every miss is computed in a single batch and
+        written back to the hash.
+        :return: list of values, in object_type_ids order
+        """
+        object_type_ids = list(object_type_ids)
+        if not object_type_ids:
+            return []
+
+        conn = get_redis_connection("default")
+        hash_key = MarketPriceDAO._get_structure_hash_key(metric, structure.pk)
+        res = conn.hmget(hash_key, object_type_ids)
+
+        missing_ids = [i for i, v in zip(object_type_ids, res) if v is None]
+        calculated = MarketPriceDAO._calculate_structure_metric(metric, structure, missing_ids) if missing_ids else {}
+        if calculated:
+            MarketPriceDAO._write_hash(conn, hash_key, calculated)
+
+        return [
+            calculated[i] if v is None else json.loads(v)
+            for i, v in zip(object_type_ids, res)
+        ]
+
+    @staticmethod
+    def calculate_lowest_sell_price_multi(object_type_ids, structure):
+        rows = MarketOrder.objects.filter(
             location_id = structure.pk,
-            object_type_id = object_type_id,
+            object_type_id__in = object_type_ids,
             is_buy_order = False,
             order_active = True
-        ).order_by('price').first()
-
-        # get all orders at this price
-
-        if best_order is None:
-            return None
-        else:
-            return best_order.price
+        ).values('object_type_id').annotate(Min('price')).values_list('object_type_id', 'price__min')
+        return dict(rows)
 
     @staticmethod
-    def calculate_lowest_sell_order(object_type_id, structure):
-        best_order = MarketOrder.objects.filter(
+    def calculate_lowest_sell_order_multi(object_type_ids, structure):
+        lowest_prices = MarketPriceDAO.calculate_lowest_sell_price_multi(object_type_ids, structure)
+        if not lowest_prices:
+            return {}
+
+        orders = MarketOrder.objects.filter(
             location_id = structure.pk,
-            object_type_id = object_type_id,
+            object_type_id__in = list(lowest_prices.keys()),
             is_buy_order = False,
             order_active = True
-        ).order_by('price').first()
+        ).values_list('object_type_id', 'price', 'ccp_id')
 
-        if best_order is None:
-            return None
-        else:
-            orders_at_price = MarketOrder.objects.filter(
-                location_id=structure.pk,
-                object_type_id=object_type_id,
-                is_buy_order=False,
-                order_active=True,
-                price=best_order.price
-            ).values_list('ccp_id', flat=True)
-            return list(orders_at_price)
-
-    @staticmethod
-    def calculate_posted_volume(object_type_id, is_buy_order, structure):
-        s = MarketOrder.objects.filter(
+        ret = {}
+        for object_type_id, price, ccp_id in orders:
+            if price == lowest_prices[object_type_id]:
+                ret.setdefault(object_type_id, []).append(ccp_id)
+        return ret
+
+    @staticmethod
+    def calculate_posted_volume_multi(object_type_ids, is_buy_order, structure):
+        rows = MarketOrder.objects.filter(
             location_id = structure.pk,
-            object_type_id = object_type_id,
+            object_type_id__in = object_type_ids,
             is_buy_order = is_buy_order,
             order_active = True
-        ).aggregate(Sum('volume_remain'))
-        return s["volume_remain__sum"]
+        ).values('object_type_id').annotate(Sum('volume_remain')).values_list('object_type_id', 'volume_remain__sum')
+        return dict(rows)
 
     @staticmethod
-    def calculate_avg_velocity_30day(object_type_id, region_id):
-        thiry_ago = (timezone.now() - timedelta(days=30)).date()
-        moved = MarketHistory.objects.filter(
+    def calculate_avg_velocity_30day_multi(object_type_ids, region_id):
+        rows = MarketHistoryRollup.objects.filter(
             region_id = region_id,
-            date__gte=thiry_ago,
-            object_type_id=object_type_id
-        ).aggregate(Sum('volume'))["volume__sum"]
-        moved = 0 if moved is None else moved
-        return float(moved) / 30.0
+            object_type_id__in=object_type_ids
+        ).values_list('object_type_id', 'volume_30')
+        moved = dict(rows)
+        return {
+            i: float(moved.get(i) or 0) / 30.0 for i in object_type_ids
+        }
 
     @staticmethod
-    def calculate_max_sell_30day(object_type_id, region_id):
-        thiry_ago = (timezone.now() - timedelta(days=30)).date()
-        max = MarketHistory.objects.filter(
+    def calculate_max_sell_30day_multi(object_type_ids, region_id):
+        rows = MarketHistoryRollup.objects.filter(
             region_id = region_id,
-            date__gte=thiry_ago,
-            object_type_id=object_type_id
-        ).aggregate(Max('highest'))["highest__max"]
-        max = 0 if max is None else max
-        return max
+            object_type_id__in=object_type_ids
+        ).values_list('object_type_id', 'highest_30')
+        max_prices = dict(rows)
+        return {
+            i: max_prices.get(i) or 0 for i in object_type_ids
+        }
 
     @staticmethod
     def get_lowest_sell_price_multi(object_type_ids, structure):
-        gen_key = lambda i: ("dao_lowest_sell_price_"+str(structure.pk)+"_{}").format(i)
-        gen_value = lambda i: MarketPriceDAO.calculate_lowest_sell_price(structure=structure, object_type_id=i)
-        return MarketPriceDAO._load_cached_range(
-            object_type_ids,
-            gen_key,
-            gen_value
-        )
+        return MarketPriceDAO._load_structure_metric(object_type_ids, "lowest_sell_price", structure)
 
     @staticmethod
     def get_lowest_sell_order_multi(object_type_ids, structure):
-        gen_key = lambda i: ("dao_lowest_sell_order_"+str(structure.pk)+"_{}").format(i)
-        gen_value = lambda i: MarketPriceDAO.calculate_lowest_sell_order(structure=structure, object_type_id=i)
-        return MarketPriceDAO._load_cached_range(
-            object_type_ids,
-            gen_key,
-            gen_value
-        )
+        return MarketPriceDAO._load_structure_metric(object_type_ids, "lowest_sell_order", structure)
 
     @staticmethod
     def get_sell_volume_posted_multi(object_type_ids, structure):
-        gen_key = lambda i:  ("dao_posted_order_volume_"+str(structure.pk)+"_{}").format(i)
-        gen_value = lambda i: MarketPriceDAO.calculate_posted_volume(i, False, structure)
-        return MarketPriceDAO._load_cached_range(
-            object_type_ids,
-            gen_key,
-            gen_value
-        )
+        return MarketPriceDAO._load_structure_metric(object_type_ids, "posted_order_volume", structure)
 
     @staticmethod
     def get_avg_velocity30_multi(object_type_ids, region):
-        gen_key = lambda i: ("dao_velocity_" + str(region.pk) + "_30_{}").format(i)
-        gen_value = lambda i: MarketPriceDAO.calculate_avg_velocity_30day(i, region.pk)
-        return MarketPriceDAO._load_cached_range(
-            object_type_ids,
-            gen_key,
-            gen_value
-        )
+        # the rollup table is already aggregated, no point caching it again
+        object_type_ids = list(object_type_ids)
+        velocity = MarketPriceDAO.calculate_avg_velocity_30day_multi(object_type_ids, region.pk)
+        return [velocity[i] for i in object_type_ids]
 
     @staticmethod
     def get_max_sell30_multi(object_type_ids, region):
-        gen_key = lambda i: ("dao_max_sell_" + str(region.pk) + "_30_{}").format(i)
-        gen_value = lambda i: MarketPriceDAO.calculate_max_sell_30day(i, region.pk)
-        return MarketPriceDAO._load_cached_range(
-            object_type_ids,
-            gen_key,
-            gen_value
-        )
+        object_type_ids = list(object_type_ids)
+        max_prices = MarketPriceDAO.calculate_max_sell_30day_multi(object_type_ids, region.pk)
+        return [max_prices[i] for i in object_type_ids]
 
     @staticmethod
     def get_item_name_multi(object_type_ids, route):
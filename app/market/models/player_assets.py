@@ -1,6 +1,7 @@
 import logging
 import hashlib
 from django.db import models
+from django.core.cache import cache
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType
 
 
@@ -16,6 +17,14 @@ class AssetContainer(models.Model):
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def get_rows(character_id):
+        """
+        :return: dict of ccp_id -> (structure_id, name)
+        """
+        rows = AssetContainer.objects.filter(character_id=character_id).values_list('ccp_id', 'structure_id', 'name')
+        return {r[0]: r[1:] for r in rows}
+
 
 class AssetEntry(models.Model):
     ccp_id = models.BigIntegerField(primary_key=True)
@@ -27,35 +36,37 @@ class AssetEntry(models.Model):
     object_type = models.ForeignKey(ObjectType, on_delete=models.CASCADE)
 
     @staticmethod
-    def generate_hash(character_id):
-        assets_hashable = AssetEntry.objects.filter(character_id=character_id).order_by('ccp_id').values_list('ccp_id', 'object_type_id', 'quantity', 'structure_id', 'container_id')
-        assets_list = [a for a in assets_hashable]
-        # order by ccp_id
-        assets_list = sorted(assets_list, key=lambda a: a[0])
+    def get_digest_cache_key(character_id):
+        return "player_assets_digest_{}".format(character_id)
 
-        algo = hashlib.new('SHA256')
-        algo.update(str(assets_list).encode('utf-8'))
-        hash_hexstr = algo.hexdigest()
-        return hash_hexstr
+    @staticmethod
+    def get_digest_cache_timeout():
+        # a day. bounds how long assets can go unwritten if the rows are changed behind the scan's back
+        return 86400
 
     @staticmethod
-    def generate_has_from_list(assets):
-        assets_hashtable = []
-        for a in assets:
-            assets_hashtable.append(
-                    (
-                        int(a["item_id"]),
-                        int(a["type"].pk),
-                        int(a["quantity"]),
-                        int(a["location"].root_location_id),
-                        None if not a["is_in_container"] else int(a["location"].pk)
-                     )
-                )
-
-        # order by ccp_id
-        assets_list = sorted(assets_hashtable, key=lambda a: a[0])
+    def get_rows(character_id):
+        """
+        :return: dict of ccp_id -> (object_type_id, quantity, structure_id, container_id)
+        """
+        rows = AssetEntry.objects.filter(character_id=character_id).values_list(
+            'ccp_id', 'object_type_id', 'quantity', 'structure_id', 'container_id')
+        return {r[0]: r[1:] for r in rows}
+
+    @staticmethod
+    def generate_digest(container_rows, asset_rows):
+        """
+        Digest of a character's containers and assets, as returned by AssetContainer.get_rows/AssetEntry.get_rows
+        """
         algo = hashlib.new('SHA256')
-        algo.update(str(assets_list).encode('utf-8'))
-        hash_hexstr = algo.hexdigest()
-        return hash_hexstr
+        algo.update(str(sorted(container_rows.items())).encode('utf-8'))
+        algo.update(str(sorted(asset_rows.items())).encode('utf-8'))
+        return algo.hexdigest()
+
+    @staticmethod
+    def get_stored_digest(character_id):
+        return cache.get(AssetEntry.get_digest_cache_key(character_id))
 
+    @staticmethod
+    def store_digest(character_id, digest):
+        cache.set(AssetEntry.get_digest_cache_key(character_id), digest, timeout=AssetEntry.get_digest_cache_timeout())
@@ -4,9 +4,8 @@ from django.db import models, transaction
 from django.db.models import Q
 from django.utils import timezone
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType
-from dataclasses import dataclass
 from django.apps import apps
-from django.core.cache import cache
+from market.utils import bulk_update_fields
 logger=logging.getLogger(__name__)
 
 
@@ -31,14 +30,6 @@ class TransactionLinkage(models.Model):
         return super(TransactionLinkage, self).save(*args, **kwargs)
 
 
-@dataclass
-class TransactionSource:
-    fuzzy: bool
-    unit_price: float
-    total_price: float
-    linkages : list
-
-
 class PlayerTransaction(models.Model):
     ccp_id = models.BigIntegerField(primary_key=True)
     character = models.ForeignKey(EVEPlayerCharacter, on_delete=models.CASCADE)
@@ -60,112 +51,102 @@ class PlayerTransaction(models.Model):
     def __str__(self):
         return "Transaction #{}".format(self.pk)
 
-    @staticmethod
-    def exists(ccp_id):
-        """
-        Cache-backed exists method. Cache only hits for Structures we know exist.
-        :param ccp_id:
-        :return:
-        """
-        exists = cache.get("transaction_exists_%s" % ccp_id)
-        if exists is not None:
-            return True
-        else:
-            exists_db = PlayerTransaction.objects.filter(pk=ccp_id).exists()
-            if exists_db:
-                # after 90 days we DGAF
-                timeout = 86400 * 90
-                cache.set("transaction_exists_%s" % ccp_id, True, timeout=timeout)
-            return exists_db
-
-    def get_source_value(self, quantity, route):
-        if quantity > self.quantity:
-            raise Exception("somethings broken with {}".format(self.pk))
-
-        linkages = TransactionLinkage.objects.filter(Q(destination_transaction=self) & Q(route=route))
-        if not linkages:
-            return None
-
-        ret_links = []
-        quant_accounted = 0
-        sum_of_products = 0
-        for link in linkages:
-            quant_accounted += link.quantity_linked
-            sum_of_products += link.quantity_linked * link.source_transaction.unit_price
-            ret_links.append(link)
-
-        fuzzy = False if quant_accounted == quantity else True
-        unit_price = sum_of_products / quant_accounted
-
-        if fuzzy:
-            sum_of_products = quantity / quant_accounted * sum_of_products
-
-        return TransactionSource(fuzzy, unit_price, sum_of_products, ret_links)
-
-
     class Meta:
         index_together = [
             ["location", "object_type", "character", "timestamp", "is_buy"]
         ]
 
-    def _get_routes_that_apply_to_transaction(self):
+    @staticmethod
+    def link_character_transactions(character):
+        """
+        FIFO links every unlinked sale the character made in one of their routes' destination structures to the buy lots
+        of those routes' source characters. Sales and lots are loaded once, matched in memory (oldest sale first, each
+        eating the oldest lot bought before it), and everything is written back in one transaction. Both sides are row
+        locked, so concurrent workers can't allocate the same lot twice.
+        :return: number of units linked
+        """
         TradingRoute_lazy = apps.get_model('market', 'TradingRoute')
-        routes = TradingRoute_lazy.objects.filter(
-            destination_character = self.character,
-            destination_structure = self.location
-        )
-        return routes
-
-    def link_transactions(self):
-        # todo: LOCK THE SHIT OUT OF THIS
-        routes = self._get_routes_that_apply_to_transaction()
-        older_than = self.timestamp
-
-        new_links = []
-        transactions_to_save = []
-        attributed = 0
+        routes = list(TradingRoute_lazy.objects.filter(destination_character=character).order_by('pk'))
+        if not routes:
+            return 0
 
+        routes_by_structure = {}
         for route in routes:
-            transactions = PlayerTransaction.objects.filter(
-                location=route.source_structure,
-                object_type=self.object_type,
-                character=route.source_character,
-                timestamp__lte=older_than,
+            routes_by_structure.setdefault(route.destination_structure_id, []).append(route)
+
+        with transaction.atomic():
+            sells = list(PlayerTransaction.objects.select_for_update().filter(
+                character=character,
+                location_id__in=list(routes_by_structure.keys()),
+                quantity_without_known_source__gt=0,
+                is_buy=False
+            ).order_by('timestamp', 'ccp_id'))
+            if not sells:
+                return 0
+
+            route_sources = Q()
+            for route in routes:
+                route_sources |= Q(location_id=route.source_structure_id, character_id=route.source_character_id)
+            lots = PlayerTransaction.objects.select_for_update().filter(
+                route_sources,
+                object_type_id__in=set(s.object_type_id for s in sells),
+                timestamp__lte=sells[-1].timestamp,
                 quantity_without_known_destination__gt=0,
-                is_buy=True,
-            ).order_by('timestamp')
-
-            for source_txn in transactions:
-                if source_txn.quantity_without_known_destination >= self.quantity_without_known_source:
-                    contribution = self.quantity_without_known_source
-                else:
-                    contribution = source_txn.quantity_without_known_destination
-
-                self.quantity_without_known_source -= contribution
-                source_txn.quantity_without_known_destination -= contribution
-                attributed += contribution
-
-                link = TransactionLinkage(
-                    source_transaction = source_txn,
-                    destination_transaction = self,
-                    quantity_linked = contribution,
-                    route = route
-                )
-                new_links.append(link)
-                transactions_to_save.append(source_txn)
-
-                if not self.quantity_without_known_source:
-                    break
-
-            if not self.quantity_without_known_source:
-                break
-
-        if transactions_to_save:
-            logger.info("Successfully attributed {} units of transaction {}".format(attributed, self.pk))
-            with transaction.atomic():
-                self.save()
-                for t in transactions_to_save:
-                    t.save()
-
-                TransactionLinkage.objects.bulk_create(new_links)
-
+                is_buy=True
+            ).order_by('timestamp', 'ccp_id')
+
+            # (structure, character, type) -> that source's lots, oldest first
+            lots_by_source = {}
+            for lot in lots:
+                lots_by_source.setdefault((lot.location_id, lot.character_id, lot.object_type_id), []).append(lot)
+            # index of the oldest lot with anything left, per source. lots are always used up front to back.
+            heads = {}
+
+            new_links = []
+            linked_sells = []
+            linked_lots = {}
+            attributed = 0
+
+            for sell in sells:
+                for route in routes_by_structure[sell.location_id]:
+                    key = (route.source_structure_id, route.source_character_id, sell.object_type_id)
+                    source_lots = lots_by_source.get(key)
+                    if not source_lots:
+                        continue
+
+                    i = heads.get(key, 0)
+                    while i < len(source_lots) and sell.quantity_without_known_source:
+                        lot = source_lots[i]
+                        if lot.timestamp > sell.timestamp:
+                            break
+
+                        contribution = min(lot.quantity_without_known_destination, sell.quantity_without_known_source)
+                        sell.quantity_without_known_source -= contribution
+                        lot.quantity_without_known_destination -= contribution
+                        attributed += contribution
+
+                        new_links.append(TransactionLinkage(
+                            source_transaction = lot,
+                            destination_transaction = sell,
+                            quantity_linked = contribution,
+                            route = route
+                        ))
+                        linked_lots[lot.pk] = lot
+
+                        if not lot.quantity_without_known_destination:
+                            i += 1
+                    heads[key] = i
+
+                    if not sell.quantity_without_known_source:
+                        break
+
+                if new_links and new_links[-1].destination_transaction is sell:
+                    linked_sells.append(sell)
+
+            if new_links:
+                TransactionLinkage.objects.bulk_create(new_links, batch_size=1000)
+                bulk_update_fields(PlayerTransaction, linked_sells, ['quantity_without_known_source'])
+                bulk_update_fields(PlayerTransaction, list(linked_lots.values()), ['quantity_without_known_destination'])
+
+        logger.info("Attributed {} units across {} sales for character {}".format(attributed, len(linked_sells), character.pk))
+        return attributed
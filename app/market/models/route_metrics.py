@@ -0,0 +1,165 @@
+import logging
+import numpy as np
+
+from eve_api.models import ObjectType
+from .market_price_dao import MarketPriceDAO, MarketDataType
+
+logger=logging.getLogger(__name__)
+
+
+def _to_array(values):
+    """
+    Converts a DAO column (list with None for missing values) into a float64 array with NaN for missing values.
+    """
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def _to_list(values):
+    """
+    Converts a float64 array back into a JSON friendly list with None for missing values.
+    """
+    return [None if np.isnan(v) else v for v in values.tolist()]
+
+
+def _truthy(values):
+    # mirrors the "if a and b" checks the list based DAO functions use. NaN (None) and 0 are both falsy.
+    return ~np.isnan(values) & (values != 0)
+
+
+BASE_COLUMNS = {
+    "item_volume",
+    MarketDataType.item_name,
+    MarketDataType.item_id,
+    MarketDataType.shopping_list_id,
+    MarketDataType.shopping_list_qty,
+    MarketDataType.dest_volume_posted,
+    MarketDataType.dest_velocity,
+    MarketDataType.dest_lowest_sell,
+    MarketDataType.src_lowest_sell,
+    MarketDataType.dest_max_sell_past_30,
+}
+
+
+class RouteMetrics:
+    """
+    Columnar route metrics engine. Base columns are pulled from the DAO exactly once per instance, and every derived
+    MarketDataType is computed with vectorized operations over those base columns. Columns are memoized, so an
+    intermediate column (cogs, velocity, etc) is only ever computed once no matter how many other columns depend on it.
+
+    Create one instance per request.
+    """
+
+    def __init__(self, route, object_type_ids):
+        self.route = route
+        self.object_type_ids = list(object_type_ids)
+        self._raw = {}
+        self._arrays = {}
+
+    # base columns. these are the only places we touch the DAO/cache.
+
+    def _base_raw(self, name):
+        if name not in self._raw:
+            self._raw[name] = self._load_base(name)
+        return self._raw[name]
+
+    def _load_base(self, name):
+        ids = self.object_type_ids
+        route = self.route
+        if name == "item_volume":
+            return ObjectType.get_cached_item_volumes_multi(ids)
+        if name == MarketDataType.item_name:
+            return MarketPriceDAO.get_item_name_multi(ids, route)
+        if name == MarketDataType.item_id:
+            return MarketPriceDAO.get_item_id_multi(ids, route)
+        if name == MarketDataType.shopping_list_id:
+            return MarketPriceDAO.get_shopping_list_ids_multi(ids, route)
+        if name == MarketDataType.shopping_list_qty:
+            return MarketPriceDAO.get_shopping_list_quantity_multi(ids, route)
+        if name == MarketDataType.dest_volume_posted:
+            return MarketPriceDAO.get_dest_sell_volume_posted_multi(ids, route)
+        if name == MarketDataType.dest_velocity:
+            return MarketPriceDAO.get_dest_velocity_multi(ids, route)
+        if name == MarketDataType.dest_lowest_sell:
+            return MarketPriceDAO.get_dest_lowest_sell_multi(ids, route)
+        if name == MarketDataType.src_lowest_sell:
+            return MarketPriceDAO.get_src_lowest_sell_multi(ids, route)
+        if name == MarketDataType.dest_max_sell_past_30:
+            return MarketPriceDAO.get_dest_max_sell_past_30(ids, route)
+        raise Exception("{} is not a base column".format(name))
+
+    def _base(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = _to_array(self._base_raw(name))
+        return self._arrays[name]
+
+    # derived columns
+
+    def _derive(self, data_type):
+        route = self.route
+
+        if data_type == MarketDataType.freight_cost_total:
+            volume = self._base("item_volume")
+            price = np.nan_to_num(self._base(MarketDataType.src_lowest_sell))
+            return route.cost_per_m3 * volume + (route.pct_collateral/100.0) * price
+
+        if data_type == MarketDataType.listing_cost:
+            price = self._base(MarketDataType.dest_lowest_sell)
+            cost = (route.sales_tax/100.0) * price + (route.broker_fee/100.0) * price
+            return np.where(_truthy(price), cost, np.nan)
+
+        if data_type == MarketDataType.dest_depletion_estimate:
+            velocity = self._base(MarketDataType.dest_velocity)
+            volume = self._base(MarketDataType.dest_volume_posted)
+            has_velocity = _truthy(velocity)
+            depletion = np.divide(volume, velocity, out=np.zeros_like(volume), where=has_velocity & _truthy(volume))
+            return np.where(has_velocity, depletion, np.nan)
+
+        if data_type == MarketDataType.cogs:
+            freight = self.column(MarketDataType.freight_cost_total)
+            listing = self.column(MarketDataType.listing_cost)
+            purchase = self._base(MarketDataType.src_lowest_sell)
+            valid = _truthy(freight) & _truthy(listing) & _truthy(purchase)
+            return np.where(valid, freight + listing + purchase, np.nan)
+
+        if data_type == MarketDataType.unit_profit:
+            cogs = self.column(MarketDataType.cogs)
+            sell = self._base(MarketDataType.dest_lowest_sell)
+            return np.where(_truthy(cogs) & _truthy(sell), sell - cogs, np.nan)
+
+        if data_type == MarketDataType.projected_daily_profit:
+            profit = self.column(MarketDataType.unit_profit)
+            velocity = self._base(MarketDataType.dest_velocity)
+            return np.where(_truthy(profit) & _truthy(velocity), profit * velocity, np.nan)
+
+        if data_type == MarketDataType.capital_efficiency:
+            profit = self.column(MarketDataType.unit_profit)
+            cogs = self.column(MarketDataType.cogs)
+            valid = _truthy(profit) & _truthy(cogs)
+            efficiency = np.divide(100.0 * profit, cogs, out=np.full_like(profit, np.nan), where=valid)
+            return efficiency
+
+        raise Exception("no route metric binding for {}".format(data_type))
+
+    def column(self, data_type):
+        """
+        Returns the given MarketDataType as a float64 array.
+        """
+        if data_type in BASE_COLUMNS:
+            return self._base(data_type)
+        if data_type not in self._arrays:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._arrays[data_type] = self._derive(data_type)
+        return self._arrays[data_type]
+
+    def column_list(self, data_type):
+        """
+        Returns the given MarketDataType as a list, ready to be cached or serialized.
+        Base columns are passed through untouched so non-numeric columns (names, ids) keep their types.
+        """
+        if data_type in BASE_COLUMNS:
+            return self._base_raw(data_type)
+        return _to_list(self.column(data_type))
+
+    def resolve_rows(self, data_types):
+        columns = [self.column_list(t) for t in data_types]
+        return [list(x) for x in zip(*columns)]
@@ -6,7 +6,7 @@ from django.utils import timezone
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType
 from .market_order import MarketOrder
 from .item_group import ItemGroup
-from .player_transaction import PlayerTransaction
+from .lot_index import LotIndex
 
 logger=logging.getLogger(__name__)
 
@@ -70,29 +70,16 @@ class TradingRoute(models.Model):
         #print("tot cost: {}  freight m3 cost: {}  freight collat: {} fees: {}  units: {}".format(item_cost, freight_cost_m3, freight_cost_collat, fees, linkage.quantity_linked))
         return item_cost + freight_cost_collat + freight_cost_m3 + fees
 
-    def estimate_cogs(self, object_type, quantity, unit_sell_price):
-        possible_transactions = PlayerTransaction.objects.filter(
-            character = self.source_character,
-            location = self.source_structure,
-            object_type = object_type,
-            quantity_without_known_destination__gt=0
-        ).order_by('unit_price')
-        quantity_attributed = 0
-        quantity_remaining = quantity
-        value = 0.0
-        for transaction in possible_transactions:
-            if transaction.quantity_without_known_destination == quantity_remaining:
-                q_attribed = quantity_remaining
-            elif transaction.quantity_without_known_destination > quantity_remaining:
-                q_attribed = quantity_remaining
-            else:
-                q_attribed = transaction.quantity_without_known_destination
+    def estimate_cogs(self, object_type, quantity, unit_sell_price, lot_index=None):
+        """
+        :param lot_index: LotIndex of the source character's lots in the source structure. pass one in when estimating
+        many orders, otherwise the type's lots are loaded for this call only.
+        """
+        if lot_index is None:
+            lot_index = LotIndex.load(self.source_character_id, self.source_structure_id, [object_type.pk])
 
-            quantity_attributed += q_attribed
-            quantity_remaining -= q_attribed
-            value += q_attribed * transaction.unit_price
-            if not quantity_remaining:
-                break
+        quantity_attributed, value = lot_index.get_cheapest_cost(object_type.pk, quantity)
+        quantity_remaining = quantity - quantity_attributed
 
         if quantity_remaining:
             # extrapolate for the rest
@@ -0,0 +1,106 @@
+import logging
+import zlib
+from array import array
+from bisect import bisect_left
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger=logging.getLogger(__name__)
+
+# a structure that stops being scanned doesn't need its snapshot kept around. the db can always rebuild it.
+ORDER_BOOK_SNAPSHOT_TIMEOUT = 7 * 86400
+
+# every column is 8 bytes per order
+_COLUMNS = (('order_ids', 'q'), ('prices', 'd'), ('volumes', 'q'), ('type_ids', 'q'))
+
+
+def _snapshot_key(structure_id):
+    # used on the raw redis connection, make_key adds the cache's key prefix
+    return cache.make_key("order_book_snapshot_{}".format(structure_id))
+
+
+class OrderBookSnapshot:
+    """
+    The active orders of one structure as we last wrote them, stored as order id sorted columns. The whole book is a
+    single compressed redis value, so a scan loads it with one round trip and diffs it with a merge join.
+    """
+
+    def __init__(self, order_ids=None, prices=None, volumes=None, type_ids=None):
+        self.order_ids = order_ids if order_ids is not None else array('q')
+        self.prices = prices if prices is not None else array('d')
+        self.volumes = volumes if volumes is not None else array('q')
+        self.type_ids = type_ids if type_ids is not None else array('q')
+
+    @staticmethod
+    def from_rows(rows):
+        """
+        :param rows: iterable of (order_id, price, volume_remain, type_id)
+        """
+        snapshot = OrderBookSnapshot()
+        for order_id, price, volume, type_id in sorted(rows):
+            snapshot.order_ids.append(order_id)
+            snapshot.prices.append(price)
+            snapshot.volumes.append(volume)
+            snapshot.type_ids.append(type_id)
+        return snapshot
+
+    def __len__(self):
+        return len(self.order_ids)
+
+    def __contains__(self, order_id):
+        return self._index(order_id) is not None
+
+    def __iter__(self):
+        return zip(self.order_ids, self.prices, self.volumes, self.type_ids)
+
+    def _index(self, order_id):
+        i = bisect_left(self.order_ids, order_id)
+        if i < len(self.order_ids) and self.order_ids[i] == order_id:
+            return i
+        return None
+
+    def get(self, order_id):
+        """
+        :return: (price, volume_remain, type_id) or None
+        """
+        i = self._index(order_id)
+        if i is None:
+            return None
+        return self.prices[i], self.volumes[i], self.type_ids[i]
+
+    def dumps(self):
+        return zlib.compress(b"".join(getattr(self, name).tobytes() for name, _ in _COLUMNS))
+
+    @staticmethod
+    def loads(data):
+        raw = zlib.decompress(data)
+        width = len(raw) // len(_COLUMNS)
+        columns = {}
+        for i, (name, typecode) in enumerate(_COLUMNS):
+            column = array(typecode)
+            column.frombytes(raw[i * width:(i + 1) * width])
+            columns[name] = column
+        return OrderBookSnapshot(**columns)
+
+
+def load_order_book_snapshot(structure_id):
+    """
+    :return: the structure's stored snapshot, or None if there isn't one
+    """
+    data = get_redis_connection("default").get(_snapshot_key(structure_id))
+    if data is None:
+        return None
+    try:
+        return OrderBookSnapshot.loads(data)
+    except (zlib.error, ValueError) as e:
+        logger.warning("discarding unreadable order book snapshot for structure {}: {}".format(structure_id, e))
+        return None
+
+
+def save_order_book_snapshot(structure_id, snapshot):
+    get_redis_connection("default").set(_snapshot_key(structure_id), snapshot.dumps(), ex=ORDER_BOOK_SNAPSHOT_TIMEOUT)
+
+
+def delete_order_book_snapshot(structure_id):
+    get_redis_connection("default").delete(_snapshot_key(structure_id))
@@ -0,0 +1,104 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger=logging.getLogger(__name__)
+
+
+class ScanType:
+    structure_orders = "structure_orders"
+    region_station_orders = "region_station_orders"
+    player_orders = "player_orders"
+    player_transactions = "player_transactions"
+    player_assets = "player_assets"
+
+
+# keys are used on the raw redis connection, so they go through make_key for the cache's key prefix
+
+def _schedule_key(scan_type):
+    # sorted set of target id -> unix time the target's next scan is due
+    return cache.make_key("esi_scan_schedule_{}".format(scan_type))
+
+
+def _expiry_key(scan_type):
+    # hash of target id -> unix time the target's current ESI data expires
+    return cache.make_key("esi_scan_expires_{}".format(scan_type))
+
+
+def schedule_scan(scan_type, target_id, expires_at=None, fallback=None):
+    """
+    Schedules the next scan of target_id for just after the ESI data we just pulled for it expires.
+    :param expires_at: ESI expiry of that data (see EsiClient.get_last_expiry)
+    :param fallback: timedelta to wait instead when ESI didn't give us a usable expiry
+    """
+    now = time.time()
+    expires = expires_at.timestamp() if expires_at is not None else None
+    if expires is None or expires <= now:
+        expires = now + (fallback.total_seconds() if fallback is not None else 0)
+
+    # ESI's expiries aren't exact, and we don't want every scan of a cache window landing at the same time
+    due = expires + random.uniform(1, settings.ESI_SCAN_JITTER_SECONDS)
+
+    conn = get_redis_connection("default")
+    pipe = conn.pipeline()
+    pipe.zadd(_schedule_key(scan_type), **{str(target_id): due})
+    pipe.hset(_expiry_key(scan_type), target_id, expires)
+    pipe.execute()
+
+
+def seed_scan(scan_type, target_id):
+    """
+    Schedules target_id to be scanned right away, unless it already has a scan scheduled.
+    """
+    conn = get_redis_connection("default")
+    return conn.execute_command("ZADD", _schedule_key(scan_type), "NX", time.time(), target_id)
+
+
+def unschedule_scan(scan_type, target_id):
+    conn = get_redis_connection("default")
+    pipe = conn.pipeline()
+    pipe.zrem(_schedule_key(scan_type), target_id)
+    pipe.hdel(_expiry_key(scan_type), target_id)
+    pipe.execute()
+
+
+def scan_is_due(scan_type, target_id):
+    """
+    :return: False if the ESI data from the last scan of target_id hasn't expired yet
+    """
+    conn = get_redis_connection("default")
+    expires = conn.hget(_expiry_key(scan_type), target_id)
+    return expires is None or float(expires) <= time.time()
+
+
+def get_upcoming_scans(scan_type, within_seconds):
+    """
+    Peeks at the schedule without taking anything off it.
+    :return: list of target ids whose scan is due in the next within_seconds, overdue ones included
+    """
+    conn = get_redis_connection("default")
+    return [int(target_id) for target_id in conn.zrangebyscore(_schedule_key(scan_type), "-inf", time.time() + within_seconds)]
+
+
+def pop_due_scans(scan_type, limit):
+    """
+    Takes up to limit targets whose scan is due off the schedule, oldest first.
+    :return: list of target ids
+    """
+    if limit <= 0:
+        return []
+
+    conn = get_redis_connection("default")
+    key = _schedule_key(scan_type)
+    due = conn.zrangebyscore(key, "-inf", time.time(), start=0, num=limit)
+
+    popped = []
+    for target_id in due:
+        # if another dispatcher already took this target, zrem will tell us
+        if conn.zrem(key, target_id):
+            popped.append(int(target_id))
+    return popped
@@ -0,0 +1,127 @@
+import logging
+from bisect import bisect_left, bisect_right
+
+logger=logging.getLogger(__name__)
+
+
+def table_sort_key(value):
+    # same ordering the DataTables views have always used. missing values sort as 0.
+    if value is None:
+        return 0.0
+    if type(value) is str:
+        return value.lower()
+    return value
+
+
+class TableIndex:
+    """
+    Precomputed, read-only view over a cached table. Built once per process on the first draw, then every draw is
+    answered with binary searches over presorted columns instead of re-sorting the whole table.
+
+    For every column we keep:
+        - the sort permutation (row indexes ordered by that column)
+        - the sorted column keys, for bisecting
+        - each row's rank within that column, so small candidate sets can be re-sorted without touching the keys
+    """
+
+    def __init__(self, rows, name_column=None):
+        self.rows = rows
+        self.name_column = name_column
+        self._built = False
+
+    def __getstate__(self):
+        # only the rows are cached, the sorted columns are about twice their size and cheaper to rebuild than unpickle
+        return {"rows": self.rows, "name_column": self.name_column}
+
+    def __setstate__(self, state):
+        self.__init__(state["rows"], state["name_column"])
+
+    def _ensure_built(self):
+        # built on the first query, so a table that is only patched and cached never pays for it
+        if self._built:
+            return
+        permutations = []
+        sorted_keys = []
+        all_ranks = []
+
+        rows = self.rows
+        column_count = len(rows[0]) if rows else 0
+        for col in range(column_count):
+            keys = [table_sort_key(row[col]) for row in rows]
+            permutation = sorted(range(len(rows)), key=keys.__getitem__)
+            ranks = [0] * len(rows)
+            for rank, row_index in enumerate(permutation):
+                ranks[row_index] = rank
+
+            permutations.append(permutation)
+            sorted_keys.append([keys[i] for i in permutation])
+            all_ranks.append(ranks)
+
+        self._permutations = permutations
+        self._sorted_keys = sorted_keys
+        self._ranks = all_ranks
+        self._built = True
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _prefix_range(self, search_term):
+        keys = self._sorted_keys[self.name_column]
+        prefix = search_term.lower()
+        return bisect_left(keys, prefix), bisect_right(keys, prefix + chr(0x10FFFF))
+
+    def _filter_range(self, col, comparator, amount):
+        keys = self._sorted_keys[col]
+        if comparator == "=":
+            return bisect_left(keys, amount), bisect_right(keys, amount)
+        elif comparator == "<":
+            return 0, bisect_left(keys, amount)
+        elif comparator == ">":
+            return bisect_right(keys, amount), len(keys)
+        elif comparator == ">=":
+            return bisect_left(keys, amount), len(keys)
+        elif comparator == "<=":
+            return 0, bisect_right(keys, amount)
+        raise Exception("unknown comparator {}".format(comparator))
+
+    def query(self, data_length, data_skip, sort_column, sort_descending, filters=None, search_term=None):
+        """
+        :param filters: list of (column_index, comparator, float amount) tuples
+        :param search_term: item name prefix. requires name_column.
+        :return: (page of rows, number of rows matching the filters)
+        """
+        if not self.rows:
+            return [], 0
+        self._ensure_built()
+
+        # every filter/search maps to a contiguous range of one column's permutation
+        ranges = []
+        if search_term is not None and self.name_column is not None:
+            ranges.append((self.name_column,) + self._prefix_range(search_term))
+        for col, comparator, amount in filters or []:
+            ranges.append((col,) + self._filter_range(col, comparator, amount))
+
+        sort_permutation = self._permutations[sort_column]
+
+        if not ranges:
+            filtered_count = len(self.rows)
+            if sort_descending:
+                start = filtered_count - data_skip
+                stop = max(start - data_length, 0)
+                page = [sort_permutation[i] for i in range(start - 1, stop - 1, -1)]
+            else:
+                page = sort_permutation[data_skip:data_skip + data_length]
+            return [self.rows[i] for i in page], filtered_count
+
+        # drive the candidate set from the narrowest range, then check the others by rank
+        ranges.sort(key=lambda r: r[2] - r[1])
+        col, lo, hi = ranges[0]
+        candidates = self._permutations[col][lo:hi]
+        for col, lo, hi in ranges[1:]:
+            ranks = self._ranks[col]
+            candidates = [i for i in candidates if lo <= ranks[i] < hi]
+
+        sort_ranks = self._ranks[sort_column]
+        candidates.sort(key=sort_ranks.__getitem__, reverse=sort_descending)
+        page = candidates[data_skip:data_skip + data_length]
+        return [self.rows[i] for i in page], len(candidates)
@@ -4,6 +4,8 @@ from .market_history import *
 from .player_orders import *
 from .player_transaction import *
 from .player_assets import *
+from .scan_dispatch import *
+from .route_tables import *
 
 
 from conf.huey_queues import general_queue
@@ -1,15 +1,17 @@
-import time, logging
+import time, logging, datetime
 from conf.huey_queues import history_queue
 
 
-import dateutil.parser
 from datetime import timedelta
 
 from eve_api.esi_client import EsiClient
-from market.models import TradingRoute, MarketHistoryScanLog, MarketPriceDAO, MarketHistory
+from eve_api.esi_governor import esi_task
+from market.models import TradingRoute, MarketHistoryScanLog, MarketHistory, MarketHistoryRollup
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType, Region
+from market.utils import bulk_insert_ignore
+from .route_tables import refresh_region_route_tables
 
-import dateutil.parser
+import waffle
 from django.db.models import Q
 from django.db import connection
 from django.utils import timezone
@@ -24,36 +26,20 @@ logger=logging.getLogger(__name__)
 @history_queue.periodic_task(crontab(minute=0, hour=9))
 def enqueue_update_market_history():
     logger.info("LAUNCH_TASK {}".format("enqueue_update_market_history"))
-    # for each region we have trading routes in
-    source_regions = TradingRoute.objects.all().values_list('source_structure__location__region', flat=True)
-    dest_regions = TradingRoute.objects.all().values_list('destination_structure__location__region', flat=True)
-
-    regions = list(set(list(source_regions) + list(dest_regions)))
-    #regions = Region.objects.all().values_list('ccp_id')
+    if waffle.switch_is_active('market-history-all-regions'):
+        regions = list(Region.objects.all().values_list('ccp_id', flat=True))
+    else:
+        # for each region we have trading routes in
+        source_regions = TradingRoute.objects.all().values_list('source_structure__location__region', flat=True)
+        dest_regions = TradingRoute.objects.all().values_list('destination_structure__location__region', flat=True)
+        regions = list(set(list(source_regions) + list(dest_regions)))
 
     logger.info("enqueueing market history updates for {} regions".format(len(regions)))
     for region_id in regions:
         update_region_market_history(region_id)
 
 
-def _get_existing_region_entries(region_id, oldest_entry_days):
-    existing_entries = MarketHistory.objects.filter(
-        region_id=region_id,
-        date__gte=(timezone.now() - timedelta(days=oldest_entry_days)).date()
-        ).values_list('object_type_id', 'date')
-
-    existing_entries_dict = {}
-    for e in existing_entries:
-        obj_id = e[0]
-        entry_date = e[1]
-        if obj_id in existing_entries_dict:
-            existing_entries_dict[obj_id].append(entry_date)
-        else:
-            existing_entries_dict[obj_id] = [entry_date]
-    return existing_entries_dict
-
-
-@history_queue.task()
+@esi_task(history_queue)
 def update_region_market_history(region_id):
     logger.info("LAUNCH_TASK {} {}".format("update_region_market_history", region_id))
     with history_queue.lock_task('update-region-market-history-{}'.format(region_id)):
@@ -68,92 +54,105 @@ def update_region_market_history(region_id):
 
         items = ObjectType.get_all_tradeable_items()
 
-        client = EsiClient(raise_application_errors=False)
+        # types whose history hasn't changed since the last run come back 304 and are never yielded
+        client = EsiClient(raise_application_errors=False, use_etags=True)
         esi_url = "/v1/markets/{}/history/".format(region_id) + "?type_id={}"
 
-        item_histories = client.get_multiple(esi_url, items)
-
-        # check for items removed from the game/trading
-        to_delete = []
-        logger.info("Done pulling item market history, pruning unpublished items")
-        for object_id, h in item_histories.items():
-            if type(h) is dict:
-                if "error" in h:
-                    if h["error"] == 'Type not found!':
-                        ObjectType.verify_object_exists(object_id, force=True)
-                        object = ObjectType.get_object(object_id)
-                        if not object.published or not object.market_group:
-                            to_delete.append(object_id)
-                            logger.info("Setting object_id {} to unpublished".format(object_id))
-                    else:
-                        msg = "receiving unrecognized application error from market query. object id {} error {}".format(object_id, h)
-                        logger.error(msg)
-                        raise Exception(msg)
-                else:
-                    logger.warning("dict-based item history detected {} {}".format(object_id, h))
-
-        for i in to_delete:
-            del item_histories[i]
-
-        logger.info("Done pruneing unpublished items. Yanking existing markethistory entries out of the database")
-        # grab existing entries
-        existing_entries = _get_existing_region_entries(region_id, 30)
-
-        logger.info("Done yanking old data. Building table of new data...")
-        new_entries_to_commit = []
-        new_entry_count = 0
-
-        for object_id, history in item_histories.items():
-            existing = existing_entries[object_id] if object_id in existing_entries else []
-            # only use the last 31 days of history data (ccp sorts for us)
-            history = history[-31:]
-            new_entries = update_market_history_for_item(region_id, object_id, history, existing)
-            new_entries_to_commit.extend(new_entries)
-            new_entry_count += len(new_entries)
-
-            if new_entry_count > 10000:
-                # early commit
-                logger.info("performing early commit of market history data")
-                MarketHistory.objects.bulk_create(new_entries_to_commit)
-                new_entries_to_commit = []
-                new_entry_count = 0
-
-        if new_entry_count > 0:
-            logger.info("performing final market history data commit")
-            MarketHistory.objects.bulk_create(new_entries_to_commit)
-
-        logger.info("done creating history items, purging cache")
-        MarketPriceDAO.purge_region_dao_cache(region_id, items)
+        today = timezone.now().date()
+        oldest = today - timedelta(days=30)
+        # today's history is never pulled, yesterday is the last complete day
+        rollup_update = MarketHistoryRollup.begin_update(region_id, today - timedelta(days=1))
+
+        # history is written in batches as it comes off ESI and folded into the rollups as it's written, only the
+        # current batch is ever held in memory
+        pending = []
+        changed_count = 0
+        inserted_count = 0
+
+        for object_id, history in client.iter_multiple(esi_url, items):
+            changed_count += 1
+            if type(history) is dict:
+                _handle_history_error(object_id, history)
+                continue
+
+            pending.extend(_build_market_history_entries(region_id, object_id, history, today, oldest))
+            if len(pending) >= 10000:
+                inserted_count += _insert_market_history(region_id, pending, oldest, rollup_update)
+                pending = []
+
+        inserted_count += _insert_market_history(region_id, pending, oldest, rollup_update)
+        logger.info("{} of {} item histories changed since the last scan, {} new entries".format(
+            changed_count, len(items), inserted_count))
+
+        logger.info("done creating history items, saving rollups")
+        rollup_update.save()
+        # only once the rollups have this history can it be reported unchanged next time
+        client.commit_etags()
         scan_log.scan_complete = timezone.now()
         scan_log.save()
-        logger.info("market history cache purged. all done")
+        refresh_region_route_tables(region_id)
+        logger.info("market history rollups updated. all done")
+
 
+def _handle_history_error(object_id, history):
+    # check for items removed from the game/trading
+    if "error" not in history:
+        logger.warning("dict-based item history detected {} {}".format(object_id, history))
+        return
 
-def update_market_history_for_item(region_id, object_id, history_entries, existing_entries):
+    if history["error"] == 'Type not found!':
+        ObjectType.verify_object_exists(object_id, force=True)
+        object = ObjectType.get_object(object_id)
+        if not object.published or not object.market_group:
+            logger.info("Setting object_id {} to unpublished".format(object_id))
+    else:
+        msg = "receiving unrecognized application error from market query. object id {} error {}".format(object_id, history)
+        logger.error(msg)
+        raise Exception(msg)
 
-    max_age = timedelta(days=30)
-    today = timezone.now()
+
+def _build_market_history_entries(region_id, object_id, history_entries, today, oldest):
     ret = []
-    for entry in history_entries:
-        # ignore if today's date (gmt)
-        date = dateutil.parser.parse(entry["date"]).date()
-        if today.day == date.day and today.year == date.year and today.month == date.month:
+    # only use the last 31 days of history data (ccp sorts for us)
+    for entry in history_entries[-31:]:
+        date = datetime.date.fromisoformat(entry["date"])
+        # ignore today's entry (gmt), it isn't complete yet
+        if date == today or date < oldest:
             continue
 
-        if date < (today - max_age).date():
-            continue
+        ret.append(MarketHistory(
+            object_type_id = object_id,
+            date = date,
+            average = entry["average"],
+            lowest = entry["lowest"],
+            highest = entry["highest"],
+            order_count = entry["order_count"],
+            volume = entry["volume"],
+            region_id = region_id
+        ))
+    return ret
 
-        if date not in existing_entries:
-            history = MarketHistory(
-                object_type_id = object_id,
-                date = date,
-                average = entry["highest"],
-                lowest = entry["lowest"],
-                highest = entry["highest"],
-                order_count = entry["order_count"],
-                volume = entry["volume"],
-                region_id = region_id
-            )
-            ret.append(history)
 
-    return ret
+def _insert_market_history(region_id, entries, oldest, rollup_update):
+    """
+    Writes the entries that aren't in the db yet and adds them to the rollups.
+    :return: number of entries that were new
+    """
+    if not entries:
+        return 0
+
+    # the rollups need to know exactly which days are new, so look up this batch's existing days. the unique
+    # (region, date, object_type) constraint keeps the insert itself safe either way.
+    existing = set(MarketHistory.objects.filter(
+        region_id=region_id,
+        object_type_id__in={e.object_type_id for e in entries},
+        date__gte=oldest
+    ).values_list('object_type_id', 'date'))
+
+    new_entries = [e for e in entries if (e.object_type_id, e.date) not in existing]
+    # recorded before the insert, so the rollups of these types are fixed up even if we die right after it
+    rollup_update.expect_entries({e.object_type_id for e in new_entries})
+    inserted = bulk_insert_ignore(MarketHistory, new_entries)
+    logger.info("inserted {} market history entries for region {}".format(inserted, region_id))
+    rollup_update.add_entries(new_entries)
+    return len(new_entries)
@@ -14,6 +14,10 @@ from django.db import transaction
 from django.utils import timezone
 
 from .util import get_characters_needing_update
+from market.utils import bulk_update_fields, chunks
+from eve_api.esi_client import EsiClient
+from eve_api.esi_governor import esi_task
+from market.scan_schedule import ScanType, schedule_scan, seed_scan, scan_is_due
 
 logger=logging.getLogger(__name__)
 
@@ -88,14 +92,14 @@ def _split_assets_and_containers(assets):
     return ret_assets, containers
 
 
-def _get_player_assets_and_containers(char):
+def _get_player_assets_and_containers(char, client=None):
     routes = TradingRoute.objects.filter(
         destination_character = char
     )
 
     valid_structures = [route.destination_structure.pk for route in routes]
 
-    unfiltered_assets = get_character_assets(char.pk)
+    unfiltered_assets = get_character_assets(char.pk, client=client)
 
     filtered_assets = _remove_invalid_assets(unfiltered_assets, valid_structures)
 
@@ -116,72 +120,120 @@ def _get_player_assets_and_containers(char):
     return assets, containers
 
 
-@player_queue.task()
+def _build_asset_rows(char, assets, containers):
+    """
+    :return: (container rows, asset rows) keyed by item id, in the shape of AssetContainer.get_rows/AssetEntry.get_rows
+    """
+    # make sure every structure exists, once per structure
+    for structure_id in {a["location"].root_location_id for a in assets + containers}:
+        Structure.get_object(structure_id, char.pk)
+
+    container_rows = {
+        c["item_id"]: (c["location"].root_location_id, c["name"])
+        for c in containers
+    }
+    asset_rows = {
+        a["item_id"]: (
+            a["type"].pk,
+            a["quantity"],
+            a["location"].root_location_id,
+            None if not a["is_in_container"] else a["location"].pk
+        )
+        for a in assets
+    }
+    return container_rows, asset_rows
+
+
+def _diff_rows(existing_rows, new_rows):
+    """
+    :return: (ids to insert, ids to update, ids to delete)
+    """
+    inserted = [i for i in new_rows if i not in existing_rows]
+    changed = [i for i in new_rows if i in existing_rows and existing_rows[i] != new_rows[i]]
+    removed = [i for i in existing_rows if i not in new_rows]
+    return inserted, changed, removed
+
+
+def _write_asset_changes(char, container_rows, asset_rows):
+    """
+    Writes only the rows that differ from what's stored for the character.
+    """
+    container_inserts, container_updates, container_deletes = _diff_rows(AssetContainer.get_rows(char.pk), container_rows)
+    asset_inserts, asset_updates, asset_deletes = _diff_rows(AssetEntry.get_rows(char.pk), asset_rows)
+
+    to_container = lambda i: AssetContainer(
+        ccp_id=i,
+        character_id=char.pk,
+        structure_id=container_rows[i][0],
+        name=container_rows[i][1]
+    )
+    to_asset = lambda i: AssetEntry(
+        ccp_id=i,
+        character_id=char.pk,
+        object_type_id=asset_rows[i][0],
+        quantity=asset_rows[i][1],
+        structure_id=asset_rows[i][2],
+        container_id=asset_rows[i][3]
+    )
+
+    # containers go first and leave last, so assets never point at a missing container and moved assets aren't
+    # cascaded away with their old container
+    AssetContainer.objects.bulk_create([to_container(i) for i in container_inserts], batch_size=1000)
+    bulk_update_fields(AssetContainer, [to_container(i) for i in container_updates], ["structure", "name"])
+
+    AssetEntry.objects.bulk_create([to_asset(i) for i in asset_inserts], batch_size=1000)
+    bulk_update_fields(AssetEntry, [to_asset(i) for i in asset_updates], ["object_type", "quantity", "structure", "container"])
+    for batch in chunks(asset_deletes, 1000):
+        AssetEntry.objects.filter(ccp_id__in=batch).delete()
+
+    for batch in chunks(container_deletes, 1000):
+        AssetContainer.objects.filter(ccp_id__in=batch).delete()
+
+    logger.info("Assets for {}: {} inserted, {} updated, {} removed. Containers: {} inserted, {} updated, {} removed".format(
+        char.pk, len(asset_inserts), len(asset_updates), len(asset_deletes),
+        len(container_inserts), len(container_updates), len(container_deletes)))
+
+
+@esi_task(player_queue)
 def update_player_assets(character_id):
     logger.info("LAUNCH TASK update_player_assets {}".format(character_id))
     with player_queue.lock_task('update-player-assets-{}'.format(character_id)):
         char = EVEPlayerCharacter.get_object(character_id)
 
         # double check to verify we actually need to scan this character right now
-        oldest_allowable_update = timezone.now() - player_assets_timedelta
-        if char.assets_last_updated and char.assets_last_updated > oldest_allowable_update:
+        if not scan_is_due(ScanType.player_assets, character_id):
             logger.warning("{} was queued for assets update quickly over a given interval. killing followup task".format(character_id))
             return
 
         scan_log = PlayerAssetsScanLog.start_scan_log(char)
 
-        assets, containers = _get_player_assets_and_containers(char)
-
-        # extract hashes to figure out current configuration
-        current_assets_hash = AssetEntry.generate_hash(character_id)
-        new_assets_hash = AssetEntry.generate_has_from_list(assets)
-        force = False
+        client = EsiClient(authenticating_character=char)
+        assets, containers = _get_player_assets_and_containers(char, client)
 
-        if new_assets_hash != current_assets_hash or force:
-            logger.info("Assets hash changed for {}, updating assets".format(character_id))
+        container_rows, asset_rows = _build_asset_rows(char, assets, containers)
+        digest = AssetEntry.generate_digest(container_rows, asset_rows)
 
+        if digest != AssetEntry.get_stored_digest(character_id):
+            logger.info("Assets digest changed for {}, updating assets".format(character_id))
             with transaction.atomic():
-                AssetEntry.objects.filter(character_id=character_id).delete()
-                AssetContainer.objects.filter(character_id=character_id).delete()
-
-                container_objs = []
-                asset_objs = []
-
-                for c in containers:
-                    container_objs.append(
-                        AssetContainer(
-                        ccp_id = c["item_id"],
-                        character = char,
-                        structure = Structure.get_object(c["location"].root_location_id, char.pk),
-                        name = c["name"]
-                    ))
-                AssetContainer.objects.bulk_create(container_objs)
-
-                for a in assets:
-                    asset_objs.append(
-                        AssetEntry(
-                            ccp_id=a["item_id"],
-                            character=char,
-                            structure=Structure.get_object(a["location"].root_location_id, char.pk),
-                            container_id = None if not a["is_in_container"] else a["location"].pk,
-                            quantity = a["quantity"],
-                            object_type = a["type"]
-                        )
-                    )
-
-                AssetEntry.objects.bulk_create(asset_objs)
+                _write_asset_changes(char, container_rows, asset_rows)
+            AssetEntry.store_digest(character_id, digest)
 
         char.assets_last_updated = timezone.now()
         char.save()
 
         scan_log.stop_scan_log()
+        schedule_scan(ScanType.player_assets, character_id, client.get_last_expiry(), fallback=player_assets_timedelta)
 
     logger.info("COMPLETE TASK update_player_assets {}".format(character_id))
     return
 
 
-@player_queue.periodic_task(crontab(minute='*/5'))
+@player_queue.periodic_task(crontab(minute='*/15'))
 def enqueue_update_player_assets():
+    """
+    Safety net for the scan schedule. Picks up characters that have never been scanned or fell off the schedule.
+    """
     if waffle.switch_is_active('enable-player-asset-scans'):
         logger.info("LAUNCH_TASK {}".format("enqueue_update_player_assets"))
 
@@ -193,8 +245,8 @@ def enqueue_update_player_assets():
             "esi-assets.read_assets.v1"
         )
 
-        logger.info("enqueueing {} player asset update tasks".format(len(chars_with_valid_update_keys)))
+        logger.info("seeding {} player asset scans".format(len(chars_with_valid_update_keys)))
         for char_id in chars_with_valid_update_keys:
-            update_player_assets(char_id)
+            seed_scan(ScanType.player_assets, char_id)
 
-        logger.info("done enqueueing player asset updates")
+        logger.info("done seeding player asset scans")
@@ -6,11 +6,14 @@ import dateutil.parser
 from datetime import timedelta
 
 from eve_api.esi_client import EsiClient
+from eve_api.esi_governor import esi_task
 from market.models import MarketOrder, PlayerOrderScanLog
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType, EsiKey
 from huey import crontab
 
 from .util import get_characters_needing_update
+from market.scan_schedule import ScanType, schedule_scan, seed_scan, scan_is_due
+from .route_tables import RouteTable, refresh_character_route_tables
 
 from django.db.models import Q
 from django.utils import timezone
@@ -19,8 +22,11 @@ logger=logging.getLogger(__name__)
 
 player_orders_timedelta = timedelta(minutes=20)
 
-@player_queue.periodic_task(crontab(minute='*/5'))
+@player_queue.periodic_task(crontab(minute='*/15'))
 def enqueue_update_player_orders():
+    """
+    Safety net for the scan schedule. Picks up characters that have never been scanned or fell off the schedule.
+    """
     logger.info("LAUNCH_TASK {}".format("enqueue_update_player_orders"))
 
     oldest_allowable_update = timezone.now() - player_orders_timedelta
@@ -31,11 +37,11 @@ def enqueue_update_player_orders():
         "esi-markets.read_character_orders.v1"
     )
 
-    logger.info("enqueueing {} player order update tasks".format(len(chars_with_valid_update_keys)))
+    logger.info("seeding {} player order scans".format(len(chars_with_valid_update_keys)))
     for char_id in chars_with_valid_update_keys:
-        update_player_orders(char_id)
+        seed_scan(ScanType.player_orders, char_id)
 
-    logger.info("done enqueueing market order updates")
+    logger.info("done seeding market order scans")
 
 
 def _create_new_orders(character, orders):
@@ -58,19 +64,16 @@ def _create_new_orders(character, orders):
             ))
 
     MarketOrder.objects.bulk_create(orders_to_commit)
-    # populate cache fields
-    MarketOrder.populate_cache_for_new_objects(orders_to_commit)
-    logger.info("New orders committed & cache populated for character {}".format(character.pk))
+    logger.info("New orders committed for character {}".format(character.pk))
 
 
-@player_queue.task()
+@esi_task(player_queue)
 def update_player_orders(ccp_id):
     logger.info("LAUNCH_TASK {} {}".format("update_player_orders", ccp_id))
     with player_queue.lock_task('update-player-orders-{}'.format(ccp_id)):
         character = EVEPlayerCharacter.get_object(ccp_id)
         # double check to verify we actually need to scan this character right now
-        oldest_allowable_update = timezone.now() - player_orders_timedelta
-        if character.orders_last_updated and character.orders_last_updated > oldest_allowable_update:
+        if not scan_is_due(ScanType.player_orders, ccp_id):
             return
 
         scan_log = PlayerOrderScanLog(character = character)
@@ -88,6 +91,8 @@ def update_player_orders(ccp_id):
         character.save()
         scan_log.scan_complete = timezone.now()
         scan_log.save()
+        refresh_character_route_tables(ccp_id, [RouteTable.orders, RouteTable.transactions])
+        schedule_scan(ScanType.player_orders, ccp_id, client.get_last_expiry(), fallback=player_orders_timedelta)
     # do not create new orders. order discovery only happens when structures are scanned
     #orders_to_create = []
     #for order in orders:
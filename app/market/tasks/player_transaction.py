@@ -5,7 +5,8 @@ import dateutil.parser
 from datetime import timedelta
 
 from eve_api.esi_client import EsiClient
-from market.models import TradingRoute, PlayerTransactionScanLog, PlayerTransaction
+from eve_api.esi_governor import esi_task
+from market.models import PlayerTransactionScanLog, PlayerTransaction
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType
 from huey import crontab
 
@@ -13,13 +14,19 @@ from django.db.models import Q
 from django.utils import timezone
 
 from .util import get_characters_needing_update
+from market.scan_schedule import ScanType, schedule_scan, seed_scan, scan_is_due
+from .route_tables import RouteTable, refresh_character_route_tables
+from market.utils import chunks, bulk_insert_ignore
 
 logger=logging.getLogger(__name__)
 
 player_transactions_timedelta = timedelta(minutes=60)
 
-@player_queue.periodic_task(crontab(minute='*/5'))
+@player_queue.periodic_task(crontab(minute='*/15'))
 def enqueue_update_player_transactions():
+    """
+    Safety net for the scan schedule. Picks up characters that have never been scanned or fell off the schedule.
+    """
     logger.info("LAUNCH_TASK {}".format("enqueue_update_player_transactions"))
 
     oldest_allowable_update = timezone.now() - player_transactions_timedelta
@@ -33,19 +40,29 @@ def enqueue_update_player_transactions():
 
 
 
-    logger.info("enqueueing {} player transaction update tasks".format(len(chars_with_valid_update_keys)))
+    logger.info("seeding {} player transaction scans".format(len(chars_with_valid_update_keys)))
     for char_id in chars_with_valid_update_keys:
-        update_player_transactions(char_id)
+        seed_scan(ScanType.player_transactions, char_id)
 
-    logger.info("done enqueueing market transaction updates")
+    logger.info("done seeding market transaction scans")
 
 
-def _get_transactions(client, character):
-    #oldest_txn=PlayerTransaction.objects.filter(
-    #    character=character
-    #).order_by('ccp_id').\
-    #    values_list('ccp_id', flat=True).\
-    #    first()
+def _get_transactions_cursor(character):
+    if character.transactions_cursor is not None:
+        return character.transactions_cursor
+    # characters scanned before we kept a cursor
+    return PlayerTransaction.objects.filter(
+        character=character
+    ).order_by('-ccp_id').\
+        values_list('ccp_id', flat=True).\
+        first()
+
+
+def _get_transactions(client, character, cursor):
+    """
+    Walks the wallet back from the newest transaction, stopping at the first page that reaches the cursor.
+    :return: transactions newer than cursor
+    """
     oldest_txn = None
 
     transactions=[]
@@ -59,26 +76,38 @@ def _get_transactions(client, character):
             break
 
         oldest_txn=min(raw_txns, key=lambda t: t["transaction_id"])["transaction_id"]
-        transactions.extend(raw_txns)
+        if cursor is None:
+            transactions.extend(raw_txns)
+        else:
+            transactions.extend(t for t in raw_txns if t["transaction_id"] > cursor)
+            if oldest_txn <= cursor:
+                # everything from here back was ingested on an earlier scan
+                break
 
     return transactions
 
 
+def _get_existing_transaction_ids(transaction_ids):
+    existing = set()
+    for batch in chunks(transaction_ids, 10000):
+        existing.update(PlayerTransaction.objects.filter(ccp_id__in=batch).values_list('ccp_id', flat=True))
+    return existing
+
+
 def _verify_transaction_models_exist(transactions, character):
     for transaction in transactions:
         Structure.verify_object_exists(transaction["location_id"], character.pk)
         ObjectType.verify_object_exists(transaction["type_id"])
 
 
-@player_queue.task()
+@esi_task(player_queue)
 def update_player_transactions(ccp_id):
     logger.info("LAUNCH_TASK {} {}".format("update_player_transactions", ccp_id))
     with player_queue.lock_task('update-player-transactions-{}'.format(ccp_id)):
         character = EVEPlayerCharacter.get_object(ccp_id)
 
         # double check to verify we actually need to scan this character right now
-        oldest_allowable_update = timezone.now() - player_transactions_timedelta
-        if character.transactions_last_updated and character.transactions_last_updated > oldest_allowable_update:
+        if not scan_is_due(ScanType.player_transactions, ccp_id):
             logger.warning(
                 "{} was queued for transactions update quickly over a given interval. killing followup task".format(
                     ccp_id))
@@ -89,66 +118,55 @@ def update_player_transactions(ccp_id):
 
         client = EsiClient(authenticating_character=character)
 
-        transactions = _get_transactions(client, character)
+        cursor = _get_transactions_cursor(character)
+        transactions = _get_transactions(client, character, cursor)
+        logger.info("{} transactions newer than cursor {} for {}".format(len(transactions), cursor, ccp_id))
+
+        # dedupe, then drop anything we already have in one query instead of checking every row
+        transactions = list({t["transaction_id"]: t for t in transactions}.values())
+        newest_ids = [t["transaction_id"] for t in transactions] + ([cursor] if cursor is not None else [])
+        existing_ids = _get_existing_transaction_ids([t["transaction_id"] for t in transactions])
+        transactions = [t for t in transactions if t["transaction_id"] not in existing_ids]
 
         _verify_transaction_models_exist(transactions, character)
 
         txn_models = []
-        logger.info("scanning {} transactions for {}".format(len(transactions), ccp_id))
-        transaction_ids_being_added = []
         for t in transactions:
-            # check if t exists
-            exists = PlayerTransaction.exists(t["transaction_id"])
-            if not exists and t["transaction_id"] not in transaction_ids_being_added:
-                transaction_ids_being_added.append(t["transaction_id"])
-                txn_models.append(PlayerTransaction(
-                    character=character,
-                    ccp_id=t["transaction_id"],
-                    client_id=t["client_id"],
-                    timestamp=dateutil.parser.parse(t["date"]),
-                    is_buy=t["is_buy"],
-                    is_personal=t["is_personal"],
-                    journal_ref_id=t["journal_ref_id"],
-                    location_id=t["location_id"],
-                    quantity=t["quantity"],
-                    object_type_id=t["type_id"],
-                    unit_price=t["unit_price"],
-                    quantity_without_known_source=t["quantity"],
-                    quantity_without_known_destination=t["quantity"]
-                ))
-
-        logger.info("creating {} transactions for {}".format(len(txn_models), ccp_id))
-        PlayerTransaction.objects.bulk_create(txn_models)
-
-        trading_routes = TradingRoute.objects.filter(Q(source_character=character) | Q(destination_character=character))
-
-        source_structures = trading_routes.filter(source_character=character).values_list("source_structure_id", flat=True)
-        destination_structures = trading_routes.filter(destination_character=character).values_list("destination_structure_id", flat=True)
-
-        #structure_ids = list(set(source_structures).union(set(destination_structures)))
-        structure_ids = list(set(destination_structures))
-
-        # maybe log n this later? or just remove it and always trigger a scan
-        trigger_transaction_scan = True
-
-        if trigger_transaction_scan:
-            logger.info("trigger transaction scan for {}".format(character.pk))
-            transactions_needing_link = PlayerTransaction.objects.filter(
-                location_id__in=structure_ids,
-                quantity_without_known_source__gt=0,
-                is_buy=False,
-                character = character
-            )
-            logger.info("checking {} transactions for linkages for {}".format(len(transactions_needing_link), character.pk))
-            for t in transactions_needing_link:
-                t.link_transactions()
-            logger.info("Done checking for linkages")
+            txn_models.append(PlayerTransaction(
+                character=character,
+                ccp_id=t["transaction_id"],
+                client_id=t["client_id"],
+                timestamp=dateutil.parser.parse(t["date"]),
+                is_buy=t["is_buy"],
+                is_personal=t["is_personal"],
+                journal_ref_id=t["journal_ref_id"],
+                location_id=t["location_id"],
+                quantity=t["quantity"],
+                object_type_id=t["type_id"],
+                unit_price=t["unit_price"],
+                quantity_without_known_source=t["quantity"],
+                quantity_without_known_destination=t["quantity"]
+            ))
+
+        # a concurrent scan may have beaten us to some of these, so conflicts are skipped rather than raised
+        created = bulk_insert_ignore(PlayerTransaction, txn_models)
+        logger.info("created {} transactions for {}".format(created, ccp_id))
+
+        # everything up to here is in the db now, so the next scan can stop here
+        if newest_ids:
+            character.transactions_cursor = max(newest_ids)
+
+        logger.info("linking transactions for {}".format(character.pk))
+        PlayerTransaction.link_character_transactions(character)
+        logger.info("Done checking for linkages")
 
         character.transactions_last_updated = timezone.now()
         character.save()
 
         scan_log.scan_complete = timezone.now()
         scan_log.save()
+        refresh_character_route_tables(ccp_id, [RouteTable.transactions, RouteTable.profit, RouteTable.orders])
+        schedule_scan(ScanType.player_transactions, ccp_id, client.get_last_expiry(), fallback=player_transactions_timedelta)
 
         # if any new transactions are in a source/dest structure
         # dest_transactions = <>.where destination_quantity_unaccounted != 0
@@ -0,0 +1,329 @@
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.db.models import Q
+from conf.huey_queues import general_queue
+
+from market.models import TradingRoute
+from eve_api.local_cache import LocalCache
+
+logger=logging.getLogger(__name__)
+
+
+class RouteTable:
+    eye_of_krab = "eye_of_krab"
+    orders = "orders"
+    transactions = "transactions"
+    profit = "profit"
+    shopping_list = "shopping_list"
+
+    all_tables = [eye_of_krab, orders, transactions, profit, shopping_list]
+
+    # tables whose snapshot can be patched row by row when only some types changed
+    patchable = [eye_of_krab]
+
+    # tables the views never modify, kept in each process between draws. the others have rows appended to per draw.
+    kept_in_process = [eye_of_krab]
+
+
+# how old a snapshot can get before it's rebuilt, even if nothing triggered a refresh
+ROUTE_TABLE_MAX_AGE_SECONDS = {
+    RouteTable.eye_of_krab: 1200,
+    RouteTable.orders: 300,
+    RouteTable.transactions: 600,
+    RouteTable.profit: 600,
+    RouteTable.shopping_list: 300,
+}
+
+# snapshots of routes nobody looks at expire after a day
+ROUTE_TABLE_SNAPSHOT_TIMEOUT = 86400
+ROUTE_TABLE_BUILD_LOCK_SECONDS = 300
+# how long a request waits on another request's build before building the table itself
+ROUTE_TABLE_BUILD_WAIT_SECONDS = 30
+
+_process_snapshots = LocalCache("route_table_snapshots", max_size=20)
+
+
+def _snapshot_key(route_id, table):
+    return "route_table_{}_{}".format(table, route_id)
+
+
+def _snapshot_header_key(route_id, table):
+    # the snapshot without its data, so a process can tell whether its own copy is current without fetching it
+    return "route_table_header_{}_{}".format(table, route_id)
+
+
+def _generation_key(route_id, table):
+    # bumped every time the data behind the table changes
+    return "route_table_generation_{}_{}".format(table, route_id)
+
+
+def _build_lock_key(route_id, table):
+    return "route_table_building_{}_{}".format(table, route_id)
+
+
+def _queued_key(route_id, table):
+    return "route_table_queued_{}_{}".format(table, route_id)
+
+
+def _dirty_types_key(route_id, table):
+    # set of type ids whose rows changed since the snapshot was built. used on the raw redis connection, so make_key
+    # adds the cache's key prefix
+    return cache.make_key("route_table_dirty_types_{}_{}".format(table, route_id))
+
+
+def _full_rebuild_key(route_id, table):
+    # set when something changed that can't be patched in row by row
+    return "route_table_full_rebuild_{}_{}".format(table, route_id)
+
+
+def _get_generation(route_id, table):
+    return cache.get(_generation_key(route_id, table)) or 0
+
+
+def _build_table(route, table):
+    # the table builders live with their views
+    if table == RouteTable.eye_of_krab:
+        from market.views.eye_of_krab import EyeofKrabData
+        return EyeofKrabData.calculate_table_index(route)
+    if table == RouteTable.orders:
+        from market.views.orders import OrdersData
+        return OrdersData.calculate_table_data(route)
+    if table == RouteTable.transactions:
+        from market.views.transactions import TransactionsData
+        return TransactionsData.calculate_table_data(route)
+    if table == RouteTable.profit:
+        from market.views.profit_tracker import ProfitData
+        return ProfitData.calculate_table_data(route)
+    if table == RouteTable.shopping_list:
+        from market.views.shopping_list import ShoppingListData
+        return ShoppingListData.calculate_table_data(route)
+    raise Exception("unknown route table {}".format(table))
+
+
+def _patch_table(route, table, data, object_type_ids):
+    if table == RouteTable.eye_of_krab:
+        from market.views.eye_of_krab import EyeofKrabData
+        return EyeofKrabData.patch_table_index(route, data, object_type_ids)
+    raise Exception("route table {} can't be patched".format(table))
+
+
+def _take_changes(route_id, table):
+    """
+    :return: (full rebuild needed, set of changed type ids) since the last call
+    """
+    conn = get_redis_connection("default")
+    pipe = conn.pipeline()
+    pipe.smembers(_dirty_types_key(route_id, table))
+    pipe.delete(_dirty_types_key(route_id, table))
+    dirty, _ = pipe.execute()
+
+    full_key = _full_rebuild_key(route_id, table)
+    full = cache.get(full_key) is not None
+    cache.delete(full_key)
+    return full, {int(i) for i in dirty}
+
+
+def _build_snapshot(route, table):
+    """
+    Builds the table and replaces the route's snapshot with it. The caller must hold the build lock.
+    A patchable table only recomputes the rows of the types that changed, as long as its snapshot is recent enough.
+    """
+    # read before building, so a change that lands mid build still marks this snapshot stale
+    generation = _get_generation(route.pk, table)
+    full, dirty = _take_changes(route.pk, table)
+
+    snapshot = None
+    if table in RouteTable.patchable and not full:
+        snapshot = cache.get(_snapshot_key(route.pk, table))
+        if snapshot is not None and time.time() - snapshot["built_at"] > ROUTE_TABLE_MAX_AGE_SECONDS[table]:
+            snapshot = None
+
+    start = time.time()
+    try:
+        if snapshot is not None:
+            data = _patch_table(route, table, snapshot["data"], dirty)
+            built_at = snapshot["built_at"]
+            logger.info("patched {} rows of {} table for route {} in {:.2f}s".format(
+                len(dirty), table, route.pk, time.time() - start))
+        else:
+            data = _build_table(route, table)
+            built_at = time.time()
+            logger.info("built {} table for route {} in {:.2f}s".format(table, route.pk, time.time() - start))
+    except Exception:
+        # the changes we took are lost, make sure the next build starts over
+        cache.set(_full_rebuild_key(route.pk, table), True, timeout=ROUTE_TABLE_SNAPSHOT_TIMEOUT)
+        raise
+
+    header = {
+        "id": uuid.uuid4().hex,
+        "generation": generation,
+        # a patched snapshot keeps the age of its last full build, so it still gets fully rebuilt every so often
+        "built_at": built_at,
+    }
+    snapshot = dict(header, data=data)
+    # data first, so whoever sees the new header finds its data
+    cache.set(_snapshot_key(route.pk, table), snapshot, timeout=ROUTE_TABLE_SNAPSHOT_TIMEOUT)
+    cache.set(_snapshot_header_key(route.pk, table), header, timeout=ROUTE_TABLE_SNAPSHOT_TIMEOUT)
+    return data
+
+
+def _load_snapshot(route_id, table):
+    """
+    :return: the route's current snapshot, or None. Tables kept in process are only fetched from redis when this
+    process doesn't have the current snapshot yet.
+    """
+    if table not in RouteTable.kept_in_process:
+        return cache.get(_snapshot_key(route_id, table))
+
+    header = cache.get(_snapshot_header_key(route_id, table))
+    if header is None:
+        return None
+    local_key = "{}_{}".format(table, route_id)
+    snapshot = _process_snapshots.get(local_key)
+    if snapshot is not None and snapshot["id"] == header["id"]:
+        return snapshot
+
+    snapshot = cache.get(_snapshot_key(route_id, table))
+    if snapshot is not None:
+        _process_snapshots.set(local_key, snapshot)
+    return snapshot
+
+
+def _is_stale(route_id, table, snapshot):
+    if time.time() - snapshot["built_at"] > ROUTE_TABLE_MAX_AGE_SECONDS[table]:
+        return True
+    return snapshot["generation"] < _get_generation(route_id, table)
+
+
+def get_route_table(route, table):
+    """
+    Returns the route's most recent table. A stale table is still returned while a fresh one is built in the
+    background. Only a route without any table waits for one to be built, and then only one request builds it.
+    """
+    snapshot = _load_snapshot(route.pk, table)
+    if snapshot is not None:
+        if _is_stale(route.pk, table, snapshot):
+            request_route_table_refresh(route.pk, table, changed=False)
+        return snapshot["data"]
+
+    lock_key = _build_lock_key(route.pk, table)
+    deadline = time.monotonic() + ROUTE_TABLE_BUILD_WAIT_SECONDS
+    while True:
+        if cache.add(lock_key, True, timeout=ROUTE_TABLE_BUILD_LOCK_SECONDS):
+            try:
+                return _build_snapshot(route, table)
+            finally:
+                cache.delete(lock_key)
+
+        time.sleep(0.2)
+        snapshot = _load_snapshot(route.pk, table)
+        if snapshot is not None:
+            return snapshot["data"]
+        if time.monotonic() > deadline:
+            logger.warning("gave up waiting on the {} table build for route {}".format(table, route.pk))
+            return _build_table(route, table)
+
+
+def request_route_table_refresh(route_id, table, changed=True, object_type_ids=None):
+    """
+    Queues a background rebuild of the table, unless one is already queued.
+    :param changed: the data behind the table changed, so the current snapshot is out of date
+    :param object_type_ids: if only these types' data changed, patchable tables just recompute their rows
+    """
+    if changed:
+        if object_type_ids is not None and table in RouteTable.patchable:
+            if not object_type_ids:
+                return
+            conn = get_redis_connection("default")
+            pipe = conn.pipeline()
+            pipe.sadd(_dirty_types_key(route_id, table), *object_type_ids)
+            pipe.expire(_dirty_types_key(route_id, table), ROUTE_TABLE_SNAPSHOT_TIMEOUT)
+            pipe.execute()
+        else:
+            cache.set(_full_rebuild_key(route_id, table), True, timeout=ROUTE_TABLE_SNAPSHOT_TIMEOUT)
+
+        generation_key = _generation_key(route_id, table)
+        cache.add(generation_key, 0, timeout=None)
+        cache.incr(generation_key)
+
+    if cache.add(_queued_key(route_id, table), True, timeout=ROUTE_TABLE_BUILD_LOCK_SECONDS):
+        refresh_route_table(str(route_id), table)
+
+
+def invalidate_route_tables(route_id, tables=RouteTable.all_tables):
+    """
+    Drops the route's snapshots and forces a full rebuild, for changes the user expects to see on their next page load (route settings,
+    shopping list edits).
+    """
+    cache.delete_many([_snapshot_header_key(route_id, t) for t in tables] + [_snapshot_key(route_id, t) for t in tables])
+    for table in tables:
+        request_route_table_refresh(route_id, table)
+
+
+def _refresh_routes(routes, tables):
+    route_ids = list(routes.values_list('pk', flat=True))
+    for route_id in route_ids:
+        for table in tables:
+            request_route_table_refresh(route_id, table)
+    return len(route_ids)
+
+
+def refresh_structure_route_tables(structure_id, object_type_ids):
+    """
+    Call after a structure's orders were updated.
+    :param object_type_ids: types whose orders changed
+    """
+    if not object_type_ids:
+        return
+    object_type_ids = list(object_type_ids)
+
+    routes = TradingRoute.objects.filter(Q(source_structure_id=structure_id) | Q(destination_structure_id=structure_id))
+    route_ids = list(routes.values_list('pk', flat=True))
+    for route_id in route_ids:
+        request_route_table_refresh(route_id, RouteTable.eye_of_krab, object_type_ids=object_type_ids)
+        for table in [RouteTable.orders, RouteTable.transactions, RouteTable.shopping_list]:
+            request_route_table_refresh(route_id, table)
+    logger.info("queued table refreshes for {} routes through structure {}, {} types changed".format(
+        len(route_ids), structure_id, len(object_type_ids)))
+
+
+def refresh_region_route_tables(region_id):
+    """
+    Call after a region's market history was updated.
+    """
+    routes = TradingRoute.objects.filter(destination_structure__location__region_id=region_id)
+    count = _refresh_routes(routes, [RouteTable.eye_of_krab])
+    logger.info("queued table refreshes for {} routes into region {}".format(count, region_id))
+
+
+def refresh_character_route_tables(character_id, tables):
+    """
+    Call after a character's transactions or orders were updated.
+    """
+    routes = TradingRoute.objects.filter(Q(source_character_id=character_id) | Q(destination_character_id=character_id))
+    count = _refresh_routes(routes, tables)
+    logger.info("queued table refreshes for {} routes of character {}".format(count, character_id))
+
+
+@general_queue.task()
+def refresh_route_table(route_id, table):
+    lock_key = _build_lock_key(route_id, table)
+    if not cache.add(lock_key, True, timeout=ROUTE_TABLE_BUILD_LOCK_SECONDS):
+        # the build in progress may have started before the change that queued us. go again once it's done.
+        refresh_route_table.schedule(args=(route_id, table), delay=5)
+        return
+
+    try:
+        # anything that changes from here on needs another build
+        cache.delete(_queued_key(route_id, table))
+        try:
+            route = TradingRoute.objects.get(pk=route_id)
+        except TradingRoute.DoesNotExist:
+            return
+        _build_snapshot(route, table)
+    finally:
+        cache.delete(lock_key)
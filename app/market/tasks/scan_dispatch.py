@@ -0,0 +1,72 @@
+import logging
+from conf.huey_queues import general_queue, player_queue
+
+import waffle
+from huey import crontab
+from django.conf import settings
+
+from eve_api.esi_tokens import prewarm_access_token
+from market.scan_schedule import ScanType, pop_due_scans, get_upcoming_scans
+from .structure_orders import dispatch_due_structure_scans, get_structure_scan_characters
+from .player_orders import update_player_orders
+from .player_transaction import update_player_transactions
+from .player_assets import update_player_assets
+
+logger=logging.getLogger(__name__)
+
+
+def _queue_room(queue):
+    # how many more tasks we're willing to pile onto this queue right now
+    return max(settings.ESI_SCAN_QUEUE_CAPS[queue.name] - queue.pending_count(), 0)
+
+
+def _player_scans():
+    scans = [
+        (ScanType.player_orders, update_player_orders),
+        (ScanType.player_transactions, update_player_transactions),
+    ]
+    if waffle.switch_is_active('enable-player-asset-scans'):
+        scans.append((ScanType.player_assets, update_player_assets))
+    return scans
+
+
+@general_queue.periodic_task(crontab(minute='*'))
+def dispatch_due_scans():
+    """
+    Enqueues every scan whose ESI data has expired, without letting any queue back up past its cap. Anything over the
+    cap stays on the schedule and goes out on the next tick.
+    """
+    logger.info("LAUNCH_TASK {}".format("dispatch_due_scans"))
+
+    enqueued = dispatch_due_structure_scans(_queue_room(general_queue))
+    logger.info("{} structure order scans dispatched".format(enqueued))
+
+    room = _queue_room(player_queue)
+    for scan_type, task in _player_scans():
+        character_ids = pop_due_scans(scan_type, room)
+        for character_id in character_ids:
+            task(character_id)
+        room -= len(character_ids)
+        logger.info("{} {} scans dispatched".format(len(character_ids), scan_type))
+
+
+@general_queue.periodic_task(crontab(minute='*'))
+def prewarm_scan_access_tokens():
+    """
+    Refreshes the access tokens of characters with a scan coming up, so the scans themselves never wait on SSO.
+    """
+    window = settings.ESI_TOKEN_PREWARM_SECONDS
+    character_ids = set()
+    for scan_type, _ in _player_scans():
+        character_ids.update(get_upcoming_scans(scan_type, window))
+    character_ids.update(get_structure_scan_characters(get_upcoming_scans(ScanType.structure_orders, window)))
+
+    refreshed = 0
+    for character_id in character_ids:
+        try:
+            if prewarm_access_token(character_id, window):
+                refreshed += 1
+        except Exception as e:
+            # the scan will run into the same problem and deal with it, revoked keys included
+            logger.warning("failed to prewarm access token for character {}: {}".format(character_id, e))
+    logger.info("{} of {} upcoming scan access tokens refreshed".format(refreshed, len(character_ids)))
@@ -5,20 +5,30 @@ from conf.huey_queues import general_queue
 import dateutil.parser
 from datetime import timedelta
 
-from eve_api.esi_client import EsiClient
+from eve_api.esi_client import EsiClient, EsiNotModified
+from eve_api.esi_governor import esi_task
+from eve_api.esi_exceptions import EsiCacheSwitchover, EsiThrottled
 from .util import get_structures_we_have_keys_for
 from market.models import TradingRoute, MarketOrder, MarketPriceDAO, StructureMarketScanLog
 from eve_api.models import Structure, EVEPlayerCharacter, ObjectType
 from huey import crontab
+from huey.exceptions import TaskLockedException
 from django.conf import settings
 
 from django.db.models import Q
 from django.utils import timezone
+from django.core.cache import cache
 
-from django.db import transaction
+from market.utils import chunks, bulk_update_fields
+from market.order_book_snapshot import OrderBookSnapshot, load_order_book_snapshot, save_order_book_snapshot, \
+    delete_order_book_snapshot
+from market.scan_schedule import ScanType, schedule_scan, seed_scan, scan_is_due, pop_due_scans, unschedule_scan
+from .route_tables import refresh_structure_route_tables
 
 logger=logging.getLogger(__name__)
 
+# how long to wait between scans when ESI doesn't tell us when the market data expires
+structure_orders_timedelta = timedelta(minutes=5)
 
 def _get_key_for_structure(structure_id):
     all_source_chars =  TradingRoute.objects.filter(
@@ -39,206 +49,333 @@ def _get_key_for_structure(structure_id):
         yield EVEPlayerCharacter.get_object(char)
 
 
+def get_structure_scan_characters(structure_ids):
+    """
+    :return: ids of every character whose key can be used to scan the given structures
+    """
+    source_chars = TradingRoute.objects.filter(
+        source_character_has_access=True,
+        source_structure_id__in=structure_ids
+    ).values_list('source_character', flat=True)
+    dest_chars = TradingRoute.objects.filter(
+        destination_character_has_access=True,
+        destination_structure_id__in=structure_ids
+    ).values_list('destination_character', flat=True)
+    return set(source_chars) | set(dest_chars)
+
+
+def _summarize_order_page(page):
+    # stored with each page's etag, so we know which orders are sitting on a page ESI tells us hasn't changed
+    return [(order["order_id"], order["location_id"]) for order in page]
+
+
+def _download_order_pages(client, endpoint_url, stages=None, etag_scope=None):
+    """
+    Downloads an order book using conditional requests.
+    :return: (orders on pages that changed, (order_id, location_id) of every order on pages that didn't)
+    """
+    while True:
+        try:
+            orders = []
+            unchanged_orders = []
+            for page in client.iter_multiple_paginated(endpoint_url, stages=stages,
+                                                       summarize=_summarize_order_page, etag_scope=etag_scope):
+                if isinstance(page, EsiNotModified):
+                    unchanged_orders.extend(page.summary)
+                else:
+                    orders.extend(page)
+            return orders, unchanged_orders
+        except EsiCacheSwitchover:
+            logger.warning("Restarting order download {}".format(endpoint_url))
+            client.discard_etags()
+
+
 def _get_station_orders(station_id):
-    client = EsiClient()
+    client = EsiClient(use_etags=True)
     station = Structure.get_object(station_id, origin_character_id=None)
 
-    results = client.get_multiple_paginated("/v1/markets/"+str(station.location.region.pk)+"/orders/")
+    # filter out orders not in our target station as each page arrives, so we never hold the whole region in memory
+    in_station = lambda page: [order for order in page if order["location_id"] == station_id]
 
-    # filter out orders not in our target station
-    filtered_orders = []
-    for order in results:
-        if order["location_id"] == station_id:
-            filtered_orders.append(order)
-    return filtered_orders
+    orders, unchanged_orders = _download_order_pages(
+        client,
+        "/v1/markets/"+str(station.location.region.pk)+"/orders/",
+        stages=[in_station],
+        etag_scope=station_id
+    )
+    return orders, [order_id for order_id, _ in unchanged_orders], client
 
 
 def _get_citadel_orders(structure_id, auth_char):
-    client = EsiClient(authenticating_character=auth_char)
-    results = client.get_multiple_paginated("/v1/markets/structures/"+str(structure_id)+"/")
-    return results
+    client = EsiClient(authenticating_character=auth_char, use_etags=True)
+    orders, unchanged_orders = _download_order_pages(client, "/v1/markets/structures/"+str(structure_id)+"/")
+    return orders, [order_id for order_id, _ in unchanged_orders], client
 
 
-def _get_orders(structure_id, auth_character):
-    if structure_id >= 60000000 and structure_id <= 61000000:
-        return _get_station_orders(structure_id)
-    else:
-        return _get_citadel_orders(structure_id, auth_character)
+def _is_npc_station(structure_id):
+    return structure_id >= 60000000 and structure_id <= 61000000
 
 
-def _prune_dead_database_orders(structure_id, orders):
-    # extract order_id from orders
-    order_ids = [o["order_id"] for o in orders]
+def _get_region_station_orders(region_id, station_ids):
+    """
+    Downloads a region's order book once and splits it up by station.
+    :return: (dict of station_id -> orders, dict of station_id -> order ids on unchanged pages,
+              expiry of the regional book, client to commit etags with)
+    """
+    client = EsiClient(use_etags=True)
+    station_ids = set(station_ids)
 
-    dead_orders = MarketOrder.objects.filter(location_id=structure_id, order_active=True).exclude(ccp_id__in=order_ids)
+    # drop orders in stations we don't track as each page arrives
+    in_tracked_stations = lambda page: [order for order in page if order["location_id"] in station_ids]
 
-    # we have to grab this stuff before we set order_active=False
-    object_ids_impacted = set()
-    dead_order_object_ids = dead_orders.values_list('object_type_id', flat=True)
-    object_ids_impacted.update(dead_order_object_ids)
+    orders, unchanged_orders = _download_order_pages(
+        client,
+        "/v1/markets/"+str(region_id)+"/orders/",
+        stages=[in_tracked_stations],
+        etag_scope=",".join(str(s) for s in sorted(station_ids))
+    )
 
-    logger.info("{} dead orders pruned".format(dead_orders.count()))
-    dead_orders.update(order_active=False)
-    # dead_orders is empty after this. do not use it. funny side effect from using .update instead of .save
+    orders_by_station = {station_id: [] for station_id in station_ids}
+    for order in orders:
+        orders_by_station[order["location_id"]].append(order)
+    unchanged_by_station = {station_id: [] for station_id in station_ids}
+    for order_id, station_id in unchanged_orders:
+        unchanged_by_station[station_id].append(order_id)
+    return orders_by_station, unchanged_by_station, client.get_last_expiry(), client
 
-    return list(object_ids_impacted)
 
+def _get_scan_target(structure_id):
+    # npc stations are scanned a whole region at a time
+    if _is_npc_station(structure_id):
+        return ScanType.region_station_orders, Structure.get_object(structure_id, None).location.region_id
+    return ScanType.structure_orders, structure_id
 
-def _insert_bulk_orders(orders):
-    MarketOrder.objects.bulk_create(orders)
-    # populate cache fields
-    MarketOrder.populate_cache_for_new_objects(orders)
 
+def _is_scan_due(structure_id, scan_type, target_id):
+    if scan_is_due(scan_type, target_id):
+        return True
+    # the region's book may be current, but a station that was added since has never had its orders pulled from it
+    return scan_type == ScanType.region_station_orders and Structure.get_object(structure_id, None).market_last_updated is None
 
-def _insert_new_db_orders(structure_id, orders):
-    orders_to_create = []
-    total_ctr = 0
-    group_ctr = 0
 
-    order_ids = [o["order_id"] for o in orders]
+def _get_orders(structure_id, auth_character):
+    """
+    :return: (orders on changed pages, order ids on unchanged pages, client to commit etags with)
+    """
+    if _is_npc_station(structure_id):
+        return _get_station_orders(structure_id)
+    else:
+        return _get_citadel_orders(structure_id, auth_character)
 
-    logger.info("Processing {} orders retreived from ESI".format(len(order_ids)))
 
-    already_existing_orders = \
-        set(
-            MarketOrder.objects.filter(
-                location_id=structure_id,
-                order_active=True,
-                ccp_id__in=order_ids
-            ).values_list('ccp_id', flat=True)
-        )
+def _load_order_snapshot(structure_id):
+    """
+    Snapshot of every active order in the structure, as written by the last scan. Rebuilt from the db if the stored one
+    is missing.
+    :return: OrderBookSnapshot
+    """
+    snapshot = load_order_book_snapshot(structure_id)
+    if snapshot is not None:
+        return snapshot
+
+    logger.info("no order book snapshot for structure {}, loading it from the db".format(structure_id))
+    rows = MarketOrder.objects.filter(
+        location_id=structure_id,
+        order_active=True
+    ).values_list('ccp_id', 'price', 'volume_remain', 'object_type_id')
+    return OrderBookSnapshot.from_rows(rows)
+
+
+def _diff_orders(snapshot, orders, unchanged_order_ids=()):
+    """
+    Merge join of the ESI order book against the snapshot, both ordered by order id. Orders on pages ESI reported as
+    unchanged are alive and identical to what we wrote last time, so they are only counted as seen.
+    :return: (orders we don't have active, orders whose price/volume changed, order_ids that are no longer on market)
+    """
+    new_orders = {}
+    changed_orders = []
+    dead_order_ids = []
+    unchanged = set(unchanged_order_ids)
+
+    snapshot_ids = snapshot.order_ids
+    i, snapshot_len = 0, len(snapshot_ids)
+    last_order_id = None
+    for order in sorted(orders, key=lambda o: o["order_id"]):
+        order_id = order["order_id"]
+        # ESI repeats orders that move between pages mid download
+        if order_id == last_order_id or order_id in unchanged:
+            continue
+        last_order_id = order_id
+
+        while i < snapshot_len and snapshot_ids[i] < order_id:
+            if snapshot_ids[i] not in unchanged:
+                dead_order_ids.append(snapshot_ids[i])
+            i += 1
+
+        if i < snapshot_len and snapshot_ids[i] == order_id:
+            if snapshot.prices[i] != order["price"] or snapshot.volumes[i] != order["volume_remain"]:
+                changed_orders.append(order)
+            i += 1
+        else:
+            new_orders[order_id] = order
+
+    dead_order_ids.extend(order_id for order_id in snapshot_ids[i:] if order_id not in unchanged)
+    return new_orders, changed_orders, dead_order_ids
+
+
+def _build_next_snapshot(snapshot, orders, unchanged_order_ids, reactivated_rows):
+    """
+    The structure's order book once this scan's changes are written, without reading it back from the db.
+    :param reactivated_rows: (order_id, price, volume_remain, type_id) of unchanged orders the snapshot didn't have
+    """
+    rows = {}
+    for order in orders:
+        rows[order["order_id"]] = (order["order_id"], order["price"], order["volume_remain"], order["type_id"])
+    for order_id in unchanged_order_ids:
+        stored = snapshot.get(order_id)
+        if stored is not None:
+            rows[order_id] = (order_id,) + stored
+    for row in reactivated_rows:
+        rows[row[0]] = row
+    return OrderBookSnapshot.from_rows(rows.values())
+
+
+def _build_order(order):
+    return MarketOrder(
+        ccp_id = order["order_id"],
+        duration = order["duration"],
+        is_buy_order = order["is_buy_order"],
+        issued = dateutil.parser.parse(order["issued"]),
+        location = Structure.get_object(order["location_id"], None),
+        min_volume = order["min_volume"],
+        price = order["price"],
+        range = order["range"],
+        object_type = ObjectType.get_object(order["type_id"]),
+        volume_remain = order["volume_remain"],
+        volume_total = order["volume_total"]
+    )
 
-    orders_to_add = set(order_ids).difference(already_existing_orders)
 
-    # check for orders that were falsely inactivated
-    orders_to_reactivate = \
-        MarketOrder.objects.filter(
-            location_id=structure_id,
-            order_active=False,
-            ccp_id__in=orders_to_add
+def _insert_new_db_orders(new_orders):
+    # orders can be falsely inactivated (bad esi page, etc). those need reactivating, not inserting.
+    orders_to_reactivate = set()
+    for order_ids in chunks(list(new_orders.keys()), 10000):
+        orders_to_reactivate.update(
+            MarketOrder.objects.filter(ccp_id__in=order_ids).values_list('ccp_id', flat=True)
         )
 
-    # this is what gets returned
-    object_ids_updated = set()
-
     if orders_to_reactivate:
         logger.info("{} orders were set to inactive that are actually still alive. Reactivating.".format(len(orders_to_reactivate)))
-
-        orders_to_add = orders_to_add.difference(orders_to_reactivate.values_list('ccp_id', flat=True))
-
-        # save all the object_ids impacted by reactivation
-        object_ids_reactivated = orders_to_reactivate.values_list('object_type_id', flat=True)
-        object_ids_updated.update(object_ids_reactivated)
-
-
-        orders_to_reactivate.update(order_active=True)
-        # do not use this variable again, .update vs .save shennagians
-
-    for order in orders:
-        if order["order_id"] in orders_to_add:
-            # save object_id impacted by new order
-            object_ids_updated.add(order["type_id"])
-
-            # create order
-            o = MarketOrder(
-                ccp_id = order["order_id"],
-                duration = order["duration"],
-                is_buy_order = order["is_buy_order"],
-                issued = dateutil.parser.parse(order["issued"]),
-                location = Structure.get_object(order["location_id"], None),
-                min_volume = order["min_volume"],
+        reactivated = []
+        for order_id in orders_to_reactivate:
+            order = new_orders[order_id]
+            reactivated.append(MarketOrder(
+                ccp_id = order_id,
+                order_active = True,
                 price = order["price"],
-                range = order["range"],
-                object_type = ObjectType.get_object(order["type_id"]),
                 volume_remain = order["volume_remain"],
-                volume_total = order["volume_total"]
-            )
-            orders_to_create.append(o)
-            total_ctr += 1
-            group_ctr += 1
-
-            if group_ctr >= 10000:
-                logger.info("10000 objects to be committed, running bulk create early")
-                _insert_bulk_orders(orders_to_create)
-                logger.info("commit completed")
-                group_ctr = 0
-                orders_to_create = []
-
-    if group_ctr:
-        _insert_bulk_orders(orders_to_create)
-
-    logger.info("{} new market orders inserted into db".format(total_ctr))
-    return list(object_ids_updated)
-
-
-def _update_db_order_details(orders):
-    counter = 0
-    orders_to_modify = {}
-
-    logger.info("Trying to grab order prices & volume from cache")
-    prices, volumes = MarketOrder.get_order_prices_and_volume(orders)
-    logger.info("Prices & volumes loaded, figuring out what needs updating...")
-
-    for order in orders:
-        stored_price = prices[order["order_id"]]
-        stored_vol_remain = volumes[order["order_id"]]
-
-        if stored_price != order["price"] or stored_vol_remain != order["volume_remain"]:
-            orders_to_modify[order["order_id"]] = order
-
-    order_objects_to_modify = MarketOrder.objects.filter(ccp_id__in = orders_to_modify.keys())
-
-    # this is what we're returning
-    modified_object_ids = set()
-
-    logger.info("Beginning massive transaction to update order details")
-    with transaction.atomic():
-        for order_obj in order_objects_to_modify:
-            order_data = orders_to_modify[order_obj.pk]
-            modified_object_ids.add(order_data["type_id"])
-
-            order_obj.price = order_data["price"]
-            order_obj.volume_remain = order_data["volume_remain"]
-            order_obj.issued = dateutil.parser.parse(order_data["issued"])
-            order_obj.save()
-            counter += 1
-    logger.info("{} market orders had their details updated".format(counter))
-    return list(modified_object_ids)
-
-
-def _update_orders_database(structure_id, orders):
-    object_ids_updated = []
-    # create new orders we dont have in the db
-    object_ids_updated.extend(_insert_new_db_orders(structure_id, orders))
-
-    # prune orders that arent around anymore
-    object_ids_updated.extend(_prune_dead_database_orders(structure_id, orders))
+                issued = dateutil.parser.parse(order["issued"])
+            ))
+        bulk_update_fields(MarketOrder, reactivated, ['order_active', 'price', 'volume_remain', 'issued'])
+
+    orders_to_create = [_build_order(o) for order_id, o in new_orders.items() if order_id not in orders_to_reactivate]
+    for batch in chunks(orders_to_create, 10000):
+        MarketOrder.objects.bulk_create(batch)
+    logger.info("{} new market orders inserted into db".format(len(orders_to_create)))
+
+
+def _prune_dead_database_orders(dead_order_ids):
+    for order_ids in chunks(dead_order_ids, 10000):
+        MarketOrder.objects.filter(ccp_id__in=order_ids).update(order_active=False)
+    logger.info("{} dead orders pruned".format(len(dead_order_ids)))
+
+
+def _update_db_order_details(changed_orders):
+    order_objs = [
+        MarketOrder(
+            ccp_id = order["order_id"],
+            price = order["price"],
+            volume_remain = order["volume_remain"],
+            issued = dateutil.parser.parse(order["issued"])
+        ) for order in changed_orders
+    ]
+    bulk_update_fields(MarketOrder, order_objs, ['price', 'volume_remain', 'issued'])
+    logger.info("{} market orders had their details updated".format(len(order_objs)))
+
+
+def _reactivate_unchanged_orders(order_ids):
+    """
+    Orders on unchanged pages were written by the run that stored the page's etag. If anything has since marked them
+    inactive they just need switching back on, their details are still current.
+    :return: (order_id, price, volume_remain, type_id) of the reactivated orders
+    """
+    rows = []
+    for batch in chunks(order_ids, 10000):
+        rows.extend(MarketOrder.objects.filter(ccp_id__in=batch).values_list('ccp_id', 'price', 'volume_remain', 'object_type_id'))
+        MarketOrder.objects.filter(ccp_id__in=batch).update(order_active=True)
+    if order_ids:
+        logger.info("{} orders on unchanged pages were reactivated".format(len(order_ids)))
+    return rows
+
+
+def _update_orders_database(structure_id, orders, unchanged_order_ids=()):
+    logger.info("Processing {} orders retreived from ESI, {} more on unchanged pages".format(len(orders), len(unchanged_order_ids)))
+    snapshot = _load_order_snapshot(structure_id)
+    new_orders, changed_orders, dead_order_ids = _diff_orders(snapshot, orders, unchanged_order_ids)
+    inactive_unchanged_ids = [order_id for order_id in set(unchanged_order_ids) if order_id not in snapshot]
+    logger.info("structure {} diff: {} new, {} changed, {} dead".format(
+        structure_id, len(new_orders), len(changed_orders), len(dead_order_ids)))
+
+    try:
+        _insert_new_db_orders(new_orders)
+        _prune_dead_database_orders(dead_order_ids)
+        _update_db_order_details(changed_orders)
+        reactivated_rows = _reactivate_unchanged_orders(inactive_unchanged_ids)
+    except Exception:
+        # the db is somewhere between the old book and the new one. the next scan diffs against the db instead.
+        delete_order_book_snapshot(structure_id)
+        raise
+    save_order_book_snapshot(
+        structure_id,
+        _build_next_snapshot(snapshot, orders, unchanged_order_ids, reactivated_rows)
+    )
 
-    # update orders whose volume_remain has changed
-    # update orders whose price has changed
-    object_ids_updated.extend(_update_db_order_details(orders))
+    object_ids_updated = set(o["type_id"] for o in new_orders.values())
+    object_ids_updated.update(o["type_id"] for o in changed_orders)
+    object_ids_updated.update(snapshot.get(order_id)[2] for order_id in dead_order_ids)
+    object_ids_updated.update(row[3] for row in reactivated_rows)
 
-    # purge dao of object_ids_updated
-    object_ids_updated = set(object_ids_updated)
+    # purge dao of object_ids_updated. an empty purge would reheat every item, so skip it when nothing changed
     logger.info("total of {} object types need cache purged for structure {}".format(len(object_ids_updated), structure_id))
-    MarketPriceDAO.purge_structure_price_cache(structure_id, object_ids_updated)
+    if object_ids_updated:
+        MarketPriceDAO.purge_structure_price_cache(structure_id, object_ids_updated)
+    # the dao is hot again, route tables can pick up the changed rows
+    refresh_structure_route_tables(structure_id, object_ids_updated)
 
 
-@general_queue.task()
+@esi_task(general_queue)
 def update_structure_orders(structure_id):
     with general_queue.lock_task('update-structure-orders-{}'.format(structure_id)):
         logger.info("LAUNCH_TASK {} {}".format("update_structure_orders", structure_id))
+        scan_type, target_id = _get_scan_target(structure_id)
+        if not _is_scan_due(structure_id, scan_type, target_id):
+            logger.info("market data for structure {} hasn't expired yet, skipping scan".format(structure_id))
+            return
+
         structure = Structure.get_object(structure_id, None)
         scan_log = StructureMarketScanLog(structure = structure)
         scan_log.save()
 
         key_gen = _get_key_for_structure(structure_id)
 
-        orders = []
+        orders, unchanged_order_ids, client = [], [], None
         for character in key_gen:
             try:
-                orders = _get_orders(structure_id, character)
+                orders, unchanged_order_ids, client = _get_orders(structure_id, character)
                 break
+            except EsiThrottled:
+                # another character's key won't help, the whole task goes back on the queue
+                raise
             except Exception as e:
                 # generic catch all because there's so many things that can go wrong
                 logger.warning("Failed to retrieve market data for {} using character {}. Error: {}".format(structure_id, character, e))
@@ -248,15 +385,83 @@ def update_structure_orders(structure_id):
         logger.info("orders downloaded successfully for structure {}".format(structure_id))
 
         # update db
-        _update_orders_database(structure_id,orders)
-        logger.info("done updating structure {} orders".format(structure_id))
-        s = Structure.get_object(structure_id, None)
-        s.market_last_updated = timezone.now()
-
-        s.market_data_expires = timezone.now() + timedelta(minutes=5)
-        s.save()
-        scan_log.scan_complete = timezone.now()
-        scan_log.save()
+        _update_orders_database(structure_id, orders, unchanged_order_ids)
+        if client is not None:
+            # only now that the orders are in the db can these pages be reported as unchanged next time
+            client.commit_etags()
+
+        expires = client.get_last_expiry() if client is not None else None
+        if expires is None or expires <= timezone.now():
+            expires = timezone.now() + structure_orders_timedelta
+        _complete_structure_update(structure_id, scan_log, expires)
+        schedule_scan(scan_type, target_id, expires)
+
+
+def _complete_structure_update(structure_id, scan_log, market_data_expires):
+    logger.info("done updating structure {} orders".format(structure_id))
+    # not get_object(), the locally cached instance is shared with every thread in the process
+    s = Structure.objects.get(ccp_id=structure_id)
+    s.market_last_updated = timezone.now()
+
+    s.market_data_expires = market_data_expires
+    s.save()
+    scan_log.scan_complete = timezone.now()
+    scan_log.save()
+
+
+@esi_task(general_queue)
+def update_region_station_orders(region_id, station_ids):
+    """
+    Updates every tracked NPC station in a region off of a single download of the region's order book.
+    """
+    with general_queue.lock_task('update-region-station-orders-{}'.format(region_id)):
+        logger.info("LAUNCH_TASK {} {} {}".format("update_region_station_orders", region_id, station_ids))
+
+        # the regional book only changes once per ESI cache window. if another task already pulled this window's book,
+        # the stations it covered are already up to date.
+        window_expires = cache.get("region_station_orders_expires_{}".format(region_id))
+        if window_expires and window_expires > timezone.now():
+            station_ids = list(
+                Structure.objects.filter(
+                    Q(ccp_id__in=station_ids) &
+                    (Q(market_last_updated__isnull=True) | Q(market_data_expires__lte=timezone.now()))
+                ).values_list('ccp_id', flat=True)
+            )
+            if not station_ids:
+                logger.info("region {} order book already processed for this cache window".format(region_id))
+                schedule_scan(ScanType.region_station_orders, region_id, window_expires)
+                return
+
+        scan_logs = {}
+        for station_id in station_ids:
+            scan_logs[station_id] = StructureMarketScanLog(structure=Structure.get_object(station_id, None))
+            scan_logs[station_id].save()
+
+        orders_by_station, unchanged_by_station, expires, client = _get_region_station_orders(region_id, station_ids)
+        logger.info("region {} orders downloaded successfully for {} stations".format(region_id, len(station_ids)))
+        if expires is None or expires <= timezone.now():
+            expires = timezone.now() + structure_orders_timedelta
+
+        all_stations_updated = True
+        for station_id, orders in orders_by_station.items():
+            try:
+                with general_queue.lock_task('update-structure-orders-{}'.format(station_id)):
+                    _update_orders_database(station_id, orders, unchanged_by_station[station_id])
+                    _complete_structure_update(station_id, scan_logs[station_id], expires)
+            except TaskLockedException:
+                logger.warning("station {} is already being updated, skipping it for region {}".format(station_id, region_id))
+                all_stations_updated = False
+
+        # a skipped station never got this download's orders, so its pages can't be reported unchanged next time
+        if all_stations_updated:
+            client.commit_etags()
+
+        cache.set(
+            "region_station_orders_expires_{}".format(region_id),
+            expires,
+            timeout=max(int((expires - timezone.now()).total_seconds()), 1)
+        )
+        schedule_scan(ScanType.region_station_orders, region_id, expires)
 
 
 def _get_out_of_date_structures():
@@ -268,17 +473,59 @@ def _get_out_of_date_structures():
     )
 
 
-@general_queue.periodic_task(crontab(minute='*/5'))
+def _get_tracked_stations_by_region(structures_with_keys):
+    station_regions = {}
+    for s in structures_with_keys:
+        if _is_npc_station(s):
+            region_id = Structure.get_object(s, None).location.region_id
+            station_regions.setdefault(region_id, []).append(s)
+    return station_regions
+
+
+@general_queue.periodic_task(crontab(minute='*/15'))
 def enqueue_update_structure_orders():
+    """
+    Safety net for the scan schedule. Scans normally reschedule themselves for when their ESI data expires, this only
+    picks up structures that have never been scanned or have fallen off the schedule.
+    """
     logger.info("LAUNCH_TASK {}".format("enqueue_update_structure_orders"))
     out_of_date_structures = _get_out_of_date_structures()
     structures_with_keys = get_structures_we_have_keys_for()
 
     structures_to_update = list(out_of_date_structures.intersection(structures_with_keys))
 
+    seeded = 0
+    for s in structures_to_update:
+        if seed_scan(*_get_scan_target(s)):
+            seeded += 1
+    logger.info("{} of {} out of date structures were missing from the scan schedule".format(seeded, len(structures_to_update)))
 
-    logger.info("{} structures queued for order updating".format(len(structures_to_update)))
 
-    for s in structures_to_update:
-        f = update_structure_orders.s(s)
-        general_queue.enqueue(f)
\ No newline at end of file
+def dispatch_due_structure_scans(limit):
+    """
+    Enqueues up to limit structure and npc region order scans whose market data has expired.
+    :return: number of tasks enqueued
+    """
+    structures_with_keys = get_structures_we_have_keys_for()
+    enqueued = 0
+
+    for structure_id in pop_due_scans(ScanType.structure_orders, limit):
+        if structure_id not in structures_with_keys:
+            logger.info("lost access to structure {}, removing it from the scan schedule".format(structure_id))
+            unschedule_scan(ScanType.structure_orders, structure_id)
+            continue
+        general_queue.enqueue(update_structure_orders.s(structure_id))
+        enqueued += 1
+
+    region_ids = pop_due_scans(ScanType.region_station_orders, limit - enqueued)
+    if region_ids:
+        station_regions = _get_tracked_stations_by_region(structures_with_keys)
+        for region_id in region_ids:
+            if region_id not in station_regions:
+                logger.info("no tracked stations left in region {}, removing it from the scan schedule".format(region_id))
+                unschedule_scan(ScanType.region_station_orders, region_id)
+                continue
+            general_queue.enqueue(update_region_station_orders.s(region_id, station_regions[region_id]))
+            enqueued += 1
+
+    return enqueued
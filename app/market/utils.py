@@ -1,8 +1,76 @@
 import logging
 from django.core.cache import cache
+from django.db import connection
+from django.db.models import Case, When, Value, AutoField
 logger=logging.getLogger(__name__)
 
 
+def chunks(l, n):
+    """Yield successive n-sized chunks from l."""
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def bulk_update_fields(model, objects, fields, batch_size=1000):
+    """
+    Django 2.1 doesn't have QuerySet.bulk_update, so this does the same thing: one
+    UPDATE ... SET col = CASE pk WHEN .. THEN .. END WHERE pk IN (..) per batch of objects.
+    Objects don't need to be loaded from the db, they only need their pk and the given fields set.
+    Does not fire save signals.
+    :param model: model class
+    :param objects: model instances
+    :param fields: names of the fields to write
+    :return: number of rows updated
+    """
+    objects = list(objects)
+    pk_name = model._meta.pk.name
+    model_fields = [model._meta.get_field(f) for f in fields]
+    updated = 0
+
+    for batch in chunks(objects, batch_size):
+        updates = {}
+        for field in model_fields:
+            whens = [
+                When(pk=o.pk, then=Value(getattr(o, field.attname), output_field=field))
+                for o in batch
+            ]
+            updates[field.attname] = Case(*whens, output_field=field)
+        updated += model.objects.filter(**{pk_name + "__in": [o.pk for o in batch]}).update(**updates)
+    return updated
+
+
+def bulk_insert_ignore(model, objects, batch_size=1000):
+    """
+    bulk_create that silently skips rows whose primary or unique key already exists. Django 2.1's bulk_create has no
+    ignore_conflicts, so this writes INSERT IGNORE (mysql) / INSERT ... ON CONFLICT DO NOTHING (everything else).
+    Auto primary keys are left to the db and are not set on the objects. Does not fire save signals.
+    :return: number of rows inserted
+    """
+    objects = list(objects)
+    if not objects:
+        return 0
+
+    fields = [f for f in model._meta.concrete_fields if not isinstance(f, AutoField)]
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+    row_placeholder = "({})".format(", ".join(["%s"] * len(fields)))
+    table = connection.ops.quote_name(model._meta.db_table)
+
+    if connection.vendor == "mysql":
+        statement = "INSERT IGNORE INTO {} ({}) VALUES {}"
+    else:
+        statement = "INSERT INTO {} ({}) VALUES {} ON CONFLICT DO NOTHING"
+
+    inserted = 0
+    with connection.cursor() as cursor:
+        for batch in chunks(objects, batch_size):
+            params = []
+            for o in batch:
+                params.extend(f.get_db_prep_save(f.pre_save(o, True), connection) for f in fields)
+            cursor.execute(statement.format(table, columns, ", ".join([row_placeholder] * len(batch))), params)
+            inserted += cursor.rowcount
+    return inserted
+
+
 def get_cached_column(
         cache_key,
         primary_key,
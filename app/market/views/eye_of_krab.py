@@ -1,6 +1,5 @@
 from django.views.generic import TemplateView, FormView, View
 from django.http import JsonResponse
-from django.core.cache import cache
 from django.views.generic.detail import SingleObjectMixin
 from django.urls import reverse_lazy
 from django.contrib import messages
@@ -11,8 +10,12 @@ import json
 
 from market.models import TradingRoute, MarketPriceDAO, ShoppingListItem
 from market.models.market_price_dao import MarketDataType
+from market.models.route_metrics import RouteMetrics
+from market.table_index import TableIndex
+from market.tasks.route_tables import RouteTable, get_route_table
 
 from eve_api.models import ObjectType
+from eve_api.local_cache import LocalCache
 
 import logging
 from dataclasses import dataclass
@@ -21,6 +24,8 @@ from braces.views import LoginRequiredMixin
 
 logger=logging.getLogger(__name__)
 
+demo_index_cache = LocalCache("eye_demo_index", max_size=1, ttl_seconds=86400)
+
 
 
 
@@ -122,15 +127,9 @@ def resolve_fields(route, fields, object_type):
 
 
 def resolve_columns(route, fields, object_types):
-    ret = []
-
-    func_lu = MarketPriceDAO.get_multi_bindings()
     object_type_ids = [o.pk for o in object_types]
-    for field in fields:
-        values = func_lu[field.field_type](object_type_ids, route)
-        ret.append(values)
-
-    return [list(x) for x in zip(*ret)]
+    metrics = RouteMetrics(route, object_type_ids)
+    return metrics.resolve_rows([field.field_type for field in fields])
 
 
 class JSONResponseMixin:
@@ -150,100 +149,83 @@ class EyeofKrabData(JSONResponseMixin, TemplateView):
         return self.render_to_json_response(context, **response_kwargs)
 
     @staticmethod
-    def filter_table(search_term, filter_params, items):
+    def build_table_filters(filter_params):
         # build quick lookup for column indexes
         col_lu = [t.field_type for t in table_fields]
 
-        if search_term is not None:
-            search_filtered = []
-            name_index = col_lu.index(MarketDataType.item_name)
-            for i in items:
-                if i[name_index].lower().startswith(search_term.lower()):
-                    search_filtered.append(i)
-            items = search_filtered
-
-        # for each filter type, apply filter
+        filters = []
         for coltype, param in filter_params.items():
             if not param["comparator"] or param["amount"] is None or param["amount"]=="":
                 continue
-            else:
-                col_index = col_lu.index(coltype)
-
-                # sort data before clipping
-                def sort_key(i):
-                    if i[col_index] is None:
-                        return 0.0
-                    if type(i[col_index]) is str:
-                        return i[col_index].lower()
-                    return i[col_index]
-
-                items = sorted(items, key=sort_key)
-                cmp_value = float(param["amount"])
-
-                if param["comparator"] == "=":
-                    items = [item for item in items if (item[col_index] if item[col_index] else 0) == cmp_value]
-                elif param["comparator"] == "<":
-                    items = [item for item in items if (item[col_index] if item[col_index] else 0) < cmp_value]
-                elif param["comparator"] == ">":
-                    items = [item for item in items if (item[col_index] if item[col_index] else 0) > cmp_value]
-                elif param["comparator"] == ">=":
-                    items = [item for item in items if (item[col_index] if item[col_index] else 0) >= cmp_value]
-                elif param["comparator"] == "<=":
-                    items = [item for item in items if (item[col_index] if item[col_index] else 0) <= cmp_value]
-        return items
+            filters.append((col_lu.index(coltype), param["comparator"], float(param["amount"])))
+        return filters
 
     @staticmethod
-    def get_table_data(route, table_fields, data_length, data_skip, sort_column, sort_direction, filter_params, search_term):
+    def get_table_index(route, table_fields):
+        name_column = [t.field_type for t in table_fields].index(MarketDataType.item_name)
         if route is None:
-            # demo mode
-            items = cache.get("cached_eye_demo_data")
-            if not items:
+            # demo mode. the demo data never changes, each process reads it once.
+            index = demo_index_cache.get("eye_demo")
+            if not index:
                 f = open(settings.DEMO_FILE_LOCATION + "eye_demo_data.json", "r")
                 items = json.loads(f.read())
                 f.close()
-                cache.set("cached_eye_demo_data", items, 86400)
+                index = TableIndex(items, name_column)
+                demo_index_cache.set("eye_demo", index)
         else:
-            items_list = route.items
-            items = cache.get("cached_eye_of_krab_route_{}".format(route.pk))
-            #i_str = str(items)
-            #logger.info("data blob rows :{}".format(len(items)))
-            #logger.info("data blob size: {}".format(len(i_str)))
-            if not items:
-                logger.info("Calculating eye of krab data")
-                items = resolve_columns(route, table_fields, items_list)
-                logger.info("Eye of krab data calculated")
-                timeout = 1200 if settings.DEBUG else 1200
-                cache.set("cached_eye_of_krab_route_{}".format(route.pk), items, timeout=timeout)
-                logger.info("Cache set for eye of krab data")
-
-        # apply filtering
-        total_item_count = len(items)
-        items = EyeofKrabData.filter_table(search_term, filter_params, items)
-
-        sort_direction_bool = False if sort_direction == "asc" else True
-
-        def sort_key(i):
-            if i[sort_column] is None:
-                return 0.0
-            if type(i[sort_column]) is str:
-                return i[sort_column].lower()
-            return i[sort_column]
-
-        sorted_items = sorted(items, key=sort_key, reverse=sort_direction_bool)
-
-        sliced_items = sorted_items[data_skip:data_length+data_skip]
+            index = get_route_table(route, RouteTable.eye_of_krab)
+        return index
+
+    @staticmethod
+    def calculate_table_index(route):
+        name_column = [t.field_type for t in table_fields].index(MarketDataType.item_name)
+        logger.info("Calculating eye of krab data")
+        items = resolve_columns(route, table_fields, route.items)
+        logger.info("Eye of krab data calculated, building table index")
+        return TableIndex(items, name_column)
+
+    @staticmethod
+    def patch_table_index(route, index, object_type_ids):
+        """
+        Recomputes only the rows of the given types and rebuilds the index around them.
+        """
+        item_id_column = [t.field_type for t in table_fields].index(MarketDataType.item_id)
+        on_route = set(row[item_id_column] for row in index.rows)
+        object_type_ids = [i for i in object_type_ids if i in on_route]
+        if not object_type_ids:
+            return index
+
+        metrics = RouteMetrics(route, object_type_ids)
+        patched = dict(zip(object_type_ids, metrics.resolve_rows([field.field_type for field in table_fields])))
+        rows = [patched.get(row[item_id_column], row) for row in index.rows]
+        return TableIndex(rows, index.name_column)
+
+    @staticmethod
+    def get_table_data(route, table_fields, data_length, data_skip, sort_column, sort_direction, filter_params, search_term):
+        index = EyeofKrabData.get_table_index(route, table_fields)
+
+        total_item_count = len(index)
+        sliced_items, filtered_count = index.query(
+            data_length,
+            data_skip,
+            sort_column,
+            False if sort_direction == "asc" else True,
+            filters=EyeofKrabData.build_table_filters(filter_params),
+            search_term=search_term
+        )
 
         # append shopping list quantities
         # assume object_id_col (hard code)
         object_id_col = 12
         shopping_lookup = ShoppingListItem.get_route_shopping_lookup(route)
+        ret = []
         for row in sliced_items:
             obj_id = row[object_id_col]
             val = shopping_lookup[obj_id].quantity if obj_id in shopping_lookup else 0
-            row.append(val)
-
+            # rows belong to the cached index, don't modify them in place
+            ret.append(row + [val])
 
-        return sliced_items, total_item_count, len(items)
+        return ret, total_item_count, filtered_count
 
     def get_context_data(self, **kwargs):
         demo = False
@@ -8,6 +8,8 @@ from django.conf import settings
 
 from market.models import TradingRoute, MarketPriceDAO, PlayerTransaction, MarketOrder, ShoppingListItem
 from market.models.market_price_dao import MarketDataType
+from market.models.lot_index import LotIndex
+from market.tasks.route_tables import RouteTable, get_route_table
 from market.forms import TradingRouteForm
 
 from eve_api.models import ObjectType
@@ -49,10 +51,12 @@ class OrdersData(JSONResponseMixin, TemplateView):
             is_buy_order=False,
             location=dest_structure,
             order_active=True
-        ).order_by('object_type__name')
+        ).select_related('object_type').order_by('object_type__name')
 
         data = []
         order_type_ids = [o.object_type_id for o in orders]
+        # every order's breakeven comes out of the same lots, load them once
+        lot_index = LotIndex.load(route.source_character_id, route.source_structure_id, set(order_type_ids))
         lowest_sell_prices = MarketPriceDAO.get_dest_lowest_sell_multi(order_type_ids, route)
         lowest_order_ids = MarketPriceDAO.get_dest_lowest_order_multi(order_type_ids, route)
         lowest_src_sell_price = MarketPriceDAO.get_src_lowest_sell_multi(order_type_ids, route)
@@ -70,7 +74,7 @@ class OrdersData(JSONResponseMixin, TemplateView):
                 is_lowest = False
 
             # get breakeven
-            breakeven_for_order = route.estimate_cogs(order.object_type, q_remain, order.price)
+            breakeven_for_order = route.estimate_cogs(order.object_type, q_remain, order.price, lot_index)
             unit_breakeven = breakeven_for_order / q_remain if breakeven_for_order else None
             data.append(
                 [
@@ -100,11 +104,7 @@ class OrdersData(JSONResponseMixin, TemplateView):
                 f.close()
                 cache.set("orders_demo_data", items, 86400)
         else:
-            items = cache.get("acached_orders_table_{}".format(route.pk))
-            if not items:
-                items = OrdersData.calculate_table_data(route)
-                timeout = 5 if settings.DEBUG else 5
-                cache.set("acached_orders_table_{}".format(route.pk), items, timeout=timeout)
+            items = get_route_table(route, RouteTable.orders)
 
 
         sort_direction_bool = False if sort_direction == "asc" else True
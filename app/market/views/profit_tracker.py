@@ -7,16 +7,18 @@ from django.contrib import messages
 from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
+from django.db.models import Sum, F, FloatField, ExpressionWrapper
+import numpy as np
 
 from market.models import TradingRoute, MarketPriceDAO, PlayerTransaction, MarketOrder, TransactionLinkage
 from market.models.market_price_dao import MarketDataType
+from market.tasks.route_tables import RouteTable, get_route_table
 from market.forms import TradingRouteForm
 
 from eve_api.models import ObjectType
 import json
 import logging
 from enum import Enum
-from dataclasses import dataclass
 
 from braces.views import LoginRequiredMixin
 
@@ -43,46 +45,49 @@ class ProfitData(JSONResponseMixin, TemplateView):
     def calculate_table_data(route):
         thirty_ago = timezone.now() - timedelta(days=30)
 
-        links = TransactionLinkage.objects.filter(route=route, date_linked__gte=thirty_ago)
-
-        object_types = links.values_list('source_transaction__object_type', flat=True).distinct()
-
-        object_type_lookup = {}
-
-        @dataclass
-        class ObjectProfitData:
-            obj_type: ObjectType
-            qty_sold: int
-            qty_purchased: int
-            qty_on_market: int
-            total_profit: float
-
-        for o in object_types:
-            object_type_lookup[o] = ObjectProfitData(ObjectType.get_object(o),0,0,0,0.0)
-
-        for link in links:
-            obj_type = link.source_transaction.object_type
-            data = object_type_lookup[obj_type.ccp_id]
-            data.qty_sold += link.quantity_linked
-            data.qty_purchased += link.quantity_linked
-
-            cogs = route.calculate_cogs_from_linkage(link)
-            #print("cogs from sale of {} is {} ea {} units with sell price of {}".format(obj_type, cogs/link.quantity_linked, link.quantity_linked, link.destination_transaction.unit_price))
-            revenue = link.quantity_linked * link.destination_transaction.unit_price
-            profit = revenue - cogs
-            data.total_profit += profit
+        # one row per type: units sold, sum(qty * sell price) and sum(qty * purchase price) over the route's linkages
+        rows = TransactionLinkage.objects.filter(
+            route=route,
+            date_linked__gte=thirty_ago
+        ).values('source_transaction__object_type').annotate(
+            qty_sold=Sum('quantity_linked'),
+            revenue=Sum(ExpressionWrapper(
+                F('quantity_linked') * F('destination_transaction__unit_price'),
+                output_field=FloatField()
+            )),
+            item_cost=Sum(ExpressionWrapper(
+                F('quantity_linked') * F('source_transaction__unit_price'),
+                output_field=FloatField()
+            ))
+        ).values_list('source_transaction__object_type', 'qty_sold', 'revenue', 'item_cost')
+        rows = list(rows)
+        if not rows:
+            return []
+
+        object_type_ids = [r[0] for r in rows]
+        qty_sold = np.array([r[1] for r in rows], dtype=np.float64)
+        revenue = np.array([r[2] for r in rows], dtype=np.float64)
+        item_cost = np.array([r[3] for r in rows], dtype=np.float64)
+        volumes = np.array(ObjectType.get_cached_item_volumes_multi(object_type_ids), dtype=np.float64)
+
+        # TradingRoute.calculate_cogs_from_linkage, summed over every linkage of a type
+        freight_m3 = volumes * qty_sold * float(route.cost_per_m3)
+        freight_collat = item_cost * route.pct_collateral / 100
+        fees = (route.broker_fee + route.sales_tax) / 100.0 * revenue
+        total_profit = revenue - (item_cost + freight_collat + freight_m3 + fees)
 
         # convert to the format we send to client
+        names = ObjectType.get_cached_item_names_multi(object_type_ids)
         ret = []
-        for data in object_type_lookup.values():
+        for name, qty, profit in zip(names, qty_sold.tolist(), total_profit.tolist()):
             ret.append([
-                data.obj_type.name,
+                name,
                 #data.qty_purchased,
-                data.qty_sold,
+                int(qty),
                 #data.qty_on_market,
-                data.qty_sold / 30.0,
-                data.total_profit / data.qty_sold,
-                data.total_profit
+                qty / 30.0,
+                profit / qty,
+                profit
             ])
         return ret
 
@@ -98,12 +103,7 @@ class ProfitData(JSONResponseMixin, TemplateView):
                 f.close()
                 cache.set("profit_tracker_demo_data", items, 86400)
         else:
-
-            items = cache.get("cached_profit_table_{}".format(route.pk))
-            if not items:
-                items = ProfitData.calculate_table_data(route)
-                timeout = 5 if settings.DEBUG else 300
-                cache.set("cached_profit_table_{}".format(route.pk), items, timeout=timeout)
+            items = get_route_table(route, RouteTable.profit)
 
 
         sort_direction_bool = False if sort_direction == "asc" else True
@@ -12,6 +12,7 @@ from market.forms import TradingRouteForm
 
 from market.models import ItemGroup, StructureMarketScanLog, MarketHistoryScanLog, PlayerTransactionScanLog, PlayerOrderScanLog, TradingRoute
 from market.tasks import update_player_orders, update_region_market_history, update_player_transactions, update_structure_orders
+from market.tasks.route_tables import invalidate_route_tables
 from eve_api.models import ObjectType
 from market.forms import EditRouteForm
 
@@ -74,6 +75,8 @@ class EditRouteView(LoginRequiredMixin, FormView):
             route.colorblind = colorblind
 
             route.save()
+            # every table depends on the route's fees
+            invalidate_route_tables(route.pk)
             messages.info(self.request, "Route details updated.")
             self.success_url = reverse(viewname='market:route-view', args=[str(route.pk)])
 
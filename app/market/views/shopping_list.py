@@ -12,6 +12,7 @@ from market.models.market_price_dao import MarketDataType
 
 from market.models import ItemGroup
 from market.models.shopping_list import ShoppingListItem
+from market.tasks.route_tables import RouteTable, get_route_table, invalidate_route_tables
 from eve_api.models import ObjectType
 
 from django.http import HttpResponseForbidden, HttpResponseBadRequest
@@ -77,11 +78,7 @@ class ShoppingListData(JSONResponseMixin, TemplateView):
                 f.close()
                 cache.set("cached_shoppinglist_demo_data", items, 86400)
         else:
-            items = cache.get("cached_shopping_list_table_{}".format(route.pk))
-            if not items:
-                items = ShoppingListData.calculate_table_data(route)
-                timeout = 1 if settings.DEBUG else 1
-                cache.set("cached_shopping_list_table_{}".format(route.pk), items, timeout=timeout)
+            items = get_route_table(route, RouteTable.shopping_list)
 
         sort_direction_bool = False if sort_direction == "asc" else True
         total_item_count = len(items)
@@ -162,6 +159,7 @@ def shopping_list_clear_view(request, pk):
 
             list_items = ShoppingListItem.objects.filter(route=route)
             list_items.delete()
+            invalidate_route_tables(route.pk, [RouteTable.shopping_list])
             return JsonResponse({"result":"ok"})
         else:
             return HttpResponseBadRequest()
@@ -215,6 +213,7 @@ def shopping_list_edit_view(request, pk):
                         quantity=qty
                     )
                     entry.save()
+            invalidate_route_tables(route.pk, [RouteTable.shopping_list])
             return JsonResponse({"result":"ok"})
         else:
             return HttpResponseBadRequest()
@@ -5,9 +5,11 @@ from django.views.generic.detail import SingleObjectMixin
 from django.urls import reverse_lazy
 from django.contrib import messages
 from django.conf import settings
+from django.db.models import Sum, F, FloatField, ExpressionWrapper
 
-from market.models import TradingRoute, MarketPriceDAO, PlayerTransaction, MarketOrder, ShoppingListItem
+from market.models import TradingRoute, MarketPriceDAO, PlayerTransaction, MarketOrder, ShoppingListItem, TransactionLinkage
 from market.models.market_price_dao import MarketDataType
+from market.tasks.route_tables import RouteTable, get_route_table
 from market.forms import TradingRouteForm
 
 from eve_api.models import ObjectType
@@ -40,45 +42,73 @@ class TransactionsData(SingleObjectMixin, JSONResponseMixin, TemplateView):
         return self.render_to_json_response(context, **response_kwargs)
 
 
+    @staticmethod
+    def _get_source_values(route, dest_char, dest_structure):
+        """
+        What every sale the route linked was bought for.
+        :return: dict of destination transaction id -> (quantity accounted for, sum of quantity * purchase price)
+        """
+        rows = TransactionLinkage.objects.filter(
+            route=route,
+            destination_transaction__character=dest_char,
+            destination_transaction__location=dest_structure,
+        ).values('destination_transaction').annotate(
+            quantity_accounted=Sum('quantity_linked'),
+            sum_of_products=Sum(ExpressionWrapper(
+                F('quantity_linked') * F('source_transaction__unit_price'),
+                output_field=FloatField()
+            ))
+        ).values_list('destination_transaction', 'quantity_accounted', 'sum_of_products')
+        return {r[0]: (r[1], r[2]) for r in rows}
+
     @staticmethod
     def calculate_table_data(route):
         dest_char = route.destination_character
         dest_structure = route.destination_structure
-        transactions = PlayerTransaction.objects.filter(
+        transactions = list(PlayerTransaction.objects.filter(
             character = dest_char,
             location = dest_structure,
             is_buy = False,
-        ).order_by('timestamp')
+        ).order_by('timestamp').values_list('ccp_id', 'timestamp', 'object_type_id', 'quantity', 'unit_price'))
 
-        player_orders = MarketOrder.objects.filter(
+        types_on_market = set(MarketOrder.objects.filter(
             character=dest_char,
             location=dest_structure,
             is_buy_order=False,
             order_active=True
-        )
-        obj_ids = [t.object_type.pk for t in transactions]
-        obj_prices = MarketPriceDAO.get_src_lowest_sell_multi(obj_ids, route)
-        data = []
-        zipped = zip(transactions, obj_prices)
-        for t, obj_price in zipped:
-            source_data = t.get_source_value(t.quantity, route)
+        ).values_list('object_type_id', flat=True).distinct())
 
-            any_orders_on_market = player_orders.filter(object_type=t.object_type).exists()
+        source_values = TransactionsData._get_source_values(route, dest_char, dest_structure)
 
+        obj_ids = [t[2] for t in transactions]
+        obj_prices = MarketPriceDAO.get_src_lowest_sell_multi(obj_ids, route)
+        obj_names = ObjectType.get_cached_item_names_multi(obj_ids)
+        data = []
+        zipped = zip(transactions, obj_prices, obj_names)
+        for (ccp_id, timestamp, object_type_id, quantity, unit_price), obj_price, obj_name in zipped:
+            source_unit_price = None
+            source_total_price = None
+            if ccp_id in source_values:
+                quant_accounted, sum_of_products = source_values[ccp_id]
+                source_unit_price = sum_of_products / quant_accounted
+                # fuzzy, scale up to the whole sale
+                source_total_price = sum_of_products if quant_accounted == quantity else quantity / quant_accounted * sum_of_products
+
+            has_source = source_unit_price is not None
             data.append(
                 [
-                    t.timestamp,
-                    t.object_type.name,
-                    t.quantity,
-                    t.unit_price,
-                    source_data.unit_price if source_data else None,
-                    (t.unit_price - source_data.unit_price) if source_data else None,
-                    t.unit_price * t.quantity,
-                    source_data.total_price if source_data else None,
-                    (t.unit_price * t.quantity - source_data.total_price) if source_data else None,
-                    any_orders_on_market,
+                    timestamp,
+                    obj_name,
+                    quantity,
+                    unit_price,
+                    source_unit_price,
+                    (unit_price - source_unit_price) if has_source else None,
+                    unit_price * quantity,
+                    source_total_price,
+                    (unit_price * quantity - source_total_price) if has_source else None,
+                    object_type_id in types_on_market,
                     obj_price,
-                    t.object_type.pk,
+                    object_type_id,
                 ]
             )
         return data
@@ -94,11 +124,7 @@ class TransactionsData(SingleObjectMixin, JSONResponseMixin, TemplateView):
                 f.close()
                 cache.set("transactions_demo_data", items, 86400)
         else:
-            items = cache.get("cached_transactions_table_{}".format(route.pk))
-            if not items:
-                items = TransactionsData.calculate_table_data(route)
-                timeout = 60 if settings.DEBUG else 600
-                cache.set("cached_transactions_table_{}".format(route.pk), items, timeout=timeout)
+            items = get_route_table(route, RouteTable.transactions)
 
         sort_direction_bool = False if sort_direction == "asc" else True
         total_item_count = len(items)
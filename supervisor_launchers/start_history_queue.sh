@@ -5,4 +5,4 @@ source env/bin/activate
 export DJANGO_SETTINGS_MODULE=conf.production
 
 cd app
-exec python ./manage.py run_consumer --queue history_queue --worker-type greenlet --workers 1
\ No newline at end of file
+exec python ./manage.py run_consumer --queue history_queue --worker-type process --workers 1
\ No newline at end of file